@@ -0,0 +1,342 @@
+"""
+Локальный анализ текста, повторяющий анализаторы индекса
+
+custom_analyzer: стандартный токенизатор, lowercase, русские стоп-слова
+(_russian_) и дополнительный список RUSSIAN_KEYWORDS.
+standard: стандартный токенизатор и lowercase (поля title и author).
+
+Для подсчета частот слов в больших текстах токенизация и подсчет
+выполняются на массивах NumPy (count_terms, top_terms, year_top_words).
+Символы переводятся в нижний регистр по одному через таблицу, кроме двух,
+у которых str.lower зависит от контекста или дает несколько символов
+('Σ' в конце слова -> 'ς', 'İ' -> 'i' и U+0307): текст с ними сначала
+переводится в нижний регистр целиком, как в analyze.
+numpy импортируется только в этих функциях: tokenize и analyze нужны
+локальному индексу и созданию индекса, которым numpy не требуется.
+"""
+
+import re
+
+
+RUSSIAN_KEYWORDS = ["князь", "повезет", "сорок"]
+
+# Список _russian_ из Elasticsearch (стоп-слова Snowball для русского языка)
+RUSSIAN_STOPWORDS = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только
+ее мне было вот от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни
+быть был него до вас нибудь опять уж вам ведь там потом себя ничего ей может они тут
+где есть надо ней для мы тебя их чем была сам чтоб без будто чего раз тоже себе под
+будет ж тогда кто этот того потому этого какой совсем ним здесь этом один почти мой
+тем чтобы нее сейчас были куда зачем всех никогда можно при наконец два об другой хоть
+после над больше тот через эти нас про всего них какая много разве три эту моя впрочем
+хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно всю
+между
+""".split())
+
+STOPWORDS = RUSSIAN_STOPWORDS | frozenset(RUSSIAN_KEYWORDS)
+
+# Приближение стандартного токенизатора: последовательности букв и цифр
+TOKEN_RE = re.compile(r"[^\W_]+")
+# Символы, которые str.lower переводит не по одному (конечная сигма, İ)
+CONTEXT_LOWER = ('\u03a3', '\u0130')
+FB2_BINARY_RE = re.compile(r"<binary[^>]*>.*?</binary>", re.S)
+MARKUP_RE = re.compile(r"<[^>]*>")
+
+
+def tokenize(text):
+    """Стандартный анализатор: токены в нижнем регистре
+
+    Аргументы:
+        text: текст
+
+    Возвращаемые значения:
+        tokens: список токенов
+
+    """
+    return TOKEN_RE.findall(text.lower())
+
+
+def fb2_text(text):
+    """Текст файла FictionBook без разметки и вложений <binary>
+
+    Аргументы:
+        text: содержимое файла .fb2
+
+    Возвращаемые значения:
+        text: текст без тегов
+
+    """
+    return MARKUP_RE.sub(' ', FB2_BINARY_RE.sub(' ', text))
+
+
+def analyze(text):
+    """custom_analyzer: токены в нижнем регистре без стоп-слов
+
+    Аргументы:
+        text: текст
+
+    Возвращаемые значения:
+        tokens: список токенов
+
+    """
+    return [token for token in tokenize(text) if token not in STOPWORDS]
+
+
+HASH_BASE = 1099511628211
+TABLES = {}
+
+
+def char_code(code):
+    """Код символа в нижнем регистре для букв и цифр, 0 для остальных
+
+    Аргументы:
+        code: код символа
+
+    Возвращаемые значения:
+        code: код символа после lowercase (0 - не буква и не цифра)
+
+    """
+    char = chr(code)
+    if not char.isalnum():
+        return 0
+    lower = char.lower()
+    return ord(lower) if len(lower) == 1 else code
+
+
+def char_table():
+    """Таблица символов BMP: код символа в нижнем регистре для букв и цифр, 0 для остальных
+
+    Возвращаемые значения:
+        table: массив uint32 из 65536 элементов
+
+    """
+    import numpy as np
+    if 'chars' not in TABLES:
+        TABLES['chars'] = np.array([char_code(code) for code in range(65536)],
+                                   dtype=np.uint32)
+    return TABLES['chars']
+
+
+def hash_powers(length):
+    """Степени основания полиномиального хеша и обратные к ним (по модулю 2**64)
+
+    Аргументы:
+        length: минимальная длина массивов
+
+    Возвращаемые значения:
+        powers: массив степеней основания
+        inverse: массив степеней обратного элемента
+
+    """
+    import numpy as np
+    if TABLES.get('powers') is None or len(TABLES['powers']) < length:
+        length = max(length, 1 << 20)
+        powers = np.full(length, HASH_BASE, dtype=np.uint64)
+        powers[0] = 1
+        inverse = np.full(length, pow(HASH_BASE, -1, 2 ** 64), dtype=np.uint64)
+        inverse[0] = 1
+        TABLES['powers'] = np.cumprod(powers)
+        TABLES['inverse'] = np.cumprod(inverse)
+    return TABLES['powers'], TABLES['inverse']
+
+
+def token_hashes(text):
+    """Токенизация текста одним проходом по массиву кодов символов
+
+    Каждый токен представлен 64-битным полиномиальным хешем своих символов
+    в нижнем регистре, посчитанным через префиксные суммы. Символы вне BMP
+    переводятся через char_code по одному на каждый различный код.
+
+    Аргументы:
+        text: текст
+
+    Возвращаемые значения:
+        hashes: хеши токенов (uint64)
+        starts: позиции начала токенов
+        ends: позиции конца токенов
+        codes: коды символов текста в нижнем регистре (0 - не буква и не цифра)
+
+    """
+    import numpy as np
+    if any(char in text for char in CONTEXT_LOWER):
+        text = text.lower()
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    astral = codes > 65535
+    table = char_table()
+    if astral.any():
+        unique = np.unique(codes[astral])
+        lower = np.array([char_code(code) for code in unique.tolist()], dtype=np.uint32)
+        mapped = lower[np.searchsorted(unique, codes[astral])]
+        codes = table[np.where(astral, 0, codes)]
+        codes[astral] = mapped
+    else:
+        codes = table[codes]
+    edges = np.diff((codes != 0).view(np.int8), prepend=np.int8(0), append=np.int8(0))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    powers, inverse = hash_powers(len(codes))
+    prefix = np.zeros(len(codes) + 1, dtype=np.uint64)
+    np.cumsum(codes.astype(np.uint64) * powers[:len(codes)], out=prefix[1:])
+    hashes = (prefix[ends] - prefix[starts]) * inverse[starts]
+    hashes ^= (ends - starts).astype(np.uint64) << np.uint64(56)
+    return hashes, starts, ends, codes
+
+
+def stopword_hashes():
+    """Хеши стоп-слов custom_analyzer
+
+    Возвращаемые значения:
+        hashes: отсортированный массив хешей
+
+    """
+    import numpy as np
+    if 'stopwords' not in TABLES:
+        TABLES['stopwords'] = np.sort(token_hashes(' '.join(sorted(STOPWORDS)))[0])
+    return TABLES['stopwords']
+
+
+class Vocabulary:
+    """Общий словарь: хеш слова -> номер, номер -> слово
+
+    Хеши хранятся в отсортированном массиве, символы слов - в одном буфере
+    кодов, поэтому поиск и добавление слов выполняются без цикла по словам.
+    """
+
+    def __init__(self):
+        import numpy as np
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.sorted_ids = np.zeros(0, dtype=np.int64)
+        self.chars = np.zeros(0, dtype=np.uint32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def ids(self, hashes, codes, starts, ends):
+        """Номера слов по их хешам, новые слова добавляются в словарь
+
+        Аргументы:
+            hashes: различные хеши слов
+            codes: коды символов текста
+            starts: позиция начала одного из вхождений каждого слова
+            ends: позиция конца того же вхождения
+
+        Возвращаемые значения:
+            ids: массив номеров слов
+
+        """
+        import numpy as np
+        pos = np.searchsorted(self.hashes, hashes)
+        found = pos < len(self.hashes)
+        found[found] = self.hashes[pos[found]] == hashes[found]
+        ids = np.empty(len(hashes), dtype=np.int64)
+        ids[found] = self.sorted_ids[pos[found]]
+
+        new = ~found
+        new_ids = np.arange(len(self), len(self) + np.count_nonzero(new))
+        ids[new] = new_ids
+        lengths = ends[new] - starts[new]
+        gather = (np.repeat(starts[new] - np.cumsum(lengths) + lengths, lengths)
+                  + np.arange(lengths.sum()))
+        self.chars = np.concatenate([self.chars, codes[gather]])
+        self.offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum(lengths)])
+        self.hashes = np.insert(self.hashes, pos[new], hashes[new])
+        self.sorted_ids = np.insert(self.sorted_ids, pos[new], new_ids)
+        return ids
+
+    def term(self, term_id):
+        """Слово по номеру
+
+        Аргументы:
+            term_id: номер слова
+
+        Возвращаемые значения:
+            term: слово
+
+        """
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.chars[start:end].tobytes().decode('utf-32-le')
+
+
+def count_terms(text, vocabulary):
+    """Частоты слов текста после custom_analyzer
+
+    Аргументы:
+        text: текст
+        vocabulary: общий словарь Vocabulary
+
+    Возвращаемые значения:
+        ids: номера различных слов в словаре
+        counts: число упоминаний каждого слова
+
+    """
+    import numpy as np
+    hashes, starts, ends, codes = token_hashes(text)
+    order = np.argsort(hashes)
+    ordered = hashes[order]
+    first = np.ones(len(ordered), dtype=bool)
+    first[1:] = ordered[1:] != ordered[:-1]
+    unique = ordered[first]
+    counts = np.diff(np.append(np.flatnonzero(first), len(ordered)))
+    positions = order[first]
+
+    keep = ~np.isin(unique, stopword_hashes())
+    positions = positions[keep]
+    ids = vocabulary.ids(unique[keep], codes, starts[positions], ends[positions])
+    return ids, counts[keep]
+
+
+def top_terms(ids, counts, vocabulary, top=10):
+    """Самые частые слова
+
+    Аргументы:
+        ids: номера слов
+        counts: число упоминаний
+        vocabulary: общий словарь Vocabulary
+        top: число слов
+
+    Возвращаемые значения:
+        words: список пар (слово, число упоминаний) по убыванию
+
+    """
+    import numpy as np
+    if len(ids) > top:
+        best = np.argpartition(counts, -top)[-top:]
+        ids, counts = ids[best], counts[best]
+    order = np.argsort(-counts, kind='stable')
+    return [(vocabulary.term(term_id), int(count))
+            for term_id, count in zip(ids[order].tolist(), counts[order].tolist())]
+
+
+def year_top_words(books, top=10):
+    """Самые частые слова по книгам и по годам
+
+    Аргументы:
+        books: итератор кортежей (название, год, текст)
+        top: число слов
+
+    Возвращаемые значения:
+        by_book: словарь название -> список пар (слово, число упоминаний)
+        by_year: словарь год -> список пар (слово, число упоминаний)
+
+    """
+    import numpy as np
+    vocabulary = Vocabulary()
+    by_book = {}
+    year_counts = {}
+    for name, year, text in books:
+        ids, counts = count_terms(text, vocabulary)
+        by_book[name] = top_terms(ids, counts, vocabulary, top)
+        total = year_counts.get(year, np.zeros(0, dtype=np.int64))
+        if len(total) < len(vocabulary):
+            total = np.concatenate([total, np.zeros(len(vocabulary) - len(total),
+                                                    dtype=np.int64)])
+        np.add.at(total, ids, counts)
+        year_counts[year] = total
+
+    by_year = {}
+    for year, total in year_counts.items():
+        ids = np.flatnonzero(total)
+        by_year[year] = top_terms(ids, total[ids], vocabulary, top)
+    return by_book, by_year
@@ -0,0 +1,601 @@
+"""
+Нагрузочный тест команд main.py на синтетическом корпусе
+
+usage: benchmark.py [-h] [--books N] [--mb M] [--runs R] [--backend BACKEND] ...
+
+Корпус: N книг по M МБ в LR_2/input/bench-*, имена файлов 'название - автор - год',
+слова выбираются из словаря образцов LR_2/input по закону Ципфа.
+
+Замеряются add-books (или build-local), count-books-with-words, search-books,
+search-dates, calc-date и top-words: p50/p95/p99 задержки, пропускная способность
+и пиковый RSS. Результат выводится таблицей и пишется в JSON (--output) для
+сравнения запусков на разных коммитах (--compare).
+
+Варианты --backend:
+    elasticsearch - реальный кластер (индекс LR2_INDEX, по умолчанию 'lr2-bench');
+    mock - клиент Elasticsearch с транспортом-заглушкой без сети: измеряется
+           только работа клиента (запросы, сериализация, разбор ответов);
+    local - локальный индекс local_index без Elasticsearch.
+
+С --startup вместо нагрузочного теста замеряется запуск python -m main
+(python -X importtime): время импортов до разбора аргументов и до
+создания клиента Elasticsearch. Если оно больше --import-budget
+(или --client-budget), скрипт завершается с кодом 1.
+"""
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import platform
+import argparse
+import contextlib
+import subprocess
+from collections import Counter
+from datetime import datetime, timezone
+
+os.environ.setdefault('LR2_INDEX', 'lr2-bench')
+
+from prettytable import PrettyTable
+from elasticsearch6 import Elasticsearch
+from elasticsearch6.connection import Connection
+
+import main
+from analysis import STOPWORDS, fb2_text, tokenize
+
+
+SAMPLES = ['LR_2/input', 'LR_3/input/books']
+SYLLABLES = ['ка', 'ра', 'но', 'ли', 'ве', 'то', 'мо', 'сти', 'пре', 'да', 'ни', 'ро', 'ла',
+             'же', 'вы', 'ко', 'ту', 'ми', 'се', 'ча']
+# Аргументы python после -X importtime: точка входа образа (python -m main) до
+# разбора аргументов и создание клиента Elasticsearch
+STARTUP_PATHS = {
+    'arg_parse': ['-m', 'main', '--help'],
+    'connect': ['-c', "import main; main.connect_elasticsearch('localhost', 9200, ping=False)"]
+}
+IMPORT_BUDGET_MS = 50
+# Импорты elasticsearch6 и urllib3 до первого сетевого вызова (около 120 мс в образе)
+CLIENT_BUDGET_MS = 200
+OPERATIONS = ['count-books-with-words', 'search-books', 'search-dates', 'calc-date',
+              'top-words']
+
+
+def arg_parse():
+    """Обработка аргументов командной строки
+
+    Возвращаемые значения:
+        argument: введенные аргументы
+    """
+    argument = argparse.ArgumentParser()
+    argument.add_argument("--books", type=int, default=20, help="число книг в корпусе")
+    argument.add_argument("--mb", type=float, default=1, help="размер одной книги, МБ")
+    argument.add_argument("--authors", type=int, default=5, help="число авторов")
+    argument.add_argument("--vocabulary", type=int, default=50000,
+                          help="размер словаря корпуса")
+    argument.add_argument("--zipf", type=float, default=1.07,
+                          help="показатель распределения Ципфа")
+    argument.add_argument("--seed", type=int, default=1, help="начальное значение генератора")
+    argument.add_argument("--runs", type=int, default=50,
+                          help="число запусков каждой команды поиска")
+    argument.add_argument("--backend", choices=['elasticsearch', 'mock', 'local'],
+                          default='mock', help="где выполнять команды")
+    argument.add_argument("-s", "--host", default='localhost')
+    argument.add_argument("-p", "--port", type=int, default=9200)
+    argument.add_argument("--chunk-size", type=int, default=500,
+                          help="число документов в одном bulk-запросе")
+    argument.add_argument("--threads", type=int, default=1,
+                          help="число параллельных bulk-запросов")
+    argument.add_argument("--split-kb", type=int, default=None,
+                          help="разбивать книги на части по заданному числу КБ")
+    argument.add_argument("--mapping", choices=['default', 'lean'], default='default',
+                          help="профиль маппинга индекса")
+    argument.add_argument("-o", "--output", default=None, help="файл JSON с результатами")
+    argument.add_argument("--compare", default=None,
+                          help="файл JSON предыдущего запуска для сравнения")
+    argument.add_argument("--keep", action='store_true',
+                          help="не удалять корпус и индекс после теста")
+    argument.add_argument("--startup", action='store_true',
+                          help="замерить только время запуска main.py")
+    argument.add_argument("--import-budget", type=float, default=IMPORT_BUDGET_MS,
+                          help="допустимое время импортов до разбора аргументов, мс")
+    argument.add_argument("--client-budget", type=float, default=CLIENT_BUDGET_MS,
+                          help="допустимое время импортов до первого запроса, мс")
+    return argument.parse_args()
+
+
+class MockConnection(Connection):
+    """Транспорт-заглушка: отвечает на запросы main.py без сети
+
+    Bulk-запросы подтверждаются по строкам действий, поиск возвращает
+    пустые результаты с агрегациями нужной формы.
+    """
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None,
+                        ignore=(), headers=None):
+        path = url.split('?')[0]
+        if method == 'HEAD':
+            return 200, {}, ''
+        if path.endswith('/_bulk'):
+            return 200, {}, json.dumps(mock_bulk(body))
+        if path.endswith('/_mget'):
+            ids = json.loads(body)['ids']
+            return 200, {}, json.dumps({'docs': [{'_id': idi, 'found': False} for idi in ids]})
+        if path.endswith('/_mtermvectors'):
+            return 200, {}, json.dumps({'docs': []})
+        if path.endswith('/_search') or path.endswith('/_msearch') or 'scroll' in path:
+            return 200, {}, json.dumps(mock_search(body))
+        return 200, {}, '{}'
+
+
+def mock_bulk(body):
+    """Ответ bulk API: успех для каждого действия
+
+    Аргументы:
+        body: тело запроса
+
+    Возвращаемые значения:
+        response: ответ bulk API
+
+    """
+    data = body if isinstance(body, bytes) else body.encode('utf-8')
+    items, pos = [], 0
+    while pos < len(data):
+        end = data.find(b'\n', pos)
+        op_type, meta = next(iter(json.loads(data[pos:end]).items()))
+        items.append({op_type: {'_id': meta.get('_id'), 'status': 201}})
+        pos = end + 1
+        if op_type != 'delete':
+            pos = data.find(b'\n', pos) + 1
+    return {'took': 0, 'errors': False, 'items': items}
+
+
+def mock_aggregations(aggs):
+    """Пустые результаты агрегаций той же формы, что у Elasticsearch
+
+    Аргументы:
+        aggs: описание агрегаций из запроса
+
+    Возвращаемые значения:
+        result: словарь имя -> пустой результат
+
+    """
+    result = {}
+    for name, agg in (aggs or {}).items():
+        kind = next(key for key in agg if key not in ('aggs', 'aggregations', 'meta'))
+        if kind == 'stats':
+            result[name] = {'count': 0, 'min': None, 'max': None, 'avg': None, 'sum': 0}
+        elif kind == 'percentiles':
+            result[name] = {'values': {}}
+        elif kind == 'top_hits':
+            result[name] = {'hits': {'total': 0, 'hits': []}}
+        elif kind in ('terms', 'composite', 'histogram', 'date_histogram'):
+            result[name] = {'buckets': []}
+        else:
+            result[name] = {'value': 0}
+    return result
+
+
+def mock_search(body):
+    """Пустой ответ поиска (или _msearch)
+
+    Аргументы:
+        body: тело запроса
+
+    Возвращаемые значения:
+        response: ответ поиска
+
+    """
+    empty = {'_scroll_id': 'mock', 'took': 0, 'timed_out': False,
+             '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+             'hits': {'total': 0, 'max_score': None, 'hits': []}}
+    if not body:
+        return empty
+    text = body.decode('utf-8') if isinstance(body, bytes) else body
+    lines = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if len(lines) == 1:
+        return dict(empty, aggregations=mock_aggregations(lines[0].get('aggs')))
+    return {'responses': [dict(empty, aggregations=mock_aggregations(search.get('aggs')))
+                          for search in lines[1::2]]}
+
+
+def sample_vocabulary(size):
+    """Словарь по образцам LR_2/input, отсортированный по частоте
+
+    Если образцов нет, слова составляются из слогов.
+
+    Аргументы:
+        size: число слов
+
+    Возвращаемые значения:
+        words: список слов от самого частого к редкому
+
+    """
+    counts = Counter()
+    for sample in SAMPLES:
+        for root, _, files in os.walk(sample):
+            for name_file in files:
+                if not name_file.endswith(('.txt', '.fb2')):
+                    continue
+                text, _, error = main.read_book(os.path.join(root, name_file))
+                if error is None:
+                    counts.update(tokenize(fb2_text(text) if name_file.endswith('.fb2')
+                                           else text))
+    words = [word for word, _ in counts.most_common(size)]
+    generator = random.Random(0)
+    while len(words) < size:
+        word = ''.join(generator.choices(SYLLABLES, k=generator.randint(2, 4)))
+        if word not in counts:
+            counts[word] = 1
+            words.append(word)
+    return words
+
+
+def zipf_weights(size, exponent):
+    """Накопленные веса распределения Ципфа
+
+    Аргументы:
+        size: число слов
+        exponent: показатель распределения
+
+    Возвращаемые значения:
+        cum_weights: накопленные веса для random.choices
+
+    """
+    total, cum_weights = 0.0, []
+    for rank in range(1, size + 1):
+        total += rank ** -exponent
+        cum_weights.append(total)
+    return cum_weights
+
+
+def generate_corpus(directory, books, megabytes, authors, words, cum_weights, seed):
+    """Запись синтетического корпуса
+
+    Аргументы:
+        directory: каталог корпуса
+        books: число книг
+        megabytes: размер одной книги, МБ
+        authors: число авторов
+        words: словарь
+        cum_weights: накопленные веса слов
+        seed: начальное значение генератора
+
+    Возвращаемые значения:
+        corpus: список кортежей (название, автор, год)
+
+    """
+    generator = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    corpus = []
+    for number in range(books):
+        book = (f"Книга {number + 1}", f"Автор {generator.randint(1, authors)}",
+                str(generator.randint(1800, 2020)))
+        corpus.append(book)
+        file_path = os.path.join(directory, ' - '.join(book) + '.txt')
+        if os.path.exists(file_path):
+            continue
+        size, limit = 0, int(megabytes * 1024 * 1024)
+        with open(file_path, 'w', encoding='utf-8') as write_file:
+            while size < limit:
+                line = ' '.join(generator.choices(words, cum_weights=cum_weights, k=12)) + '\n'
+                write_file.write(line)
+                size += len(line.encode('utf-8'))
+    return corpus
+
+
+def percentile(values, share):
+    """Процентиль по рангу
+
+    Аргументы:
+        values: отсортированный список значений
+        share: доля (0.5, 0.95, 0.99)
+
+    Возвращаемые значения:
+        value: значение процентиля
+
+    """
+    return values[max(0, math.ceil(share * len(values)) - 1)]
+
+
+def measure(call, runs):
+    """Замер задержек вызова
+
+    Вывод команды подавляется, выход через sys.exit считается обычным
+    завершением (так команды сообщают об отсутствии результатов).
+
+    Аргументы:
+        call: функция от номера запуска
+        runs: число запусков
+
+    Возвращаемые значения:
+        result: словарь с процентилями задержки, пропускной способностью и пиковым RSS
+
+    """
+    latencies = []
+    start = time.perf_counter()
+    for run in range(runs):
+        begin = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                call(run)
+            except SystemExit:
+                pass
+        latencies.append((time.perf_counter() - begin) * 1000)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'runs': runs,
+        'p50_ms': round(percentile(latencies, 0.5), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'mean_ms': round(sum(latencies) / runs, 3),
+        'throughput_ops': round(runs / elapsed, 2),
+        'peak_rss_mb': main.peak_memory()
+    }
+
+
+def query_args(corpus, words, cum_weights, seed, runs):
+    """Аргументы команд поиска для каждого запуска
+
+    Слова запросов выбираются по тому же распределению Ципфа без стоп-слов.
+
+    Аргументы:
+        corpus: список кортежей (название, автор, год)
+        words: словарь
+        cum_weights: накопленные веса слов
+        seed: начальное значение генератора
+        runs: число запусков
+
+    Возвращаемые значения:
+        queries: словарь команда -> список списков аргументов
+
+    """
+    generator = random.Random(seed + 1)
+    content = [(word, weight) for word, weight in zip(words, cum_weights)
+               if word not in STOPWORDS]
+    query_words = generator.choices([word for word, _ in content], k=runs,
+                                    cum_weights=[weight for _, weight in content])
+    authors = [generator.choice(corpus)[1] for _ in range(runs)]
+    years = [generator.choice(corpus)[2] for _ in range(runs)]
+    ranges = [sorted(generator.sample(range(1800, 2021), 2)) for _ in range(runs)]
+    return {
+        'count-books-with-words': [[word] for word in query_words],
+        'search-books': [[word, '-a', author] for word, author in zip(query_words, authors)],
+        'search-dates': [[word, '-f', str(low), '-u', str(high)]
+                         for word, (low, high) in zip(query_words, ranges)],
+        'calc-date': [['-a', author] for author in authors],
+        'top-words': [['-y', year] for year in years]
+    }
+
+
+def elastic_client(backend, host, port):
+    """Клиент Elasticsearch для теста
+
+    Аргументы:
+        backend: elasticsearch или mock
+        host: хост
+        port: порт
+
+    Возвращаемые значения:
+        elastic: объект подключения
+
+    """
+    if backend == 'mock':
+        return Elasticsearch([{'host': 'mock'}], connection_class=MockConnection)
+    return main.connect_elasticsearch(host, port, timeout=600, ping=False)
+
+
+def run_benchmark(args, corpus_path, corpus, queries):
+    """Замер загрузки и команд поиска
+
+    Аргументы:
+        args: разобранные аргументы
+        corpus_path: каталог корпуса относительно LR_2/input
+        corpus: список кортежей (название, автор, год)
+        queries: словарь команда -> список аргументов для каждого запуска
+
+    Возвращаемые значения:
+        results: словарь команда -> результаты замера
+
+    """
+    size = sum(os.path.getsize(os.path.join('LR_2/input', corpus_path, ' - '.join(book) + '.txt'))
+               for book in corpus)
+    results = {}
+    if args.backend == 'local':
+        local_path = os.path.join('LR_2/input', f'{corpus_path}.idx')
+        base = ['--backend', 'local', '--local-index', local_path]
+        results['build-local'] = measure(lambda run: main.run_local_command(
+            main.arg_parse(['build-local', corpus_path] + base)), 1)
+        command = lambda argv: main.run_local_command(main.arg_parse(argv + base))
+        cleanup = lambda: os.remove(local_path)
+    else:
+        elastic = elastic_client(args.backend, args.host, args.port)
+        if args.backend == 'elasticsearch':
+            if not main.INDEX_NAME.startswith('lr2-bench'):
+                print(f"Тест удаляет индекс '{main.INDEX_NAME}*': задайте LR2_INDEX=lr2-bench...")
+                sys.exit(1)
+            elastic.indices.delete(index=f"{main.INDEX_NAME}*", ignore=404)
+        with contextlib.redirect_stdout(io.StringIO()):
+            main.create_index(elastic, profile=args.mapping)
+        options = ['--chunk-size', str(args.chunk_size), '--threads', str(args.threads)]
+        if args.split_kb:
+            options += ['--split-kb', str(args.split_kb)]
+        results['add-books'] = measure(lambda run: main.run_command(
+            main.arg_parse(['add-books', corpus_path] + options), elastic), 1)
+        elastic.indices.refresh(index=main.INDEX_NAME)
+        if args.backend == 'elasticsearch':
+            elastic.indices.flush(index=main.INDEX_NAME)
+            store = elastic.indices.stats(index=main.INDEX_NAME, metric='store')
+            results['add-books']['index_mb'] = round(
+                store['_all']['primaries']['store']['size_in_bytes'] / 1024 / 1024, 2)
+        command = lambda argv: main.run_command(main.arg_parse(argv), elastic)
+        cleanup = lambda: elastic.indices.delete(index=f"{main.INDEX_NAME}*", ignore=404)
+
+    load = results.get('add-books') or results['build-local']
+    load['books'] = len(corpus)
+    load['mb'] = round(size / 1024 / 1024, 2)
+    load['mb_per_s'] = round(load['mb'] / (load['mean_ms'] / 1000), 2)
+
+    for operation in OPERATIONS:
+        argvs = queries[operation]
+        results[operation] = measure(lambda run: command([operation] + argvs[run]), len(argvs))
+    if not args.keep and args.backend != 'mock':
+        cleanup()
+    return results
+
+
+def import_time(argv):
+    """Время импортов и запуска отдельного процесса python -X importtime
+
+    Аргументы:
+        argv: аргументы python (выполняется в каталоге LR_2)
+
+    Возвращаемые значения:
+        imports_ms: суммарное собственное время всех импортов, мс
+        wall_ms: время работы процесса, мс
+
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', *argv],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+    wall = (time.perf_counter() - start) * 1000
+    imports = 0
+    for line in result.stderr.splitlines():
+        # import time: <собственное, мкс> | <с вложенными, мкс> | <модуль>
+        own = line.partition('|')[0].rpartition(':')[2].strip()
+        if line.startswith('import time:') and own.isdigit():
+            imports += int(own)
+    return imports / 1000, wall
+
+
+def startup(args):
+    """Замер запуска main.py с проверкой бюджета времени импортов
+
+    Аргументы:
+        args: разобранные аргументы
+
+    Возвращаемые значения:
+        code: код завершения (1, если бюджет превышен)
+
+    """
+    budgets = {'arg_parse': args.import_budget, 'connect': args.client_budget}
+    runs = max(1, min(args.runs, 20))
+    table = PrettyTable(['Путь', 'Импорты p50, мс', 'Процесс p50, мс', 'Бюджет, мс', ''])
+    table.align['Путь'] = 'l'
+    results, code = {}, 0
+    for name, argv in STARTUP_PATHS.items():
+        times = [import_time(argv) for _ in range(runs)]
+        imports = percentile(sorted(imports for imports, _ in times), 0.5)
+        wall = percentile(sorted(wall for _, wall in times), 0.5)
+        over = budgets[name] is not None and imports > budgets[name]
+        code = 1 if over else code
+        results[name] = {'imports_p50_ms': round(imports, 1), 'wall_p50_ms': round(wall, 1),
+                         'budget_ms': budgets[name]}
+        table.add_row([name, round(imports, 1), round(wall, 1),
+                       '-' if budgets[name] is None else budgets[name],
+                       'ПРЕВЫШЕН' if over else ''])
+    print(table)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as write_file:
+            json.dump({'commit': git_commit(), 'python': platform.python_version(),
+                       'startup': results}, write_file, ensure_ascii=False, indent=2)
+    return code
+
+
+def git_commit():
+    """Текущий коммит репозитория
+
+    Возвращаемые значения:
+        commit: хеш коммита (None вне репозитория git)
+
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous=None):
+    """Вывод результатов и сравнение с предыдущим запуском
+
+    Аргументы:
+        results: словарь команда -> результаты замера
+        previous: результаты предыдущего запуска (None - без сравнения)
+
+    Возвращаемые значения:
+
+    """
+    columns = ['Команда', 'Запусков', 'p50, мс', 'p95, мс', 'p99, мс', 'Оп/с', 'Пик RSS, МБ']
+    if previous:
+        columns.append('p50 к прошлому')
+    table = PrettyTable(columns)
+    for operation, result in results.items():
+        row = [operation, result['runs'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+               result['throughput_ops'], result['peak_rss_mb']]
+        if previous:
+            old = previous.get(operation)
+            row.append(f"{(result['p50_ms'] / old['p50_ms'] - 1) * 100:+.1f}%"
+                       if old and old['p50_ms'] else '-')
+        table.add_row(row)
+    print(table)
+    load = results.get('add-books') or results.get('build-local')
+    print(f"Загрузка: {load['books']} книг, {load['mb']} МБ, {load['mb_per_s']} МБ/с"
+          + (f", размер индекса {load['index_mb']} МБ" if 'index_mb' in load else ''))
+
+
+def benchmark():
+    """Генерация корпуса, замер команд и запись результатов"""
+    args = arg_parse()
+    if args.startup:
+        sys.exit(startup(args))
+    corpus_path = f"bench-{args.books}x{args.mb:g}mb-{args.seed}"
+    directory = os.path.join('LR_2/input', corpus_path)
+
+    start = time.perf_counter()
+    words = sample_vocabulary(args.vocabulary)
+    cum_weights = zipf_weights(len(words), args.zipf)
+    corpus = generate_corpus(directory, args.books, args.mb, args.authors, words, cum_weights,
+                             args.seed)
+    print(f"Корпус {directory}: {len(corpus)} книг, "
+          f"{round(time.perf_counter() - start, 2)} с")
+
+    queries = query_args(corpus, words, cum_weights, args.seed, args.runs)
+    try:
+        results = run_benchmark(args, corpus_path, corpus, queries)
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as read_file:
+            previous = json.load(read_file)['results']
+    print_results(results, previous)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'backend': args.backend,
+        'mapping': args.mapping if args.backend != 'local' else None,
+        'index': main.INDEX_NAME if args.backend != 'local' else None,
+        'corpus': {'books': args.books, 'mb': args.mb, 'authors': args.authors,
+                   'vocabulary': len(words), 'zipf': args.zipf, 'seed': args.seed,
+                   'split_kb': args.split_kb},
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as write_file:
+            json.dump(report, write_file, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {args.output}")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,242 @@
+"""
+Локальный инвертированный индекс для работы без Elasticsearch
+
+Индекс хранится в одном файле и открывается через mmap: заголовок с
+метаданными книг в JSON и массивы uint32 (словарь, списки вхождений и
+частоты слов по книгам), которые читаются без копирования.
+"""
+
+import sys
+import json
+import mmap
+import heapq
+import struct
+from array import array
+from collections import Counter
+
+from analysis import analyze, tokenize
+
+
+MAGIC = b'LR2IDX01'
+ARRAYS = ('term_offsets', 'post_offsets', 'post_docs', 'post_tf',
+          'doc_offsets', 'doc_terms', 'doc_tf')
+
+
+def build_index(books, path):
+    """Построение локального индекса и запись его в файл
+
+    Аргументы:
+        books: итератор кортежей (название, автор, год, текст)
+        path: путь к файлу индекса
+
+    Возвращаемые значения:
+        count: число книг в индексе
+
+    """
+    docs = []
+    doc_counts = []
+    vocabulary = set()
+    for name, author, year, text in books:
+        counts = Counter(analyze(text))
+        vocabulary.update(counts)
+        doc_counts.append(counts)
+        docs.append({'title': name, 'author': author, 'year': str(year),
+                     'author_tokens': tokenize(author)})
+
+    terms = sorted(vocabulary, key=lambda term: term.encode('utf-8'))
+    term_ids = {term: number for number, term in enumerate(terms)}
+    arrays = {name: array('I') for name in ARRAYS}
+
+    blob = bytearray()
+    for term in terms:
+        arrays['term_offsets'].append(len(blob))
+        blob += term.encode('utf-8')
+    arrays['term_offsets'].append(len(blob))
+
+    postings = [[] for _ in terms]
+    arrays['doc_offsets'].append(0)
+    for doc, counts in enumerate(doc_counts):
+        for term_id, freq in sorted((term_ids[term], freq) for term, freq in counts.items()):
+            postings[term_id].append((doc, freq))
+            arrays['doc_terms'].append(term_id)
+            arrays['doc_tf'].append(freq)
+        arrays['doc_offsets'].append(len(arrays['doc_terms']))
+
+    arrays['post_offsets'].append(0)
+    for term_postings in postings:
+        for doc, freq in term_postings:
+            arrays['post_docs'].append(doc)
+            arrays['post_tf'].append(freq)
+        arrays['post_offsets'].append(len(arrays['post_docs']))
+
+    layout = {}
+    offset = 0
+    for name in ARRAYS:
+        size = len(arrays[name]) * arrays[name].itemsize
+        layout[name] = [offset, size]
+        offset += size
+    layout['terms'] = [offset, len(blob)]
+    header = json.dumps({
+        'byteorder': sys.byteorder,
+        'docs': docs,
+        'layout': layout
+    }, ensure_ascii=False).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+
+    with open(path, 'wb') as out:
+        out.write(MAGIC)
+        out.write(struct.pack('<Q', len(header)))
+        out.write(header)
+        for name in ARRAYS:
+            arrays[name].tofile(out)
+        out.write(blob)
+    return len(docs)
+
+
+class LocalIndex:
+    """Локальный индекс, открытый через mmap"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as read_file:
+            self.mmap = mmap.mmap(read_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"Файл {path} не является локальным индексом")
+        header_size = struct.unpack_from('<Q', self.mmap, len(MAGIC))[0]
+        start = len(MAGIC) + 8
+        meta = json.loads(bytes(self.mmap[start:start + header_size]))
+        if meta['byteorder'] != sys.byteorder:
+            raise ValueError(f"Индекс {path} записан с другим порядком байт")
+        self.docs = meta['docs']
+
+        self.data = memoryview(self.mmap)[start + header_size:]
+        for name in ARRAYS:
+            offset, size = meta['layout'][name]
+            setattr(self, name, self.data[offset:offset + size].cast('I'))
+        offset, size = meta['layout']['terms']
+        self.terms = self.data[offset:offset + size]
+
+    def term_id(self, term):
+        """Номер слова в словаре или None
+
+        Аргументы:
+            term: слово после анализа
+
+        Возвращаемые значения:
+            term_id: номер слова
+
+        """
+        key = term.encode('utf-8')
+        low, high = 0, len(self.term_offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.term(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.term_offsets) - 1 and self.term(low) == key:
+            return low
+        return None
+
+    def term(self, term_id):
+        """Слово словаря по номеру (в UTF-8)
+
+        Аргументы:
+            term_id: номер слова
+
+        Возвращаемые значения:
+            term: слово
+
+        """
+        return bytes(self.terms[self.term_offsets[term_id]:self.term_offsets[term_id + 1]])
+
+    def docs_with_words(self, word):
+        """Книги, в которых есть хотя бы одно слово строки (как match)
+
+        Аргументы:
+            word: строка
+
+        Возвращаемые значения:
+            docs: множество номеров книг
+
+        """
+        docs = set()
+        for term in analyze(word):
+            term_id = self.term_id(term)
+            if term_id is not None:
+                start, end = self.post_offsets[term_id], self.post_offsets[term_id + 1]
+                docs.update(self.post_docs[start:end])
+        return docs
+
+    def docs_by_author(self, author):
+        """Книги, в имени автора которых есть хотя бы одно слово строки
+
+        Аргументы:
+            author: автор
+
+        Возвращаемые значения:
+            docs: множество номеров книг
+
+        """
+        tokens = set(tokenize(author))
+        return {doc for doc, meta in enumerate(self.docs)
+                if tokens.intersection(meta['author_tokens'])}
+
+    def docs_by_years(self, from_date, until_date):
+        """Книги из диапазона годов
+
+        Аргументы:
+            from_date: начальный год
+            until_date: конечный год
+
+        Возвращаемые значения:
+            docs: множество номеров книг
+
+        """
+        return {doc for doc, meta in enumerate(self.docs)
+                if int(from_date) <= int(meta['year']) <= int(until_date)}
+
+    def books(self, docs):
+        """Метаданные книг в порядке номеров
+
+        Аргументы:
+            docs: номера книг
+
+        Возвращаемые значения:
+            books: список словарей title, author, year
+
+        """
+        return [self.docs[doc] for doc in sorted(docs)]
+
+    def top_words(self, year, top=10):
+        """Самые частые слова в книгах года
+
+        Аргументы:
+            year: год публикации
+            top: число слов
+
+        Возвращаемые значения:
+            words: список пар (слово, число упоминаний)
+
+        """
+        docs = [doc for doc, meta in enumerate(self.docs) if meta['year'] == str(year)]
+        if len(docs) == 1:
+            start, end = self.doc_offsets[docs[0]], self.doc_offsets[docs[0] + 1]
+            best = heapq.nlargest(top, range(start, end), key=self.doc_tf.__getitem__)
+            return [(self.term(self.doc_terms[pos]).decode('utf-8'), self.doc_tf[pos])
+                    for pos in best]
+
+        counts = Counter()
+        for doc in docs:
+            start, end = self.doc_offsets[doc], self.doc_offsets[doc + 1]
+            for term_id, freq in zip(self.doc_terms[start:end], self.doc_tf[start:end]):
+                counts[term_id] += freq
+        return [(self.term(term_id).decode('utf-8'), count)
+                for term_id, count in counts.most_common(top)]
+
+    def close(self):
+        """Закрытие файла индекса"""
+        for name in ARRAYS:
+            getattr(self, name).release()
+        self.terms.release()
+        self.data.release()
+        self.mmap.close()
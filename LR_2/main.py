@@ -11,24 +11,95 @@ usage: main.py [-h] [-p PORT] [-s HOST] [-a AUTHOR] [-y YEAR] [-n NAME]
 5) Поиск всех книг заданного автора, которые содержат заданную строку (search-books)
 6) Поиск всех книг из указанного диапазона годов, которые НЕ содержат заданную строку (search-dates)
 7) Вычислить среднее арифметическое для года издания заданного автора
-8) Топ-10 самых популярных слов с количеством их упоминаний во всех книгах одного года (top-words)
+8) Топ-K (по умолчанию 10) самых популярных слов с количеством их упоминаний во всех книгах
+   одного года (top-words)
+9) Пересчет сводки частот слов по годам (rebuild-stats)
+10) Статистика годов издания с группировкой по автору или десятилетию (stats)
+11) Выполнение команд из файла или stdin по одной на строку с одним подключением (batch)
+12) Интерактивный режим с одним подключением (shell)
+13) Пакетный поиск по списку слов или пар (автор, слово) через _msearch (msearch)
+14) Построение локального индекса для работы без Elasticsearch (build-local)
+15) Частоты слов по книгам и годам в каталоге без Elasticsearch (word-stats)
+16) Возврат настроек индекса после прерванной массовой загрузки (restore-settings)
+17) Перестроение индекса в новой версии с переключением псевдонима (reindex)
+18) Синхронизация каталога с индексом по манифесту, со слежением за изменениями (sync)
+19) Выгрузка индекса в каталог сжатых файлов JSON Lines параллельным scroll (export)
+20) Загрузка выгрузки export в индекс через bulk API (import)
+
+Для любой команды --metrics выводит время фаз и статистику запросов к
+Elasticsearch (--metrics-json, --metrics-prom - в файл), --profile
+сохраняет профиль cProfile.
 """
 
+import io
 import os
+import mmap
+import codecs
+import contextlib
+import functools
+import json
 import sys
+import time
+import hashlib
+import threading
+import heapq
+import shlex
+import signal
+import select
+import struct
 import argparse
-from statistics import mean
-
-from prettytable import PrettyTable
-from elasticsearch6 import Elasticsearch
-
-
-INDEX_NAME = '2018-3-09-doc-lr2'
-
-
-def arg_parse():
+from collections import deque, Counter, OrderedDict
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import metrics
+
+
+INDEX_NAME = os.environ.get('LR2_INDEX', '2018-3-09-doc-lr2')
+READ_BLOCK = 1024 * 1024
+MANIFEST_NAME = '.lr2-manifest.json'
+# IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+INOTIFY_EVENTS = 0x8 | 0x40 | 0x80 | 0x200
+BULK_PROFILE = {
+    'index.refresh_interval': '-1',
+    'index.number_of_replicas': '0',
+    'index.translog.durability': 'async'
+}
+# Метка времени профиля загрузки обновляется раз в BULK_HEARTBEAT с; профиль,
+# метка которого старше BULK_STALE с, считается оставшимся после сбоя
+BULK_HEARTBEAT = 30
+BULK_STALE = 120
+BULK_TOKENS = set()
+STATS_INDEX = f'{INDEX_NAME}-stats'
+MAPPING_PROFILES = ('default', 'lean')
+BATCH_EXCLUDE_SIZE = 10000
+DUMP_MANIFEST = 'manifest.json'
+DUMP_SUFFIXES = {'gzip': '.ndjson.gz', 'zstd': '.ndjson.zst', 'none': '.ndjson'}
+DUMP_GZIP_LEVEL = 6
+DUMP_ZSTD_LEVEL = 3
+CACHE = {
+    'enabled': False,
+    'ttl': 300,
+    'dir': None,
+    'max_entries': 1024,
+    'memory': OrderedDict(),
+    'generation': 0,
+    'generation_mtime': None,
+    'puts': 0,
+    'hits': 0,
+    'misses': 0,
+    'lock': threading.Lock()
+}
+
+
+def arg_parse(argv=None):
     """Обработка аргументов командной строки
 
+    Аргументы:
+        argv: список аргументов (None - аргументы процесса)
+
     Возвращаемые значения:
         argument: введенные аргументы
     """
@@ -36,28 +107,178 @@ def arg_parse():
     argument.add_argument("command")
     argument.add_argument("second_command", nargs='?', default=None)
     argument.add_argument("-p", "--port", type=int, default=9200)
-    argument.add_argument("-s", "--host", type=str, default='localhost')
+    argument.add_argument("-s", "--host", type=str, default='localhost',
+                          help="хост или список хостов через запятую (host[:port],...)")
     argument.add_argument("-a", "--author")
     argument.add_argument("-y", "--year")
     argument.add_argument("-n", "--name")
     argument.add_argument("-f", "--from_date")
     argument.add_argument("-u", "--until_date")
+    argument.add_argument("--chunk-size", type=int, default=500,
+                          help="число документов в одном bulk-запросе")
+    argument.add_argument("--chunk-bytes", type=int, default=10 * 1024 * 1024,
+                          help="максимальный размер bulk-запроса в байтах")
+    argument.add_argument("--max-retries", type=int, default=5,
+                          help="число повторов при отказе 429")
+    argument.add_argument("--initial-backoff", type=float, default=2,
+                          help="начальная задержка перед повтором, с")
+    argument.add_argument("--threads", type=int, default=1,
+                          help="число параллельных bulk-запросов")
+    argument.add_argument("--workers", type=int, default=1,
+                          help="число процессов для чтения файлов")
+    argument.add_argument("--split-kb", type=int, default=None,
+                          help="разбивать книги на части по заданному числу КБ")
+    argument.add_argument("--bulk-profile", action='store_true',
+                          help="на время add-books отключить refresh и реплики")
+    argument.add_argument("--force-merge", type=int, default=None, metavar='SEGMENTS',
+                          help="после add-books объединить сегменты шарда до заданного числа")
+    argument.add_argument("--shards", type=int, default=None,
+                          help="число первичных шардов при создании индекса")
+    argument.add_argument("--replicas", type=int, default=None,
+                          help="число реплик при создании индекса")
+    argument.add_argument("--analysis", default=None,
+                          help="файл JSON с настройками анализа при создании индекса")
+    argument.add_argument("--mapping", choices=MAPPING_PROFILES, default=None,
+                          help="профиль маппинга для create и reindex (lean - без текста "
+                               "в _source, с best_compression)")
+    argument.add_argument("--slices", default='auto',
+                          help="число параллельных частей _reindex и scroll в export "
+                               "('auto' - по числу шардов)")
+    argument.add_argument("--scroll-size", type=int, default=100,
+                          help="число документов на странице scroll в export")
+    argument.add_argument("--compression", choices=sorted(DUMP_SUFFIXES), default='gzip',
+                          help="сжатие файлов export")
+    argument.add_argument("--part-mb", type=int, default=256,
+                          help="размер файла export до сжатия, МБ")
+    argument.add_argument("--keep-old", action='store_true',
+                          help="не удалять старый индекс после reindex")
+    argument.add_argument("--manifest", default=None,
+                          help="файл манифеста sync (по умолчанию .lr2-manifest.json в каталоге)")
+    argument.add_argument("--watch", action='store_true',
+                          help="после sync следить за каталогом и загружать изменения")
+    argument.add_argument("--interval", type=float, default=1.0,
+                          help="пауза sync --watch между проверками или после серии событий, с")
+    argument.add_argument("--top", type=int, default=10,
+                          help="число слов в выводе top-words")
+    argument.add_argument("--maxsize", type=int, default=10,
+                          help="число соединений в пуле на каждый узел")
+    argument.add_argument("--timeout", type=float, default=30,
+                          help="таймаут запроса, с")
+    argument.add_argument("--compress", action='store_true',
+                          help="сжимать тела запросов (gzip)")
+    argument.add_argument("--sniff", action='store_true',
+                          help="получать список узлов кластера")
+    argument.add_argument("--no-ping", action='store_true',
+                          help="не проверять подключение перед выполнением команды")
+    argument.add_argument("--concurrency", type=int, default=None,
+                          help="число одновременных запросов (top-words: 4, batch: 1)")
+    argument.add_argument("--query", default='count-books-with-words',
+                          choices=['count-books-with-words', 'search-books', 'search-dates'],
+                          help="тип запросов для msearch")
+    argument.add_argument("--batch-size", type=int, default=100,
+                          help="число запросов в одном _msearch")
+    argument.add_argument("--size", type=int, default=10,
+                          help="число книг в результате каждого запроса msearch")
+    argument.add_argument("--format", choices=['jsonl', 'csv'], default='jsonl',
+                          help="формат результатов msearch")
+    argument.add_argument("-o", "--output", default=None,
+                          help="файл результатов msearch (по умолчанию stdout)")
+    argument.add_argument("--cache", action='store_true',
+                          help="кэшировать результаты поиска")
+    argument.add_argument("--cache-ttl", type=float, default=300,
+                          help="время жизни записи кэша, с")
+    argument.add_argument("--cache-dir", default=os.path.expanduser('~/.cache/lr2'),
+                          help="каталог дискового кэша ('' - только в памяти)")
+    argument.add_argument("--backend", choices=['elasticsearch', 'local'],
+                          default='elasticsearch',
+                          help="где выполнять поиск: в Elasticsearch или в локальном индексе")
+    argument.add_argument("--local-index", default='LR_2/input/local.idx',
+                          help="файл локального индекса")
+    argument.add_argument("--group-by", choices=['author', 'decade'], default=None,
+                          help="группировка статистики годов издания")
+    argument.add_argument("--metrics", action='store_true',
+                          help="вывести в stderr время фаз и статистику запросов")
+    argument.add_argument("--metrics-json", default=None, metavar='FILE',
+                          help="записать метрики в JSON ('-' - stdout)")
+    argument.add_argument("--metrics-prom", default=None, metavar='FILE',
+                          help="записать метрики в файл .prom для node_exporter")
+    argument.add_argument("--profile", default=None, metavar='FILE',
+                          help="выполнить команду под cProfile и сохранить статистику")
+
+    return argument.parse_args(argv)
+
+
+def parse_hosts(host, port):
+    """Разбор списка хостов
+
+    Аргументы:
+        host: хост или список хостов через запятую, у каждого можно указать порт
+        port: порт по умолчанию
+
+    Возвращаемые значения:
+        hosts: список словарей {'host': ..., 'port': ...}
+
+    """
+    hosts = []
+    for item in host.split(','):
+        name, _, item_port = item.strip().partition(':')
+        hosts.append({'host': name, 'port': int(item_port) if item_port else port})
+    return hosts
+
 
-    return argument.parse_args()
+def load_elasticsearch():
+    """Импорт клиента elasticsearch6 перед первым подключением
 
+    Сериализатор elasticsearch6 при импорте загружает numpy, если он
+    установлен (около 50 мс), хотя типы numpy в запросы не передаются.
+    Если numpy еще не загружен, на время импорта клиента он скрывается.
+
+    Возвращаемые значения:
+        Elasticsearch: класс клиента
 
-def connect_elasticsearch(host, port):
+    """
+    if 'elasticsearch6' not in sys.modules and 'numpy' not in sys.modules:
+        sys.modules['numpy'] = None
+        try:
+            import elasticsearch6
+        finally:
+            del sys.modules['numpy']
+    from elasticsearch6 import Elasticsearch
+    return Elasticsearch
+
+
+def connect_elasticsearch(host, port, maxsize=10, timeout=30, compress=False, sniff=False,
+                          ping=True, measure=False):
     """Подключение к Elasticsearch
 
     Аргументы:
-        host: имя хоста для подключения
+        host: имя хоста или список хостов через запятую
         port: порт для подключения
+        maxsize: число соединений в пуле на каждый узел
+        timeout: таймаут запроса, с
+        compress: сжимать тела запросов (gzip)
+        sniff: получать список узлов кластера при старте и при ошибках соединения
+        ping: проверять подключение
+        measure: учитывать запросы в метриках (metrics.connection_class)
 
     Возвращаемые значения:
         elastic: объект подключения
 
     """
-    elastic = Elasticsearch([{'host': host, 'port': port}])
+    options = {'connection_class': metrics.connection_class()} if measure else {}
+    elastic = load_elasticsearch()(
+        parse_hosts(host, port),
+        maxsize=maxsize,
+        timeout=timeout,
+        http_compress=compress,
+        retry_on_timeout=True,
+        sniff_on_start=sniff,
+        sniff_on_connection_fail=sniff,
+        sniffer_timeout=60 if sniff else None,
+        **options
+    )
+    if not ping:
+        return elastic
     if elastic.ping():
         print('Connect')
     else:
@@ -65,44 +286,93 @@ def connect_elasticsearch(host, port):
     return elastic
 
 
-def create_index(es_object):
-    """Создание индекса
+def default_analysis():
+    """Настройки анализа индекса по умолчанию
+
+    Возвращаемые значения:
+        analysis: блок settings.analysis с анализатором custom_analyzer
+
+    """
+    from analysis import RUSSIAN_KEYWORDS
+    return {
+        "filter": {
+            "russian_stop": {
+                "type": "stop",
+                "stopwords": "_russian_"
+            },
+            "russian_keywords": {
+                "type": "stop",
+                "stopwords": RUSSIAN_KEYWORDS
+            }
+        },
+
+        "analyzer": {
+            "custom_analyzer": {
+                "type": "custom",
+                "tokenizer": "standard",
+                "filter": [
+                    "lowercase",
+                    "russian_stop",
+                    "russian_keywords"
+                ]
+            }
+        }
+    }
+
+
+def load_analysis(file):
+    """Чтение настроек анализа из файла JSON
+
+    Файл содержит блок analysis (или объект с ключом analysis), в нем
+    должен быть определен анализатор custom_analyzer, который использует
+    поле text.
 
     Аргументы:
-        es_object: объект подключения
+        file: путь к файлу
 
     Возвращаемые значения:
-        created: был ли создан новый индекс (True/False)
+        analysis: блок settings.analysis
 
     """
-    created = False
-    body_books = {
-        "settings": {
-            "analysis": {
-                "filter": {
-                    "russian_stop": {
-                        "type": "stop",
-                        "stopwords": "_russian_"
-                    },
-                    "russian_keywords": {
-                        "type": "stop",
-                        "stopwords": ["князь", "повезет", "сорок"]
-                    }
-                },
+    with open(file, 'r', encoding='utf-8') as read_file:
+        config = json.load(read_file)
+    analysis = config.get('analysis', config)
+    if 'custom_analyzer' not in analysis.get('analyzer', {}):
+        print(f"В файле {file} нет анализатора custom_analyzer")
+        sys.exit(1)
+    return analysis
 
-                "analyzer": {
-                    "custom_analyzer": {
-                        "type": "custom",
-                        "tokenizer": "standard",
-                        "filter": [
-                            "lowercase",
-                            "russian_stop",
-                            "russian_keywords"
-                        ]
-                    }
-                }
-            }
-        },
+
+def index_body(shards=None, replicas=None, analysis=None, profile='default'):
+    """Настройки и маппинг индекса книг
+
+    Профиль lean рассчитан на запросы этого скрипта: подполе author.keyword
+    (группировка stats по автору) ограничено 256 символами, отдельных
+    подполей для точного сравнения нет, так как автор и название ищутся
+    только по словам. У text индексируются только частоты без позиций и
+    норм (фразовых запросов нет, книги
+    перебираются агрегациями, а не по релевантности). Текст не хранится в
+    _source, вместо него сохраняются векторы терминов для top-words и сводки
+    частот, поля сжимаются best_compression. Перестроить такой индекс можно
+    только из файлов (reindex с каталогом).
+
+    Аргументы:
+        shards: число первичных шардов (None - по умолчанию)
+        replicas: число реплик (None - по умолчанию)
+        analysis: блок settings.analysis (None - default_analysis)
+        profile: профиль маппинга 'default' или 'lean'
+
+    Возвращаемые значения:
+        body: тело запроса создания индекса
+
+    """
+    settings = {"analysis": analysis or default_analysis()}
+    if shards is not None:
+        settings["number_of_shards"] = shards
+    if replicas is not None:
+        settings["number_of_replicas"] = replicas
+    body_books = {
+        "settings": settings,
         "mappings": {
             "document": {
                 "properties": {
@@ -114,7 +384,10 @@ def create_index(es_object):
                     "author": {
                         "type": "text",
                         "analyzer": "standard",
-                        "search_analyzer": "standard"
+                        "search_analyzer": "standard",
+                        "fields": {
+                            "keyword": {"type": "keyword"}
+                        }
                     },
                     "year_publication": {
                         "type": "date",
@@ -124,359 +397,3150 @@ def create_index(es_object):
                         "type": "text",
                         "analyzer": "custom_analyzer",
                         "search_analyzer": "custom_analyzer"
+                    },
+                    "book_id": {
+                        "type": "keyword"
+                    },
+                    "chunk": {
+                        "type": "integer"
                     }
                 }
             }
         }
     }
+    if profile == 'lean':
+        settings["codec"] = "best_compression"
+        mapping = body_books["mappings"]["document"]
+        mapping["_source"] = {"excludes": ["text"]}
+        properties = mapping["properties"]
+        properties["author"]["fields"]["keyword"]["ignore_above"] = 256
+        properties["text"].update(index_options="freqs", norms=False, term_vector="yes")
+    return body_books
+
+
+def index_profile(es_object, index=INDEX_NAME):
+    """Профиль маппинга индекса книг
+
+    Аргументы:
+        es_object: объект подключения
+        index: индекс или псевдоним
 
+    Возвращаемые значения:
+        profile: 'lean', если текст не хранится в _source, иначе 'default'
+
+    """
+    res = es_object.indices.get_mapping(index=index, doc_type='document', ignore=404)
+    for mappings in res.values():
+        if isinstance(mappings, dict) and 'mappings' in mappings:
+            source = mappings['mappings'].get('document', {}).get('_source', {})
+            if 'text' in source.get('excludes', []):
+                return 'lean'
+    return 'default'
+
+
+def index_version(name):
+    """Номер версии физического индекса вида '<INDEX_NAME>-v<номер>'
+
+    Аргументы:
+        name: имя индекса
+
+    Возвращаемые значения:
+        version: номер версии (0 для других имен)
+
+    """
+    suffix = name[len(f'{INDEX_NAME}-v'):]
+    if name.startswith(f'{INDEX_NAME}-v') and suffix.isdigit():
+        return int(suffix)
+    return 0
+
+
+def next_index(es_object):
+    """Имя физического индекса следующей версии
+
+    Аргументы:
+        es_object: объект подключения
+
+    Возвращаемые значения:
+        name: имя индекса '<INDEX_NAME>-v<номер>'
+
+    """
+    res = es_object.indices.get_alias(index=f'{INDEX_NAME}-v*', ignore=404)
+    version = max([index_version(name) for name in res] + [0]) + 1
+    return f'{INDEX_NAME}-v{version}'
+
+
+def alias_indices(es_object):
+    """Физические индексы, из которых сейчас читают запросы
+
+    Аргументы:
+        es_object: объект подключения
+
+    Возвращаемые значения:
+        indices: список имен (INDEX_NAME, если это индекс старого формата без псевдонима)
+
+    """
+    if es_object.indices.exists_alias(name=INDEX_NAME):
+        return sorted(es_object.indices.get_alias(name=INDEX_NAME))
+    if es_object.indices.exists(INDEX_NAME):
+        return [INDEX_NAME]
+    return []
+
+
+def create_index(es_object, shards=None, replicas=None, analysis=None, profile='default'):
+    """Создание индекса
+
+    Книги хранятся в физическом индексе '<INDEX_NAME>-v<номер>', запросы
+    и загрузка идут через псевдоним INDEX_NAME, который команда reindex
+    переключает на новую версию.
+
+    Аргументы:
+        es_object: объект подключения
+        shards: число первичных шардов (None - по умолчанию)
+        replicas: число реплик (None - по умолчанию)
+        analysis: блок settings.analysis (None - default_analysis)
+        profile: профиль маппинга 'default' или 'lean'
+
+    Возвращаемые значения:
+        created: был ли создан новый индекс (True/False)
+
+    """
+    created = False
+    body_books = index_body(shards, replicas, analysis, profile)
+    body_books["aliases"] = {INDEX_NAME: {}}
     try:
         if not es_object.indices.exists(INDEX_NAME):
-            es_object.indices.create(index=INDEX_NAME, ignore=400, body=body_books)
-            print(f"Индекс: '{INDEX_NAME}' успешно создан!")
+            name = next_index(es_object)
+            es_object.indices.create(index=name, ignore=400, body=body_books)
+            print(f"Индекс: '{name}' (псевдоним '{INDEX_NAME}', маппинг {profile}) "
+                  f"успешно создан!")
+            invalidate_cache()
             created = True
         else:
             print(f"Индекс: '{INDEX_NAME}' уже существует!")
     except TypeError as ex:
         print(str(ex))
 
+    create_stats_index(es_object)
     return created
 
 
-def exists(es_object, name, author, year):
-    """Проверка существования книги
+def create_stats_index(es_object):
+    """Создание индекса со сводкой частот слов по годам
+
+    Каждый документ сводки хранит число упоминаний одного слова во всех
+    книгах одного года.
 
     Аргументы:
         es_object: объект подключения
-        name: название книги
-        author: автор
-        year: год публикации
 
     Возвращаемые значения:
-        exist: существует ли данная книга в заданом индексе (True/False)
+        created: был ли создан новый индекс (True/False)
 
     """
-    exist = True
-    body = {
-        "query": {
-            "bool": {
-                "must": [
-                    {
-                        "match": {"title": f"{name}"}
-                    },
-                    {
-                        "match": {"author": f"{author}"}
-                    },
-                    {
-                        "match": {"year_publication": f"{year}"}
-                    }
-                ]
+    if es_object.indices.exists(STATS_INDEX):
+        return False
+    es_object.indices.create(index=STATS_INDEX, ignore=400, body={
+        "mappings": {
+            "document": {
+                "properties": {
+                    "year": {"type": "keyword"},
+                    "term": {"type": "keyword"},
+                    "count": {"type": "long"}
+                }
             }
         }
-    }
-    res = searcher(es_object, body)
-    if len(res['hits']['hits']) == 0:
-        exist = False
-    return exist
+    })
+    return True
 
 
-def add_book(file, es_object, name, author, year):
-    """Загрузка заданного файла
+def book_id(name, author, year):
+    """Детерминированный идентификатор книги
+
+    Идентификатор вычисляется как хеш от названия, автора и года, поэтому
+    повторная загрузка той же книги попадает в тот же документ.
 
     Аргументы:
-        file: название файла
-        es_object: объект подключения
         name: название книги
         author: автор
         year: год публикации
 
     Возвращаемые значения:
+        idi: идентификатор документа
 
     """
-    if not exists(es_object, name, author, year):
-        with open(f"LR_2/input/{file}", 'r', encoding='utf-8') as read_file:
-            es_object.INDEX_NAME(index=INDEX_NAME, doc_type='document', body={
-                'title': name,
-                'author': author,
-                'year_publication': year,
-                'text': read_file.read()
-            })
-        print('Успешно!')
-    else:
-        print('Данная книга уже существует!')
+    key = '\x00'.join(str(part).strip().lower() for part in (name, author, year))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
 
 
-def add_books(path, es_object):
-    """Загрузка всех файлов в каталоге
+def exists(es_object, name, author, year):
+    """Проверка существования книги
 
     Аргументы:
-        path: путь к каталогу
         es_object: объект подключения
+        name: название книги
+        author: автор
+        year: год публикации
 
     Возвращаемые значения:
+        exist: существует ли данная книга в заданом индексе (True/False)
 
     """
-    files = os.listdir(f'LR_2/input/{path}')
-    for file in files:
-        name_file = file
-        file = file.split('.')[0]
-        file_shard = file.split(' - ')
-        if len(file_shard) == 3:
-            name = file_shard[0]
-            author = file_shard[1]
-            year = file_shard[2]
-            if not exists(es_object, name, author, year):
-                with open(f"LR_2/input/{path}/{name_file}", 'r', encoding='utf-8') as read_file:
-                    es_object.INDEX_NAME(index=INDEX_NAME, doc_type='document', body={
-                        'title': name,
-                        'author': author,
-                        'year_publication': year,
-                        'text': read_file.read()
-                    })
-            else:
-                print(f"Эта книга уже существует: {name_file.split('.')[0]}")
-    print('Загрузка завершена!')
+    # Книга, загруженная с --split-kb, хранится частями '<id>-0', '<id>-1', ...
+    idi = book_id(name, author, year)
+    return bool(existing_ids(es_object, [idi, f"{idi}-0"]))
 
 
-def searcher(es_object, search):
-    """Поиск в индексе по определенному запросу
+def existing_ids(es_object, ids, index=INDEX_NAME):
+    """Проверка существования сразу нескольких книг одним запросом mget
 
     Аргументы:
         es_object: объект подключения
-        search: запрос
+        ids: список идентификаторов документов
+        index: индекс или псевдоним
 
     Возвращаемые значения:
-        res: результат поиска
+        found: множество идентификаторов, которые уже есть в индексе
+
     """
-    res = es_object.search(index=INDEX_NAME, body=search)
-    return res
+    if not ids:
+        return set()
+    res = es_object.mget(index=index, doc_type='document',
+                         body={'ids': list(ids)}, _source=False)
+    return {doc['_id'] for doc in res['docs'] if doc.get('found')}
 
 
-def count_books_with_words(es_object, word):
-    """Вывод всех книг с заданным словом
+@contextlib.contextmanager
+def mapped_file(file_path):
+    """Файл книги, отображенный в память только для чтения
 
     Аргументы:
-        es_object: объект подключения
-        word: слово
+        file_path: путь к файлу
 
     Возвращаемые значения:
+        mapped: объект mmap (пустая строка байт для пустого файла)
 
     """
-    body = {
-        "query": {
-            "bool": {
-                "must": [
-                    {
-                        "match": {"text": f"{word}"}
-                    }
-                ]
-            }
-        }
-    }
+    with open(file_path, 'rb') as read_file:
+        if os.fstat(read_file.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(read_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
 
-    res = searcher(es_object, body)
-    if len(res['hits']['hits']) == 0:
-        print("Not found for this word")
-        sys.exit(0)
-    print(f"Found: {len(res['hits']['hits'])}")
-    for record in res['hits']['hits']:
-        print(f"{record['_source']['title']}, {record['_source']['author']}, "
-              f"{record['_source']['year_publication']}")
 
+def release_pages(mapped, start, end):
+    """Освобождение прочитанных страниц отображения (файл остается в кэше ОС)
 
-def search_books(es_object, author, word):
-    """Вывод всех книг заданного автора, которые содержат заданную строку
+    Аргументы:
+        mapped: объект mmap
+        start: начало прочитанного диапазона
+        end: конец прочитанного диапазона
+
+    Возвращаемые значения:
+
+    """
+    if not hasattr(mapped, 'madvise') or not hasattr(mmap, 'MADV_DONTNEED'):
+        return
+    start -= start % mmap.PAGESIZE
+    end -= end % mmap.PAGESIZE
+    if end > start:
+        mapped.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+def check_utf8(mapped):
+    """Проверка кодировки файла блоками по READ_BLOCK байт
 
     Аргументы:
-        es_object: объект подключения
-        author: автор
-        word: строка
+        mapped: объект mmap
 
     Возвращаемые значения:
+        size: размер файла в байтах
+
+    Исключения:
+        UnicodeDecodeError: файл не в UTF-8
 
     """
-    body = {
-        "query": {
-            "bool": {
-                "must": [
-                    {
-                        "match": {"text": f"{word}"}
-                    },
-                    {
-                        "match": {"author": f"{author}"}
-                    }
-                ]
-            }
-        }
-    }
-    res = searcher(es_object, body)
-    if len(res['hits']['hits']) == 0:
-        print("Not found for this word and author")
-        sys.exit(0)
-    print(f"Found: {len(res['hits']['hits'])}")
-    for record in res['hits']['hits']:
-        print(f"{record['_source']['title']}, {record['_source']['author']},"
-              f" {record['_source']['year_publication']}")
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for start in range(0, len(mapped), READ_BLOCK):
+        end = min(start + READ_BLOCK, len(mapped))
+        decoder.decode(mapped[start:end])
+        release_pages(mapped, start, end)
+    decoder.decode(b'', final=True)
+    return len(mapped)
 
 
-def search_date(es_object, from_date, until_date, word):
-    """Вывод всех книг из указанного диапазона годов, которые НЕ содержат заданную строку
+def text_ranges(mapped, split_kb=None):
+    """Разбиение текста книги на части по границам строк
 
     Аргументы:
-        es_object: объект подключения
-        from_date: начальный год
-        until_date: конечный год
-        word: строка
+        mapped: объект mmap
+        split_kb: примерный размер части в КБ (None - не разбивать)
 
     Возвращаемые значения:
+        part: пара (начало, конец) очередной части в байтах
 
     """
-    body = {
-        "query": {
-            "bool": {
-                "must": [
-                    {
-                        "range": {
-                            "year_publication": {
-                                "gte": from_date,
-                                "lte": until_date
-                            }
-                        }
-                    }
+    if not split_kb:
+        yield 0, len(mapped)
+        return
+    limit = split_kb * 1024
+    start = 0
+    while start < len(mapped):
+        end = mapped.find(b'\n', start + limit - 1)
+        end = len(mapped) if end == -1 else end + 1
+        yield start, end
+        start = end
 
-                ],
-                "must_not": {
-                    "match": {"text": f"{word}"}
-                }
-            }
-        }
-    }
-    res = searcher(es_object, body)
-    if len(res['hits']['hits']) == 0:
-        print("Not found for this word and date range")
-        sys.exit(0)
-    print(f"Found: {len(res['hits']['hits'])}")
-    for record in res['hits']['hits']:
-        print(f"{record['_source']['title']}, {record['_source']['author']}, "
-              f"{record['_source']['year_publication']}")
 
+def write_text(out, mapped, start, end):
+    """Запись фрагмента файла как строки JSON без декодирования всего текста
 
-def calc_date(es_object, author):
-    """Вывод среднего арифметического для года издания заданного автора
+    Аргументы:
+        out: двоичный поток
+        mapped: объект mmap
+        start: начало фрагмента в байтах
+        end: конец фрагмента в байтах
+
+    Возвращаемые значения:
+
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    out.write(b'"')
+    for block in range(start, end, READ_BLOCK):
+        block_end = min(block + READ_BLOCK, end)
+        text = decoder.decode(mapped[block:block_end], final=block_end == end)
+        out.write(json.dumps(text, ensure_ascii=False)[1:-1].encode('utf-8'))
+        release_pages(mapped, block, block_end)
+    out.write(b'"')
+
+
+def write_document(out, meta, mapped, start, end):
+    """Запись тела документа в JSON: метаданные и текст из файла
 
     Аргументы:
-        es_object: объект подключения
-        author: автор
+        out: двоичный поток
+        meta: словарь полей документа без текста
+        mapped: объект mmap
+        start: начало текста в байтах
+        end: конец текста в байтах
 
     Возвращаемые значения:
 
     """
-    body = {
-        "query": {
-            "bool": {
-                "must": [
-                    {
-                        "match": {"author": f"{author}"}
-                    }
-                ]
-            }
-        }
-    }
-    res = searcher(es_object, body)
-    if len(res['hits']['hits']) == 0:
-        print("Not found for this author")
-        sys.exit(0)
-    years = []
-    for record in res['hits']['hits']:
-        years.append(int(record['_source']['year_publication']))
-    print(round(mean(years)))
+    out.write(json.dumps(meta, ensure_ascii=False)[:-1].encode('utf-8'))
+    out.write(b', "text": ')
+    write_text(out, mapped, start, end)
+    out.write(b'}')
 
 
-def search_by_year(es_object, year):
-    """Поиск книг по году
+def book_documents(idi, name, author, year, mapped, split_kb=None):
+    """Документы Elasticsearch для одной книги
+
+    Без split_kb книга хранится одним документом. С split_kb книга
+    разбивается на части с идентификаторами '<idi>-<номер>', каждая часть
+    хранит идентификатор книги в поле book_id и свой номер в поле chunk.
+    Текст не копируется: для каждого документа возвращается диапазон байт.
 
     Аргументы:
-        es_object: объект подключения
+        idi: идентификатор книги
+        name: название книги
+        author: автор
         year: год публикации
+        mapped: объект mmap с текстом книги
+        split_kb: размер части в КБ (None - не разбивать)
 
     Возвращаемые значения:
-        res: результат поиска
+        document: кортеж (идентификатор документа, поля без текста, начало, конец)
 
     """
-    body = {
-        "query": {
-            "bool": {
-                "must": [
-                    {
-                        "match": {"year_publication": year}
-                    }
-                ]
-            }
-        }
+    meta = {
+        'title': name,
+        'author': author,
+        'year_publication': year,
+        'book_id': idi
     }
-    res = searcher(es_object, body)
-    if len(res['hits']['hits']) == 0:
-        print("Not found for this year")
-        sys.exit(0)
-    ids = []
-    for record in res['hits']['hits']:
-        ids.append(record['_id'])
-    return ids
+    if not split_kb:
+        yield idi, meta, 0, len(mapped)
+        return
+    for number, (start, end) in enumerate(text_ranges(mapped, split_kb)):
+        yield f"{idi}-{number}", dict(meta, chunk=number), start, end
 
 
-def top_words(es_object, year):
-    """Вывод топ-10 самых популярных слов с количеством их упоминаний во всех книгах одного года
+def add_book(file, es_object, name, author, year, split_kb=None):
+    """Загрузка заданного файла
 
     Аргументы:
+        file: название файла
         es_object: объект подключения
+        name: название книги
+        author: автор
         year: год публикации
+        split_kb: размер части в КБ (None - не разбивать)
 
     Возвращаемые значения:
 
     """
-    terms = {}
-    body = {
-        "fields": ["text"]
-    }
+    from elasticsearch6.exceptions import ConflictError
+    # create отклоняет только совпадающие идентификаторы, а книга могла быть
+    # загружена в другом виде (целиком или частями)
+    with metrics.phase('existing'):
+        if exists(es_object, name, author, year):
+            print('Данная книга уже существует!')
+            return
+    created = []
+    try:
+        with mapped_file(f"LR_2/input/{file}") as mapped:
+            with metrics.phase('read'):
+                check_utf8(mapped)
+            for doc_id, meta, start, end in book_documents(book_id(name, author, year), name,
+                                                           author, year, mapped, split_kb):
+                body = io.BytesIO()
+                with metrics.phase('serialize'):
+                    write_document(body, meta, mapped, start, end)
+                with metrics.phase('index'):
+                    es_object.create(index=INDEX_NAME, doc_type='document', id=doc_id,
+                                     body=body.getvalue())
+                created.append(doc_id)
+    except ConflictError:
+        print('Данная книга уже существует!')
+        return
+    finally:
+        update_word_stats(es_object, {year: created})
+        invalidate_cache()
+    print('Успешно!')
 
-    ids = search_by_year(es_object, year)
 
-    for idi in ids:
-        res = es_object.termvectors(index=INDEX_NAME, doc_type="document", id=idi, body=body)
-        for term in res['term_vectors']['text']['terms'].keys():
-            if term in terms.keys():
-                terms[term] += res['term_vectors']['text']['terms'][term]['term_freq']
-            else:
-                terms[term] = res['term_vectors']['text']['terms'][term]['term_freq']
+def parse_file_name(file):
+    """Разбор имени файла вида 'название - автор - год.txt'
+
+    Аргументы:
+        file: имя файла
+
+    Возвращаемые значения:
+        book: кортеж (название, автор, год) или None, если имя не подходит
+
+    """
+    file_shard = os.path.splitext(file)[0].split(' - ')
+    if len(file_shard) != 3:
+        return None
+    return tuple(file_shard)
+
+
+def read_book(file_path):
+    """Чтение и декодирование файла книги
+
+    Аргументы:
+        file_path: путь к файлу
+
+    Возвращаемые значения:
+        text: текст книги (None при ошибке)
+        size: размер файла в байтах
+        error: описание ошибки (None при успехе)
+
+    """
+    try:
+        with open(file_path, 'rb') as read_file:
+            data = read_file.read()
+        return data.decode('utf-8'), len(data), None
+    except (OSError, UnicodeDecodeError) as ex:
+        return None, 0, str(ex)
+
+
+def serialize_book(file_path, idi, name, author, year, split_kb=None):
+    """Чтение книги и сериализация ее документов в JSON (для пула процессов)
+
+    Аргументы:
+        file_path: путь к файлу
+        idi: идентификатор книги
+        name: название книги
+        author: автор
+        year: год публикации
+        split_kb: размер части в КБ (None - не разбивать)
+
+    Возвращаемые значения:
+        documents: список пар (идентификатор документа, тело в JSON) (None при ошибке)
+        size: размер файла в байтах
+        error: описание ошибки (None при успехе)
+
+    """
+    try:
+        with mapped_file(file_path) as mapped:
+            size = check_utf8(mapped)
+            documents = []
+            for doc_id, meta, start, end in book_documents(idi, name, author, year, mapped,
+                                                           split_kb):
+                body = io.BytesIO()
+                write_document(body, meta, mapped, start, end)
+                documents.append((doc_id, body.getvalue()))
+        return documents, size, None
+    except (OSError, UnicodeDecodeError) as ex:
+        return None, 0, str(ex)
+
+
+def book_sources(books, workers=1, split_kb=None):
+    """Документы книг с функциями записи их тел в JSON
+
+    При workers <= 1 файл отображается в память и тело документа пишется
+    прямо из отображения в момент сборки bulk-запроса, поэтому текст книги
+    не копируется целиком ни в строку, ни в словарь. При workers > 1 тела
+    сериализуются в пуле процессов, одновременно в работе не больше
+    2 * workers файлов.
+
+    Аргументы:
+        books: список кортежей (путь, название, автор, год, идентификатор)
+        workers: число процессов
+        split_kb: размер части в КБ (None - не разбивать)
+
+    Возвращаемые значения:
+        book: кортеж (размер, ошибка, документы), документы - итератор кортежей
+              (идентификатор, примерный размер, функция записи тела в поток)
+
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    if workers <= 1:
+        for file_path, name, author, year, idi in books:
+            try:
+                with mapped_file(file_path) as mapped:
+                    with metrics.phase('read'):
+                        size = check_utf8(mapped)
+                    yield size, None, (
+                        (doc_id, end - start,
+                         functools.partial(write_document, meta=meta, mapped=mapped,
+                                           start=start, end=end))
+                        for doc_id, meta, start, end in book_documents(
+                            idi, name, author, year, mapped, split_kb))
+            except (OSError, UnicodeDecodeError) as ex:
+                yield 0, str(ex), ()
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for file_path, name, author, year, idi in books:
+            pending.append(executor.submit(serialize_book, file_path, name=name,
+                                           author=author, year=year, idi=idi,
+                                           split_kb=split_kb))
+            if len(pending) >= 2 * workers:
+                yield serialized_sources(*pending.popleft().result())
+        while pending:
+            yield serialized_sources(*pending.popleft().result())
+
+
+def serialized_sources(documents, size, error):
+    """Документы, сериализованные в пуле процессов, в формате book_sources
+
+    Аргументы:
+        documents: список пар (идентификатор документа, тело в JSON)
+        size: размер файла в байтах
+        error: описание ошибки
+
+    Возвращаемые значения:
+        book: кортеж (размер, ошибка, документы)
+
+    """
+    return size, error, ((doc_id, len(body), functools.partial(write_bytes, data=body))
+                         for doc_id, body in documents or ())
+
+
+def write_bytes(out, data):
+    """Запись готового тела документа в поток
+
+    Аргументы:
+        out: двоичный поток
+        data: тело документа в JSON
+
+    Возвращаемые значения:
+
+    """
+    out.write(data)
+
+
+def book_actions(path, es_object, report, workers=1, split_kb=None, index=INDEX_NAME):
+    """Генератор bulk-действий для всех файлов в каталоге
+
+    Существование книг проверяется одним запросом на весь каталог, уже
+    загруженные файлы не читаются. Тело документа в действии не хранится:
+    вместо него передается функция записи тела в bulk-запрос (bulk_chunks).
+
+    Аргументы:
+        path: путь к каталогу
+        es_object: объект подключения
+        report: словарь со счетчиками загрузки
+        workers: число процессов для чтения файлов
+        split_kb: размер части в КБ (None - не разбивать)
+        index: индекс или псевдоним для загрузки
+
+    Возвращаемые значения:
+        action: действие для bulk API (по одному на книгу или ее часть)
+
+    """
+    books = []
+    for name_file in sorted(os.listdir(f'LR_2/input/{path}')):
+        book = parse_file_name(name_file)
+        if book is None:
+            continue
+        books.append((name_file, book, book_id(*book)))
+    with metrics.phase('existing'):
+        found = existing_ids(es_object, [doc_id for _, _, idi in books
+                                         for doc_id in (idi, f"{idi}-0")], index)
+
+    new_books = []
+    for name_file, book, idi in books:
+        if idi in found or f"{idi}-0" in found:
+            print(f"Эта книга уже существует: {os.path.splitext(name_file)[0]}")
+            report['skipped'] += 1
+        else:
+            new_books.append((name_file, book, idi))
+
+    yield from file_actions(f'LR_2/input/{path}', new_books, report, workers, split_kb, index)
+
+
+def file_actions(directory, books, report, workers=1, split_kb=None, index=INDEX_NAME,
+                 op_type='create'):
+    """Генератор bulk-действий для заданных файлов каталога
+
+    Идентификаторы документов каждого файла записываются в report['files'].
+
+    Аргументы:
+        directory: путь к каталогу
+        books: список кортежей (имя файла, (название, автор, год), идентификатор книги)
+        report: словарь со счетчиками загрузки
+        workers: число процессов для чтения файлов
+        split_kb: размер части в КБ (None - не разбивать)
+        index: индекс или псевдоним для загрузки
+        op_type: тип действия bulk (create или index)
+
+    Возвращаемые значения:
+        action: действие для bulk API (по одному на книгу или ее часть)
+
+    """
+    sources = book_sources([(f"{directory}/{name_file}", *book, idi)
+                            for name_file, book, idi in books], workers, split_kb)
+    for (name_file, (_, _, year), _), (size, error, documents) in zip(books, sources):
+        if error is not None:
+            print(f"Ошибка чтения {name_file}: {error}")
+            report['failed'] += 1
+            continue
+        report['bytes'] += size
+        report['files'][name_file] = []
+        for doc_id, estimate, write in documents:
+            report['years'][doc_id] = year
+            report['files'][name_file].append(doc_id)
+            yield {
+                '_op_type': op_type,
+                '_index': index,
+                '_type': 'document',
+                '_id': doc_id,
+                'size': estimate,
+                'write': write
+            }
+
+
+def chunked(actions, chunk_size):
+    """Разбиение потока действий на списки заданной длины
+
+    Аргументы:
+        actions: итератор действий
+        chunk_size: число действий в одном списке
+
+    Возвращаемые значения:
+        chunk: очередной список действий
+
+    """
+    chunk = []
+    for action in actions:
+        chunk.append(action)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def bulk_chunks(actions, chunk_size, chunk_bytes):
+    """Сборка тел bulk-запросов из действий book_actions
+
+    Тело документа пишется функцией действия прямо в буфер запроса, поэтому
+    текст книги в памяти присутствует один раз - в теле запроса.
+
+    Аргументы:
+        actions: итератор действий
+        chunk_size: число документов в одном запросе
+        chunk_bytes: максимальный размер запроса в байтах
+
+    Возвращаемые значения:
+        chunk: пара (тело запроса, список (идентификатор, начало, конец) строк документов)
+
+    """
+    body, items = io.BytesIO(), []
+    for action in actions:
+        if items and (len(items) >= chunk_size
+                      or body.tell() + action['size'] > chunk_bytes):
+            yield body.getvalue(), items
+            body, items = io.BytesIO(), []
+        start = body.tell()
+        with metrics.phase('serialize'):
+            body.write(json.dumps({action['_op_type']: {
+                '_index': action['_index'],
+                '_type': action['_type'],
+                '_id': action['_id']
+            }}).encode('utf-8') + b'\n')
+            action['write'](body)
+            body.write(b'\n')
+        items.append((action['_id'], start, body.tell()))
+    if items:
+        yield body.getvalue(), items
+
+
+def send_bulk(es_object, body, items, max_retries, initial_backoff):
+    """Отправка тела bulk-запроса с повтором отказов 429
+
+    Повторно отправляются только отклоненные документы, задержка перед
+    повтором удваивается, как в streaming_bulk.
+
+    Аргументы:
+        es_object: объект подключения
+        body: тело запроса (bytes)
+        items: список (идентификатор, начало, конец) строк документов в теле
+        max_retries: число повторов при отказе 429
+        initial_backoff: начальная задержка перед повтором, с
+
+    Возвращаемые значения:
+        results: список пар (успех, ответ по документу)
+
+    """
+    from elasticsearch6.exceptions import TransportError
+    results = []
+    for attempt in range(max_retries + 1):
+        if attempt:
+            with metrics.phase('backoff'):
+                time.sleep(min(600, initial_backoff * 2 ** (attempt - 1)))
+        try:
+            with metrics.phase('bulk'):
+                response = es_object.bulk(body=body)
+        except TransportError as ex:
+            if ex.status_code == 429 and attempt < max_retries:
+                continue
+            return results + [(False, {'create': {'_id': doc_id, 'status': ex.status_code,
+                                                  'error': str(ex)}})
+                              for doc_id, _, _ in items]
+
+        retry = []
+        for item, result in zip(items, response['items']):
+            info = list(result.values())[0]
+            if info.get('status') == 429 and attempt < max_retries:
+                retry.append(item)
+            else:
+                results.append((200 <= info.get('status', 500) < 300, result))
+        if not retry:
+            return results
+
+        with memoryview(body) as view:
+            body = b''.join(view[start:end] for _, start, end in retry)
+        items, offset = [], 0
+        for doc_id, start, end in retry:
+            items.append((doc_id, offset, offset + end - start))
+            offset += end - start
+    return results
+
+
+def bulk_index(es_object, actions, report, chunk_size=500, chunk_bytes=10 * 1024 * 1024,
+               max_retries=5, initial_backoff=2, threads=1):
+    """Потоковая загрузка действий через bulk API
+
+    При threads > 1 одновременно отправляется не больше threads запросов,
+    следующий запрос собирается, пока отправляются предыдущие.
+
+    Аргументы:
+        es_object: объект подключения
+        actions: итератор действий
+        report: словарь со счетчиками загрузки
+        chunk_size: число документов в одном запросе
+        chunk_bytes: максимальный размер запроса в байтах
+        max_retries: число повторов при отказе 429
+        initial_backoff: начальная задержка перед повтором, с
+        threads: число параллельных запросов
+
+    Возвращаемые значения:
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    chunks = bulk_chunks(actions, chunk_size, chunk_bytes)
+    if threads <= 1:
+        for body, items in chunks:
+            count_results(send_bulk(es_object, body, items, max_retries, initial_backoff),
+                          report)
+        return
+
+    with ThreadPoolExecutor(threads) as executor:
+        pending = deque()
+        for body, items in chunks:
+            pending.append(executor.submit(send_bulk, es_object, body, items, max_retries,
+                                           initial_backoff))
+            if len(pending) >= threads:
+                count_results(pending.popleft().result(), report)
+        while pending:
+            count_results(pending.popleft().result(), report)
+
+
+def count_results(results, report):
+    """Подсчет успешных и неудачных документов по ответу bulk API
+
+    Аргументы:
+        results: список пар (успех, ответ по документу)
+        report: словарь со счетчиками загрузки
+
+    Возвращаемые значения:
+
+    """
+    for success, item in results:
+        info = list(item.values())[0]
+        if success:
+            report['indexed'] += 1
+            report['created'].append(info['_id'])
+        elif info.get('status') == 409:
+            report['skipped'] += 1
+            print(f"Эта книга уже существует: {info.get('_id')}")
+        else:
+            report['failed'] += 1
+            print(f"Ошибка загрузки ({info.get('status')}): {info.get('error')}")
+
+
+def peak_memory():
+    """Пиковый объем резидентной памяти процесса и его дочерних процессов
+
+    Возвращаемые значения:
+        peak: пиковый RSS в МБ (None, если недоступен на этой платформе)
+
+    """
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss в Linux в КБ, в macOS в байтах
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+
+def print_report(report, elapsed):
+    """Вывод итогов загрузки
+
+    Аргументы:
+        report: словарь со счетчиками загрузки
+        elapsed: время загрузки, с
+
+    Возвращаемые значения:
+
+    """
+    from prettytable import PrettyTable
+    elapsed = max(elapsed, 1e-9)
+    peak = peak_memory()
+    table = PrettyTable(['Загружено', 'Пропущено', 'Ошибок', 'Время, с', 'Док/с', 'МБ/с',
+                         'Пик памяти, МБ'])
+    table.add_row([
+        report['indexed'],
+        report['skipped'],
+        report['failed'],
+        round(elapsed, 2),
+        round(report['indexed'] / elapsed, 2),
+        round(report['bytes'] / 1024 / 1024 / elapsed, 2),
+        '-' if peak is None else peak
+    ])
+    print(table)
+
+
+def index_meta(es_object):
+    """Поле _meta маппинга индекса книг
+
+    Аргументы:
+        es_object: объект подключения
+
+    Возвращаемые значения:
+        meta: словарь _meta (пустой, если индекса нет)
+
+    """
+    res = es_object.indices.get_mapping(index=INDEX_NAME, doc_type='document', ignore=404)
+    for index in res.values():
+        if isinstance(index, dict) and 'mappings' in index:
+            return index['mappings'].get('document', {}).get('_meta', {})
+    return {}
+
+
+def bulk_owner():
+    """Владелец профиля загрузки: хост, пространство имен процессов и процесс
+
+    Контейнеры с --network host получают имя хоста и PID 1, поэтому pid
+    сравним только внутри одного пространства имен PID (ns) после той же
+    загрузки системы (boot).
+
+    Возвращаемые значения:
+        owner: словарь host, boot, ns, pid (boot и ns - None вне Linux)
+
+    """
+    import socket
+    owner = {'host': socket.gethostname(), 'boot': None, 'ns': None, 'pid': os.getpid()}
+    with contextlib.suppress(OSError):
+        with open('/proc/sys/kernel/random/boot_id', 'r', encoding='utf-8') as read_file:
+            owner['boot'] = read_file.read().strip()
+        owner['ns'] = os.readlink('/proc/self/ns/pid')
+    return owner
+
+
+def profile_stale(entry):
+    """Остался ли сохраненный профиль загрузки после сбоя
+
+    Профиль активен, пока его метка времени обновляется. Если владелец
+    работает в том же пространстве имен PID, его процесс дополнительно
+    проверяется через os.kill; чужая метка (не из BULK_TOKENS) с тем же
+    pid не считается устаревшей, устаревание определяет метка времени.
+
+    Аргументы:
+        entry: значение _meta.bulk_profile
+
+    Возвращаемые значения:
+        stale: True, если загрузка-владелец уже не выполняется
+
+    """
+    if 'settings' not in entry:
+        # Формат без владельца: записан до проверки владельца
+        return True
+    if entry.get('token') in BULK_TOKENS:
+        return False
+    if time.time() - entry.get('heartbeat', 0) > BULK_STALE:
+        return True
+    owner, current = entry.get('owner', {}), bulk_owner()
+    if (current['ns'] is None
+            or any(owner.get(key) != current[key] for key in ('host', 'boot', 'ns'))):
+        return False
+    try:
+        os.kill(owner.get('pid'), 0)
+    except ProcessLookupError:
+        return True
+    except (PermissionError, TypeError):
+        pass
+    return False
+
+
+def restore_index_settings(es_object, token=None):
+    """Возврат настроек индекса, сохраненных перед включением профиля загрузки
+
+    Сохраненные настройки хранятся в _meta маппинга, поэтому их можно
+    вернуть и после аварийного завершения загрузки. Настройки загрузки,
+    которая еще выполняется, не возвращаются.
+
+    Аргументы:
+        es_object: объект подключения
+        token: метка профиля, включенного этим вызовом bulk_profile (его
+            настройки возвращаются без проверки владельца)
+
+    Возвращаемые значения:
+        restored: были ли возвращены настройки (True/False, None - идет загрузка)
+
+    """
+    entry = index_meta(es_object).get('bulk_profile')
+    if not entry:
+        return False
+    if (token is None or entry.get('token') != token) and not profile_stale(entry):
+        owner = entry.get('owner', {})
+        print(f"Идет массовая загрузка ({owner.get('host')}, pid {owner.get('pid')}): "
+              f"настройки индекса не изменены")
+        return None
+    saved = entry.get('settings', entry)
+    es_object.indices.put_settings(index=INDEX_NAME, body=saved)
+    es_object.indices.put_mapping(index=INDEX_NAME, doc_type='document',
+                                  body={'_meta': {'bulk_profile': None}})
+    es_object.indices.refresh(index=INDEX_NAME)
+    print("Настройки индекса после загрузки восстановлены")
+    return True
+
+
+def force_merge(es_object, segments=1):
+    """Слияние сегментов индекса после загрузки
+
+    Аргументы:
+        es_object: объект подключения
+        segments: максимальное число сегментов в шарде
+
+    Возвращаемые значения:
+
+    """
+    start = time.perf_counter()
+    es_object.indices.forcemerge(index=INDEX_NAME, max_num_segments=segments,
+                                 request_timeout=3600)
+    print(f"Сегменты объединены до {segments} за {round(time.perf_counter() - start, 2)} с")
+
+
+@contextlib.contextmanager
+def bulk_profile(es_object, enabled=True):
+    """Профиль индекса на время массовой загрузки
+
+    Отключает обновление (refresh_interval -1) и реплики, переводит
+    журнал транзакций в асинхронный режим. Исходные значения сохраняются в
+    _meta маппинга до изменения настроек и возвращаются при выходе, в том
+    числе по исключению, Ctrl+C или SIGTERM (docker stop). Если процесс был
+    убит без возможности выполнить выход, настройки возвращаются при
+    следующем create, add-book, add-books или restore-settings.
+
+    Вместе с настройками сохраняются владелец (хост, pid) и метка времени,
+    которую фоновый поток обновляет раз в BULK_HEARTBEAT с: другие
+    процессы возвращают настройки, только если метка устарела или
+    процесс-владелец на том же хосте завершен. Если профиль уже включен
+    другой загрузкой, настройки не меняются.
+
+    Аргументы:
+        es_object: объект подключения
+        enabled: включать ли профиль
+
+    Возвращаемые значения:
+
+    """
+    if not enabled:
+        yield
+        return
+    if restore_index_settings(es_object) is None:
+        print("Загрузка выполняется без изменения настроек")
+        yield
+        return
+    res = es_object.indices.get_settings(index=INDEX_NAME, flat_settings=True)
+    current = next(iter(res.values()))['settings']
+    entry = {
+        'settings': {name: current.get(name) for name in BULK_PROFILE},
+        'owner': bulk_owner(),
+        'token': os.urandom(8).hex(),
+        'heartbeat': time.time()
+    }
+    BULK_TOKENS.add(entry['token'])
+    es_object.indices.put_mapping(index=INDEX_NAME, doc_type='document',
+                                  body={'_meta': {'bulk_profile': entry}})
+
+    handler = None
+    if threading.current_thread() is threading.main_thread():
+        handler = signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=bulk_heartbeat, args=(es_object, entry, stop),
+                                 daemon=True)
+    heartbeat.start()
+    try:
+        es_object.indices.put_settings(index=INDEX_NAME, body=BULK_PROFILE)
+        print("Включен профиль массовой загрузки")
+        yield
+    finally:
+        stop.set()
+        heartbeat.join()
+        if handler is not None:
+            signal.signal(signal.SIGTERM, handler)
+        restore_index_settings(es_object, entry['token'])
+        BULK_TOKENS.discard(entry['token'])
+
+
+def bulk_heartbeat(es_object, entry, stop):
+    """Обновление метки времени профиля загрузки до остановки
+
+    Аргументы:
+        es_object: объект подключения
+        entry: значение _meta.bulk_profile
+        stop: threading.Event остановки
+
+    Возвращаемые значения:
+
+    """
+    from elasticsearch6.exceptions import TransportError
+    while not stop.wait(BULK_HEARTBEAT):
+        entry['heartbeat'] = time.time()
+        try:
+            es_object.indices.put_mapping(index=INDEX_NAME, doc_type='document',
+                                          body={'_meta': {'bulk_profile': entry}})
+        except TransportError as ex:
+            print(f"Не удалось обновить метку профиля загрузки: {ex}", file=sys.stderr)
+
+
+def new_report():
+    """Пустой словарь со счетчиками загрузки
+
+    Возвращаемые значения:
+        report: словарь со счетчиками загрузки
+
+    """
+    return {'indexed': 0, 'skipped': 0, 'failed': 0, 'bytes': 0, 'years': {}, 'created': [],
+            'files': {}}
+
+
+def add_books(path, es_object, chunk_size=500, chunk_bytes=10 * 1024 * 1024,
+              max_retries=5, initial_backoff=2, threads=1, workers=1, split_kb=None,
+              bulk_load=False, merge_segments=None):
+    """Загрузка всех файлов в каталоге через bulk API
+
+    Аргументы:
+        path: путь к каталогу
+        es_object: объект подключения
+        chunk_size: число документов в одном запросе
+        chunk_bytes: максимальный размер запроса в байтах
+        max_retries: число повторов при отказе 429
+        initial_backoff: начальная задержка перед повтором, с
+        threads: число параллельных запросов
+        workers: число процессов для чтения файлов
+        split_kb: размер части в КБ (None - не разбивать)
+        bulk_load: включить профиль массовой загрузки на время загрузки
+        merge_segments: объединить сегменты до заданного числа (None - не объединять)
+
+    Возвращаемые значения:
+        report: словарь со счетчиками загрузки
+
+    """
+    report = new_report()
+    start = time.perf_counter()
+    if not bulk_load:
+        restore_index_settings(es_object)
+    try:
+        with bulk_profile(es_object, bulk_load):
+            bulk_index(es_object, book_actions(path, es_object, report, workers, split_kb),
+                       report, chunk_size, chunk_bytes, max_retries, initial_backoff, threads)
+            # Без реплик слияние выполняется один раз, реплики получат готовые сегменты
+            if merge_segments:
+                with metrics.phase('force-merge'):
+                    force_merge(es_object, merge_segments)
+    finally:
+        # Уже записанные документы попадают в сводку и при прерванной загрузке
+        update_word_stats(es_object, by_year({doc_id: report['years'][doc_id]
+                                              for doc_id in report['created']}))
+        invalidate_cache()
+    print('Загрузка завершена!')
+    print_report(report, time.perf_counter() - start)
+    return report
+
+
+def wait_task(es_object, task_id, interval=2):
+    """Ожидание завершения фоновой задачи Elasticsearch с выводом прогресса
+
+    Аргументы:
+        es_object: объект подключения
+        task_id: идентификатор задачи
+        interval: период опроса, с
+
+    Возвращаемые значения:
+        response: результат задачи
+
+    """
+    while True:
+        res = es_object.tasks.get(task_id=task_id)
+        status = res['task']['status']
+        print(f"Перенесено документов: {status['created']} из {status['total']}")
+        if res.get('completed'):
+            if 'error' in res:
+                print(f"Ошибка задачи {task_id}: {res['error']}")
+                return None
+            return res['response']
+        time.sleep(interval)
+
+
+def reindex(es_object, path=None, slices='auto', shards=None, replicas=None, analysis=None,
+            keep_old=False, workers=1, split_kb=None, profile=None, **load_options):
+    """Перестроение индекса в новой версии с переключением псевдонима
+
+    Новый физический индекс создается с текущими настройками анализа и
+    заполняется параллельным _reindex по slices частям (или заново из
+    файлов каталога path), пока запросы читают старый индекс через
+    псевдоним. После проверки числа документов псевдоним переключается на
+    новый индекс одним атомарным запросом.
+
+    Аргументы:
+        es_object: объект подключения
+        path: каталог с файлами книг (None - копировать из текущего индекса)
+        slices: число частей _reindex ('auto' - по числу шардов)
+        shards: число первичных шардов (None - как в текущем индексе)
+        replicas: число реплик (None - как в текущем индексе)
+        analysis: блок settings.analysis (None - как в текущем индексе)
+        keep_old: не удалять старый индекс после переключения
+        workers: число процессов для чтения файлов
+        split_kb: размер части в КБ (None - не разбивать)
+        profile: профиль маппинга (None - как в текущем индексе)
+        load_options: параметры bulk_index для загрузки из файлов
+
+    Возвращаемые значения:
+        target: имя нового индекса (None при ошибке)
+
+    """
+    old = alias_indices(es_object)
+    if not old:
+        print(f"Индекс '{INDEX_NAME}' не создан")
+        sys.exit(1)
+    if path is None and index_profile(es_object) == 'lean':
+        print(f"Текст книг не хранится в _source индекса '{INDEX_NAME}': "
+              f"перестроение возможно только из файлов (reindex <каталог>)")
+        sys.exit(1)
+    restore_index_settings(es_object)
+    current = next(iter(es_object.indices.get_settings(index=old[0])
+                        .values()))['settings']['index']
+    shards = shards if shards is not None else int(current['number_of_shards'])
+    replicas = replicas if replicas is not None else int(current['number_of_replicas'])
+
+    profile = profile or index_profile(es_object)
+    analysis = analysis or live_analysis(current.get('analysis'))
+
+    target = next_index(es_object)
+    body = index_body(shards, 0, analysis, profile)
+    body['settings']['refresh_interval'] = '-1'
+    es_object.indices.create(index=target, body=body)
+    print(f"Создан индекс '{target}' (маппинг {profile}), источник: {path or ', '.join(old)}")
+
+    start = time.perf_counter()
+    task = None
+    try:
+        if path is None:
+            task = es_object.reindex(body={
+                'source': {'index': INDEX_NAME, 'size': 1000},
+                'dest': {'index': target, 'op_type': 'create'}
+            }, slices=slices, wait_for_completion=False)['task']
+            response = wait_task(es_object, task)
+            failed = response is None or bool(response.get('failures'))
+        else:
+            report = new_report()
+            bulk_index(es_object, book_actions(path, es_object, report, workers, split_kb,
+                                               target), report, **load_options)
+            print_report(report, time.perf_counter() - start)
+            failed = report['failed'] > 0
+
+        es_object.indices.put_settings(index=target, body={
+            'index.refresh_interval': None,
+            'index.number_of_replicas': replicas
+        })
+        es_object.indices.refresh(index=target)
+        expected = es_object.count(index=INDEX_NAME)['count']
+        count = es_object.count(index=target)['count']
+    except BaseException:
+        # Недозаполненный индекс без реплик и обновления не должен оставаться
+        print(f"Перестроение прервано, псевдоним не переключен, индекс '{target}' удален")
+        with contextlib.suppress(Exception):
+            if task is not None:
+                es_object.tasks.cancel(task_id=task)
+            es_object.indices.delete(index=target, ignore=404)
+        raise
+    if failed or count != expected:
+        print(f"Проверка не пройдена: в '{INDEX_NAME}' {expected} документов, "
+              f"в '{target}' {count}, ошибок: {'есть' if failed else 'нет'}. "
+              f"Псевдоним не переключен, индекс '{target}' удален")
+        es_object.indices.delete(index=target)
+        sys.exit(1)
+
+    actions = [{'add': {'index': target, 'alias': INDEX_NAME}}]
+    if old == [INDEX_NAME]:
+        actions.append({'remove_index': {'index': INDEX_NAME}})
+    else:
+        actions += [{'remove': {'index': name, 'alias': INDEX_NAME}} for name in old]
+    es_object.indices.update_aliases(body={'actions': actions})
+    print(f"Псевдоним '{INDEX_NAME}' переключен на '{target}': {count} документов "
+          f"за {round(time.perf_counter() - start, 2)} с")
+
+    old = [name for name in old if name != INDEX_NAME]
+    if old and not keep_old:
+        es_object.indices.delete(index=','.join(old))
+        print(f"Удален старый индекс: {', '.join(old)}")
+    # Сводка частот слов зависит от анализатора нового индекса
+    rebuild_stats(es_object)
+    return target
+
+
+def live_analysis(current):
+    """Настройки анализа для новой версии индекса без --analysis
+
+    Индекс, созданный с настройками по умолчанию (тот же набор фильтров и
+    анализаторов), получает текущие default_analysis, например с
+    измененным RUSSIAN_KEYWORDS. Настройки из файла --analysis
+    переносятся из текущего индекса без изменений.
+
+    Аргументы:
+        current: блок settings.index.analysis текущего индекса (None - нет)
+
+    Возвращаемые значения:
+        analysis: блок settings.analysis
+
+    """
+    default = default_analysis()
+    if not current or all(set(current.get(key, {})) == set(default[key])
+                          for key in ('filter', 'analyzer')):
+        return default
+    return current
+
+
+def file_hash(file_path):
+    """SHA-1 содержимого файла
+
+    Аргументы:
+        file_path: путь к файлу
+
+    Возвращаемые значения:
+        digest: шестнадцатеричная строка хеша
+
+    """
+    digest = hashlib.sha1()
+    with mapped_file(file_path) as mapped:
+        for start in range(0, len(mapped), READ_BLOCK):
+            end = min(start + READ_BLOCK, len(mapped))
+            digest.update(mapped[start:end])
+            release_pages(mapped, start, end)
+    return digest.hexdigest()
+
+
+def load_manifest(manifest_file):
+    """Чтение манифеста синхронизации
+
+    Аргументы:
+        manifest_file: путь к файлу манифеста
+
+    Возвращаемые значения:
+        manifest: словарь имя файла -> {size, mtime, hash, id, ids}
+
+    """
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as read_file:
+            return json.load(read_file)['files']
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest_file, manifest):
+    """Атомарная запись манифеста синхронизации
+
+    Аргументы:
+        manifest_file: путь к файлу манифеста
+        manifest: словарь имя файла -> {size, mtime, hash, id, ids}
+
+    Возвращаемые значения:
+
+    """
+    with open(f"{manifest_file}.tmp", 'w', encoding='utf-8') as write_file:
+        json.dump({'index': INDEX_NAME, 'files': manifest}, write_file, ensure_ascii=False,
+                  indent=1, sort_keys=True)
+    os.replace(f"{manifest_file}.tmp", manifest_file)
+
+
+def scan_directory(directory):
+    """Размер и время изменения файлов книг в каталоге (без чтения файлов)
+
+    Аргументы:
+        directory: путь к каталогу
+
+    Возвращаемые значения:
+        files: словарь имя файла -> (размер, время изменения в нс)
+
+    """
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and parse_file_name(entry.name) is not None:
+                stat = entry.stat()
+                files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def book_document_ids(es_object, book_ids):
+    """Все документы (и части) заданных книг в индексе
+
+    Аргументы:
+        es_object: объект подключения
+        book_ids: идентификаторы книг
+
+    Возвращаемые значения:
+        documents: словарь идентификатор документа -> год публикации
+
+    """
+    from elasticsearch6.helpers import scan
+    if not book_ids:
+        return {}
+    body = {"query": {"bool": {"should": [
+        {"terms": {"book_id": list(book_ids)}},
+        {"ids": {"values": list(book_ids)}}
+    ]}}}
+    return {record['_id']: record['_source']['year_publication']
+            for record in scan(es_object, query=body, index=INDEX_NAME,
+                               _source=['year_publication'])}
+
+
+def by_year(documents):
+    """Группировка идентификаторов документов по годам
+
+    Аргументы:
+        documents: словарь идентификатор документа -> год
+
+    Возвращаемые значения:
+        ids_by_year: словарь год -> список идентификаторов
+
+    """
+    ids_by_year = {}
+    for doc_id, year in documents.items():
+        ids_by_year.setdefault(year, []).append(doc_id)
+    return ids_by_year
+
+
+def delete_documents(es_object, ids, chunk_size=1000):
+    """Удаление документов через bulk API
+
+    Аргументы:
+        es_object: объект подключения
+        ids: идентификаторы документов
+        chunk_size: число документов в одном запросе
+
+    Возвращаемые значения:
+        deleted: список идентификаторов удаленных документов
+
+    """
+    from elasticsearch6.helpers import streaming_bulk
+    deleted = []
+    actions = ({'_op_type': 'delete', '_index': INDEX_NAME, '_type': 'document', '_id': doc_id}
+               for doc_id in ids)
+    for success, item in streaming_bulk(es_object, actions, chunk_size=chunk_size,
+                                        raise_on_error=False):
+        info = list(item.values())[0]
+        if success:
+            deleted.append(info['_id'])
+        elif info.get('status') != 404:
+            print(f"Ошибка удаления ({info.get('status')}): {info.get('error')}")
+    return deleted
+
+
+def sync_directory(directory, es_object, manifest_file, workers=1, split_kb=None,
+                   **load_options):
+    """Один проход синхронизации каталога с индексом
+
+    Неизмененные файлы определяются по размеру и времени изменения из
+    манифеста без чтения файлов и без запросов к Elasticsearch. Новые и
+    измененные (по хешу содержимого) файлы загружаются с заменой
+    документов, документы исчезнувших файлов и лишние части удаляются,
+    сводка частот слов обновляется на разницу.
+
+    Аргументы:
+        directory: путь к каталогу
+        es_object: объект подключения
+        manifest_file: путь к файлу манифеста
+        workers: число процессов для чтения файлов
+        split_kb: размер части в КБ (None - не разбивать)
+        load_options: параметры bulk_index
+
+    Возвращаемые значения:
+        report: словарь со счетчиками загрузки (None, если изменений нет)
+
+    """
+    from prettytable import PrettyTable
+    start = time.perf_counter()
+    manifest = load_manifest(manifest_file)
+    current = scan_directory(directory)
+
+    changed, touched = [], False
+    for name_file, (size, mtime) in sorted(current.items()):
+        entry = manifest.get(name_file)
+        if entry and (entry['size'], entry['mtime']) == (size, mtime):
+            continue
+        digest = file_hash(os.path.join(directory, name_file))
+        if entry and entry['hash'] == digest:
+            entry.update(size=size, mtime=mtime)
+            touched = True
+            continue
+        changed.append((name_file, size, mtime, digest))
+    vanished = [name_file for name_file in manifest if name_file not in current]
+
+    if not changed and not vanished:
+        if touched:
+            save_manifest(manifest_file, manifest)
+        print("Изменений нет")
+        return None
+
+    books = [(name_file, parse_file_name(name_file), book_id(*parse_file_name(name_file)))
+             for name_file, _, _, _ in changed]
+    old = book_document_ids(es_object, {idi for _, _, idi in books}
+                            | {manifest[name_file]['id'] for name_file in vanished})
+    # Векторы терминов старых документов читаются до замены, а вычитаются после
+    old_terms = term_frequencies(es_object, list(old), by_document=True)
+
+    report = new_report()
+    bulk_index(es_object, file_actions(directory, books, report, workers, split_kb,
+                                       op_type='index'), report, **load_options)
+    written = {doc_id for ids in report['files'].values() for doc_id in ids}
+    deleted = delete_documents(es_object, [doc_id for doc_id in old if doc_id not in written])
+    # Вычитаются только замененные и удаленные документы: старый документ, замена
+    # которого не удалась, остается в индексе вместе со своими частотами
+    removed_terms = {}
+    for doc_id in [doc_id for doc_id in report['created'] if doc_id in old] + deleted:
+        removed_terms.setdefault(old[doc_id], Counter()).update(old_terms.get(doc_id, {}))
+    apply_word_stats(es_object, removed_terms, sign=-1)
+    update_word_stats(es_object, by_year({doc_id: report['years'][doc_id]
+                                          for doc_id in report['created']}))
+    invalidate_cache()
+
+    created = set(report['created'])
+    for (name_file, size, mtime, digest), (_, _, idi) in zip(changed, books):
+        ids = report['files'].get(name_file)
+        if ids is not None and created.issuperset(ids):
+            manifest[name_file] = {'size': size, 'mtime': mtime, 'hash': digest,
+                                   'id': idi, 'ids': ids}
+        else:
+            # Файл будет обработан заново при следующем проходе
+            manifest.pop(name_file, None)
+    for name_file in vanished:
+        del manifest[name_file]
+    save_manifest(manifest_file, manifest)
+
+    table = PrettyTable(['Новых и измененных файлов', 'Удалено файлов', 'Загружено документов',
+                         'Удалено документов', 'Ошибок', 'Время, с'])
+    table.add_row([len(changed), len(vanished), report['indexed'], len(deleted),
+                   report['failed'],
+                   round(time.perf_counter() - start, 2)])
+    print(table)
+    return report
+
+
+def inotify_watch(directory):
+    """Подписка на изменения каталога через inotify (Linux)
+
+    Аргументы:
+        directory: путь к каталогу
+
+    Возвращаемые значения:
+        fd: дескриптор inotify (None, если inotify недоступен)
+
+    """
+    import ctypes
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), INOTIFY_EVENTS) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def inotify_names(data):
+    """Имена файлов из прочитанных событий inotify
+
+    Аргументы:
+        data: байты, прочитанные из дескриптора inotify
+
+    Возвращаемые значения:
+        names: множество имен файлов
+
+    """
+    names, offset = set(), 0
+    while offset + 16 <= len(data):
+        length = struct.unpack_from('iIII', data, offset)[3]
+        names.add(os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0')))
+        offset += 16 + length
+    return names
+
+
+def directory_changes(directory, interval=1.0):
+    """Генератор изменений файлов книг в каталоге
+
+    В Linux ждет событий inotify и выдает одно значение на серию событий,
+    разделенных паузой не больше interval. Без inotify каталог
+    проверяется раз в interval секунд (проход синхронизации без изменений
+    читает только метаданные файлов).
+
+    Аргументы:
+        directory: путь к каталогу
+        interval: пауза, после которой серия событий считается законченной, с
+
+    Возвращаемые значения:
+        change: None для каждого изменения
+
+    """
+    fd = inotify_watch(directory)
+    if fd is None:
+        print(f"inotify недоступен, каталог проверяется раз в {interval} с")
+        while True:
+            time.sleep(interval)
+            yield None
+    try:
+        while True:
+            select.select([fd], [], [])
+            names = inotify_names(os.read(fd, 65536))
+            while select.select([fd], [], [], interval)[0]:
+                names |= inotify_names(os.read(fd, 65536))
+            # Запись манифеста (скрытый файл) не должна запускать новый проход
+            if any(parse_file_name(name) is not None for name in names):
+                yield None
+    finally:
+        os.close(fd)
+
+
+def sync(path, es_object, manifest_file=None, watch=False, interval=1.0, **options):
+    """Синхронизация каталога с индексом и, при watch, слежение за ним
+
+    Аргументы:
+        path: путь к каталогу
+        es_object: объект подключения
+        manifest_file: путь к файлу манифеста (None - '.lr2-manifest.json' в каталоге)
+        watch: продолжать загружать изменения до Ctrl+C
+        interval: пауза между проверками или после серии событий, с
+        options: параметры sync_directory
+
+    Возвращаемые значения:
+
+    """
+    directory = f'LR_2/input/{path}'
+    manifest_file = manifest_file or os.path.join(directory, MANIFEST_NAME)
+    sync_directory(directory, es_object, manifest_file, **options)
+    if not watch:
+        return
+    print(f"Слежение за каталогом {directory} (Ctrl+C - выход)")
+    try:
+        for _ in directory_changes(directory, interval):
+            sync_directory(directory, es_object, manifest_file, **options)
+    except KeyboardInterrupt:
+        print("Слежение остановлено")
+
+
+def zstd_module():
+    """Модуль zstandard для сжатия zstd
+
+    Возвращаемые значения:
+        zstandard: модуль (без установленного пакета - выход с кодом 1)
+
+    """
+    try:
+        import zstandard
+    except ImportError:
+        print("Для сжатия zstd нужен пакет zstandard (pip3 install zstandard)")
+        sys.exit(1)
+    return zstandard
+
+
+def open_dump(path, compression, mode='rb'):
+    """Открытие файла части дампа
+
+    Аргументы:
+        path: путь к файлу
+        compression: 'gzip', 'zstd' или 'none'
+        mode: 'rb' или 'wb'
+
+    Возвращаемые значения:
+        stream: двоичный поток (при чтении итерируется по строкам)
+
+    """
+    if compression == 'gzip':
+        import gzip
+        return gzip.open(path, mode, compresslevel=DUMP_GZIP_LEVEL)
+    if compression == 'zstd':
+        zstandard = zstd_module()
+        if mode == 'wb':
+            return zstandard.ZstdCompressor(level=DUMP_ZSTD_LEVEL).stream_writer(
+                open(path, 'wb'), closefd=True)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'), closefd=True), READ_BLOCK)
+    return open(path, mode)
+
+
+def export_slice(es_object, directory, slice_id, slices, scroll_size, compression,
+                 part_bytes):
+    """Выгрузка одной части sliced scroll в файлы дампа
+
+    Документы пишутся парами строк, как в bulk API: действие с годом
+    издания ({"index": {"_id": ...}, "year": ...}), чтобы import не разбирал
+    _source, и _source. Новый файл начинается, когда в текущий записано
+    part_bytes байт до сжатия; в памяти одновременно только одна страница
+    scroll.
+
+    Аргументы:
+        es_object: объект подключения
+        directory: каталог дампа
+        slice_id: номер части
+        slices: число частей
+        scroll_size: число документов на странице scroll
+        compression: 'gzip', 'zstd' или 'none'
+        part_bytes: размер файла до сжатия, байт
+
+    Возвращаемые значения:
+        parts: список словарей file, documents, bytes
+
+    """
+    from elasticsearch6.helpers import scan
+    query = {"slice": {"id": slice_id, "max": slices}} if slices > 1 else {}
+    parts, out = [], None
+    try:
+        for hit in scan(es_object, query=query, index=INDEX_NAME, size=scroll_size):
+            if out is None or parts[-1]['bytes'] >= part_bytes:
+                if out is not None:
+                    out.close()
+                name = f"part-{slice_id:03d}-{len(parts):05d}{DUMP_SUFFIXES[compression]}"
+                out = open_dump(os.path.join(directory, name), compression, 'wb')
+                parts.append({'file': name, 'documents': 0, 'bytes': 0})
+            with metrics.phase('write'):
+                action = {'index': {'_id': hit['_id']},
+                          'year': hit['_source'].get('year_publication')}
+                data = (json.dumps(action) + '\n'
+                        + json.dumps(hit['_source'], ensure_ascii=False) + '\n').encode('utf-8')
+                out.write(data)
+            parts[-1]['documents'] += 1
+            parts[-1]['bytes'] += len(data)
+    finally:
+        if out is not None:
+            out.close()
+    return parts
+
+
+def export_index(es_object, directory, slices='auto', scroll_size=100, compression='gzip',
+                 part_mb=256):
+    """Выгрузка всего индекса в каталог в виде сжатых частей JSON Lines
+
+    Индекс читается параллельным sliced scroll: каждая часть читается в
+    своем потоке и пишет свои файлы. Последним записывается манифест с
+    настройками анализа, профилем маппинга и списком файлов, поэтому дамп
+    без манифеста считается незавершенным.
+
+    Аргументы:
+        es_object: объект подключения
+        directory: каталог дампа
+        slices: число частей scroll ('auto' - по числу шардов)
+        scroll_size: число документов на странице scroll
+        compression: 'gzip', 'zstd' или 'none'
+        part_mb: размер файла до сжатия, МБ
+
+    Возвращаемые значения:
+        manifest: словарь манифеста дампа
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from prettytable import PrettyTable
+    old = alias_indices(es_object)
+    if not old:
+        print(f"Индекс '{INDEX_NAME}' не создан")
+        sys.exit(1)
+    profile = index_profile(es_object)
+    if profile == 'lean':
+        print(f"Текст книг не хранится в _source индекса '{INDEX_NAME}': выгрузка невозможна")
+        sys.exit(1)
+    settings = next(iter(es_object.indices.get_settings(index=old[0])
+                         .values()))['settings']['index']
+    slices = int(settings['number_of_shards']) if slices == 'auto' else int(slices)
+    if compression == 'zstd':
+        zstd_module()
+    os.makedirs(directory, exist_ok=True)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max(slices, 1)) as executor:
+        futures = [executor.submit(export_slice, es_object, directory, slice_id, slices,
+                                   scroll_size, compression, part_mb * 1024 * 1024)
+                   for slice_id in range(slices)]
+        parts = [part for future in futures for part in future.result()]
+    elapsed = max(time.perf_counter() - start, 1e-9)
+
+    manifest = {
+        'index': INDEX_NAME,
+        'exported': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'compression': compression,
+        'profile': profile,
+        'analysis': settings.get('analysis'),
+        'documents': sum(part['documents'] for part in parts),
+        'parts': parts
+    }
+    manifest_file = os.path.join(directory, DUMP_MANIFEST)
+    with open(f"{manifest_file}.tmp", 'w', encoding='utf-8') as write_file:
+        json.dump(manifest, write_file, ensure_ascii=False, indent=1)
+    os.replace(f"{manifest_file}.tmp", manifest_file)
+
+    size = sum(part['bytes'] for part in parts)
+    stored = sum(os.path.getsize(os.path.join(directory, part['file'])) for part in parts)
+    table = PrettyTable(['Документов', 'Файлов', 'Данные, МБ', 'На диске, МБ', 'Время, с',
+                         'МБ/с'])
+    table.add_row([manifest['documents'], len(parts), round(size / 1024 / 1024, 2),
+                   round(stored / 1024 / 1024, 2), round(elapsed, 2),
+                   round(size / 1024 / 1024 / elapsed, 2)])
+    print(f"Индекс '{INDEX_NAME}' выгружен в {directory}")
+    print(table)
+    return manifest
+
+
+def dump_actions(directory, manifest, report):
+    """Генератор bulk-действий из файлов дампа
+
+    Строка _source передается в тело bulk-запроса как есть, без повторной
+    сериализации и разбора: год документа берется из строки действия.
+
+    Аргументы:
+        directory: каталог дампа
+        manifest: словарь манифеста дампа
+        report: словарь со счетчиками загрузки
+
+    Возвращаемые значения:
+        action: действие для bulk API
+
+    """
+    for part in manifest['parts']:
+        with open_dump(os.path.join(directory, part['file']), manifest['compression']) as stream:
+            lines = iter(stream)
+            for line in lines:
+                action = json.loads(line)
+                doc_id = action['index']['_id']
+                source = next(lines).rstrip(b'\n')
+                report['bytes'] += len(source)
+                if 'year' in action:
+                    report['years'][doc_id] = action['year']
+                else:
+                    # Выгрузка без года в строке действия
+                    report['years'][doc_id] = json.loads(source).get('year_publication')
+                yield {
+                    '_op_type': 'create',
+                    '_index': INDEX_NAME,
+                    '_type': 'document',
+                    '_id': doc_id,
+                    'size': len(source),
+                    'write': functools.partial(write_bytes, data=source)
+                }
+
+
+def import_dump(directory, es_object, bulk_load=False, **load_options):
+    """Загрузка дампа export в индекс через bulk API
+
+    Если индекса нет, он создается с настройками анализа и профилем
+    маппинга из манифеста. Документы, которые уже есть в индексе,
+    пропускаются.
+
+    Аргументы:
+        directory: каталог дампа
+        es_object: объект подключения
+        bulk_load: включить профиль массовой загрузки на время загрузки
+        load_options: параметры bulk_index
+
+    Возвращаемые значения:
+        report: словарь со счетчиками загрузки
+
+    """
+    manifest_file = os.path.join(directory, DUMP_MANIFEST)
+    if not os.path.exists(manifest_file):
+        print(f"В каталоге {directory} нет {DUMP_MANIFEST}: дамп не завершен")
+        sys.exit(1)
+    with open(manifest_file, 'r', encoding='utf-8') as read_file:
+        manifest = json.load(read_file)
+    if not alias_indices(es_object):
+        create_index(es_object, analysis=manifest['analysis'], profile=manifest['profile'])
+
+    report = new_report()
+    start = time.perf_counter()
+    if not bulk_load:
+        restore_index_settings(es_object)
+    try:
+        with bulk_profile(es_object, bulk_load):
+            bulk_index(es_object, dump_actions(directory, manifest, report), report,
+                       **load_options)
+    finally:
+        # Уже записанные документы попадают в сводку и при прерванной загрузке
+        update_word_stats(es_object, by_year({doc_id: report['years'][doc_id]
+                                              for doc_id in report['created']}))
+        invalidate_cache()
+    print(f"Дамп {directory} загружен ({manifest['documents']} документов в дампе)")
+    print_report(report, time.perf_counter() - start)
+    return report
+
+
+def configure_cache(enabled, ttl=300, cache_dir=None, max_entries=1024):
+    """Настройка кэша результатов поиска
+
+    Аргументы:
+        enabled: включить кэш
+        ttl: время жизни записи, с
+        cache_dir: каталог дискового кэша между запусками (None - только в памяти);
+            без кэша в нем только увеличивается поколение при записи в индекс
+        max_entries: число записей в кэше в памяти (LRU)
+
+    Возвращаемые значения:
+
+    """
+    CACHE['enabled'] = enabled
+    CACHE['ttl'] = ttl
+    CACHE['dir'] = cache_dir
+    CACHE['max_entries'] = max_entries
+    CACHE['generation_mtime'] = None
+    CACHE['memory'].clear()
+    if enabled and cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        prune_cache_dir()
+
+
+def cache_generation():
+    """Текущее поколение кэша
+
+    Поколение увеличивается при каждой записи в индекс этим скриптом и
+    хранится в каталоге дискового кэша, поэтому видно и другим процессам.
+    Файл поколения перечитывается, только если изменилось время его записи.
+
+    Возвращаемые значения:
+        generation: номер поколения
+
+    """
+    if not CACHE['dir']:
+        return CACHE['generation']
+    path = os.path.join(CACHE['dir'], 'generation')
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+    if mtime != CACHE['generation_mtime']:
+        try:
+            with open(path, 'r', encoding='utf-8') as read_file:
+                CACHE['generation'] = int(read_file.read() or 0)
+        except (OSError, ValueError):
+            return 0
+        CACHE['generation_mtime'] = mtime
+    return CACHE['generation']
+
+
+def invalidate_cache():
+    """Сброс кэша после записи в индекс
+
+    Поколение в каталоге дискового кэша увеличивается и без --cache, чтобы
+    процессы с кэшем не отдавали ответы, полученные до записи. Без --cache
+    несуществующий каталог не создается (в нем нет записей), а ошибка
+    записи (например, HOME только для чтения) не прерывает команду.
+
+    Возвращаемые значения:
+
+    """
+    with CACHE['lock']:
+        generation = cache_generation() + 1
+        CACHE['generation'] = generation
+        CACHE['memory'].clear()
+        if CACHE['dir'] and (CACHE['enabled'] or os.path.isdir(CACHE['dir'])):
+            path = os.path.join(CACHE['dir'], 'generation')
+            try:
+                os.makedirs(CACHE['dir'], exist_ok=True)
+                with open(f"{path}.tmp", 'w', encoding='utf-8') as out:
+                    out.write(str(generation))
+                os.replace(f"{path}.tmp", path)
+            except OSError as ex:
+                print(f"Не удалось сбросить дисковый кэш: {ex}", file=sys.stderr)
+    if CACHE['enabled'] and CACHE['dir']:
+        prune_cache_dir()
+
+
+def cache_key(index, search):
+    """Ключ кэша: индекс, поколение и нормализованное тело запроса
+
+    Аргументы:
+        index: имя индекса
+        search: запрос
+
+    Возвращаемые значения:
+        key: ключ кэша
+
+    """
+    body = json.dumps(search, sort_keys=True, ensure_ascii=False)
+    generation = cache_generation()
+    key = f"{index}\x00{generation}\x00{body}"
+    # Поколение в имени файла, чтобы prune_cache_dir удалял устаревшие записи без чтения
+    return f"{generation}-{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+
+
+def cache_get(key):
+    """Поиск ответа в кэше (сначала в памяти, затем на диске)
+
+    Аргументы:
+        key: ключ кэша
+
+    Возвращаемые значения:
+        res: сохраненный ответ или None
+
+    """
+    now = time.time()
+    with CACHE['lock']:
+        entry = CACHE['memory'].get(key)
+        if entry is not None and now - entry[0] <= CACHE['ttl']:
+            CACHE['memory'].move_to_end(key)
+            CACHE['hits'] += 1
+            return entry[1]
+    if CACHE['dir']:
+        try:
+            with open(os.path.join(CACHE['dir'], key), 'r', encoding='utf-8') as read_file:
+                entry = json.load(read_file)
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None and now - entry['time'] <= CACHE['ttl']:
+            cache_put(key, entry['response'], entry['time'], to_disk=False)
+            with CACHE['lock']:
+                CACHE['hits'] += 1
+            return entry['response']
+    with CACHE['lock']:
+        CACHE['misses'] += 1
+    return None
+
+
+def cache_put(key, res, created=None, to_disk=True):
+    """Сохранение ответа в кэше
+
+    Аргументы:
+        key: ключ кэша
+        res: ответ Elasticsearch
+        created: время создания записи (None - текущее)
+        to_disk: записать также в дисковый кэш
+
+    Возвращаемые значения:
+
+    """
+    created = time.time() if created is None else created
+    with CACHE['lock']:
+        CACHE['memory'][key] = (created, res)
+        CACHE['memory'].move_to_end(key)
+        while len(CACHE['memory']) > CACHE['max_entries']:
+            CACHE['memory'].popitem(last=False)
+    if to_disk and CACHE['dir']:
+        path = os.path.join(CACHE['dir'], key)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as out:
+            json.dump({'time': created, 'response': res}, out, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+        with CACHE['lock']:
+            CACHE['puts'] += 1
+            prune = CACHE['puts'] % CACHE['max_entries'] == 0
+        if prune:
+            prune_cache_dir()
+
+
+def prune_cache_dir():
+    """Удаление из дискового кэша записей старых поколений, устаревших по ttl
+    и самых старых записей сверх max_entries
+
+    Возвращаемые значения:
+        removed: число удаленных файлов
+
+    """
+    prefix = f"{cache_generation()}-"
+    now = time.time()
+    entries, removed = [], 0
+    try:
+        names = os.listdir(CACHE['dir'])
+    except OSError:
+        return 0
+    for name in names:
+        if name == 'generation' or name.endswith('.tmp'):
+            continue
+        path = os.path.join(CACHE['dir'], name)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        if name.startswith(prefix) and now - mtime <= CACHE['ttl']:
+            entries.append((mtime, path))
+            continue
+        with contextlib.suppress(OSError):
+            os.remove(path)
+            removed += 1
+    entries.sort()
+    for _, path in entries[:max(len(entries) - CACHE['max_entries'], 0)]:
+        with contextlib.suppress(OSError):
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+def print_cache_stats():
+    """Вывод числа попаданий и промахов кэша в stderr
+
+    Возвращаемые значения:
+
+    """
+    print(f"Кэш: попаданий {CACHE['hits']}, промахов {CACHE['misses']}", file=sys.stderr)
+
+
+def searcher(es_object, search, index=INDEX_NAME):
+    """Поиск в индексе по определенному запросу
+
+    Если кэш включен, ответ берется из кэша или сохраняется в нем.
+
+    Аргументы:
+        es_object: объект подключения
+        search: запрос
+        index: имя индекса
+
+    Возвращаемые значения:
+        res: результат поиска
+    """
+    with metrics.phase('search'):
+        if not CACHE['enabled']:
+            return es_object.search(index=index, body=search)
+        key = cache_key(index, search)
+        res = cache_get(key)
+        if res is None:
+            res = es_object.search(index=index, body=search)
+            cache_put(key, res)
+        return res
+
+
+def count_books(es_object, query):
+    """Число различных книг, документы которых подходят под запрос
+
+    Аргументы:
+        es_object: объект подключения
+        query: запрос
+
+    Возвращаемые значения:
+        total: число книг
+
+    """
+    res = searcher(es_object, {
+        "size": 0,
+        "query": query,
+        "aggs": {
+            "books": {
+                "cardinality": {"field": "book_id", "precision_threshold": 40000}
+            }
+        }
+    })
+    return res['aggregations']['books']['value']
+
+
+def stream_books(es_object, query, page_size=500):
+    """Постраничный обход всех книг, документы которых подходят под запрос
+
+    Книги перебираются composite-агрегацией по book_id, поэтому части одной
+    книги сворачиваются в одну запись, а обход не ограничен первыми
+    попаданиями. Из _source берутся только метаданные, без текста.
+
+    Аргументы:
+        es_object: объект подключения
+        query: запрос
+        page_size: число книг на одной странице
+
+    Возвращаемые значения:
+        hits: список подходящих документов одной книги (по номеру части)
+
+    """
+    after = None
+    while True:
+        composite = {
+            "size": page_size,
+            "sources": [{"book": {"terms": {"field": "book_id"}}}]
+        }
+        if after is not None:
+            composite['after'] = after
+        res = searcher(es_object, {
+            "size": 0,
+            "query": query,
+            "aggs": {
+                "books": {
+                    "composite": composite,
+                    "aggs": {
+                        "docs": {
+                            "top_hits": {
+                                "size": 100,
+                                "_source": ["title", "author", "year_publication",
+                                            "book_id", "chunk"],
+                                "sort": [{"chunk": {"order": "asc",
+                                                    "unmapped_type": "integer"}}]
+                            }
+                        }
+                    }
+                }
+            }
+        })
+        buckets = res['aggregations']['books']['buckets']
+        for bucket in buckets:
+            yield bucket['docs']['hits']['hits']
+        if len(buckets) < page_size:
+            return
+        after = buckets[-1]['key']
+
+
+def book_rows(es_object, query):
+    """Строки вывода для всех найденных книг
+
+    Аргументы:
+        es_object: объект подключения
+        query: запрос
+
+    Возвращаемые значения:
+        row: строка 'название, автор, год' с номерами частей, если книга разбита
+
+    """
+    for hits in stream_books(es_object, query):
+        source = hits[0]['_source']
+        row = f"{source['title']}, {source['author']}, {source['year_publication']}"
+        chunks = [hit['_source']['chunk'] for hit in hits if 'chunk' in hit['_source']]
+        if chunks:
+            row += f" (части: {', '.join(map(str, chunks))})"
+        yield row
+
+
+def print_books(es_object, query, not_found):
+    """Вывод числа найденных книг и потоковый вывод их списка
+
+    Аргументы:
+        es_object: объект подключения
+        query: запрос
+        not_found: сообщение, если ничего не найдено
+
+    Возвращаемые значения:
+
+    """
+    total = count_books(es_object, query)
+    if total == 0:
+        print(not_found)
+        sys.exit(0)
+    print(f"Found: {total}")
+    for row in book_rows(es_object, query):
+        print(row)
+
+
+def word_query(word):
+    """Запрос книг с заданным словом
+
+    Аргументы:
+        word: слово
+
+    Возвращаемые значения:
+        query: запрос
+
+    """
+    return {
+        "bool": {
+            "must": [
+                {
+                    "match": {"text": f"{word}"}
+                }
+            ]
+        }
+    }
+
+
+def author_word_query(author, word):
+    """Запрос книг заданного автора с заданной строкой
+
+    Условие на автора остается в оценке: она зависит от длины поля author,
+    и от нее зависит порядок книг в msearch.
+
+    Аргументы:
+        author: автор
+        word: строка
+
+    Возвращаемые значения:
+        query: запрос
+
+    """
+    return {
+        "bool": {
+            "must": [
+                {
+                    "match": {"text": f"{word}"}
+                },
+                {
+                    "match": {"author": f"{author}"}
+                }
+            ]
+        }
+    }
+
+
+def date_query(from_date, until_date, word, exclude=None):
+    """Запрос книг из диапазона годов без заданной строки
+
+    Аргументы:
+        from_date: начальный год
+        until_date: конечный год
+        word: строка
+        exclude: идентификаторы разбитых книг, которые нужно исключить
+            (части которых содержат строку)
+
+    Возвращаемые значения:
+        query: запрос
+
+    """
+    query = {
+        "bool": {
+            "filter": [
+                {
+                    "range": {
+                        "year_publication": {
+                            "gte": from_date,
+                            "lte": until_date
+                        }
+                    }
+                }
+            ],
+            "must_not": [
+                {
+                    "match": {"text": f"{word}"}
+                }
+            ]
+        }
+    }
+    if exclude:
+        query['bool']['must_not'].append({"terms": {"book_id": exclude}})
+    return query
+
+
+def count_books_with_words(es_object, word):
+    """Вывод всех книг с заданным словом
+
+    Аргументы:
+        es_object: объект подключения
+        word: слово
+
+    Возвращаемые значения:
+
+    """
+    print_books(es_object, word_query(word), "Not found for this word")
+
+
+def search_books(es_object, author, word):
+    """Вывод всех книг заданного автора, которые содержат заданную строку
+
+    Аргументы:
+        es_object: объект подключения
+        author: автор
+        word: строка
+
+    Возвращаемые значения:
+
+    """
+    print_books(es_object, author_word_query(author, word),
+                "Not found for this word and author")
+
+
+def books_with_word(es_object, from_date, until_date, word):
+    """Идентификаторы разбитых на части книг из диапазона годов, в частях
+    которых есть заданная строка
+
+    Книга из одного документа со строкой и так не попадает в результат
+    date_query, поэтому ищутся только части (поле chunk).
+
+    Аргументы:
+        es_object: объект подключения
+        from_date: начальный год
+        until_date: конечный год
+        word: строка
+
+    Возвращаемые значения:
+        ids: список идентификаторов книг
+
+    """
+    query = {
+        "bool": {
+            "must": [
+                {
+                    "match": {"text": f"{word}"}
+                }
+            ],
+            "filter": [
+                {
+                    "range": {
+                        "year_publication": {
+                            "gte": from_date,
+                            "lte": until_date
+                        }
+                    }
+                },
+                {
+                    "exists": {"field": "chunk"}
+                }
+            ]
+        }
+    }
+    return [hits[0]['_source']['book_id'] for hits in stream_books(es_object, query)]
+
+
+def search_date(es_object, from_date, until_date, word):
+    """Вывод всех книг из указанного диапазона годов, которые НЕ содержат заданную строку
+
+    Если книга разбита на части, строка ищется во всех ее частях: книга
+    исключается, если строка есть хотя бы в одной из них.
+
+    Аргументы:
+        es_object: объект подключения
+        from_date: начальный год
+        until_date: конечный год
+        word: строка
+
+    Возвращаемые значения:
+
+    """
+    query = date_query(from_date, until_date, word,
+                       books_with_word(es_object, from_date, until_date, word))
+    print_books(es_object, query, "Not found for this word and date range")
+
+
+def batch_queries(lines, query_type, from_date=None, until_date=None):
+    """Запросы для пакетного поиска по строкам входного файла
+
+    Для count-books-with-words и search-dates строка - это слово, для
+    search-books - автор и слово через табуляцию.
+
+    Аргументы:
+        lines: итератор строк
+        query_type: 'count-books-with-words', 'search-books' или 'search-dates'
+        from_date: начальный год (для search-dates)
+        until_date: конечный год (для search-dates)
+
+    Возвращаемые значения:
+        item: кортеж (параметры запроса, запрос)
+
+    """
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.strip():
+            continue
+        if query_type == 'search-books':
+            author, _, word = line.partition('\t')
+            yield {'author': author, 'word': word}, author_word_query(author, word)
+        elif query_type == 'search-dates':
+            # Исключение разбитых книг добавляет split_book_exclusions
+            yield {'word': line}, date_query(from_date, until_date, line)
+        else:
+            yield {'word': line}, word_query(line)
+
+
+def split_book_exclusions(es_object, queries, from_date, until_date, batch_size=100):
+    """Добавление к запросам search-dates исключения разбитых книг, как в search_date
+
+    Для каждой пачки запросов одним _msearch находятся разбитые книги из
+    диапазона годов, в частях которых есть слово (как в books_with_word).
+    Если таких книг больше BATCH_EXCLUDE_SIZE, они перебираются через
+    books_with_word.
+
+    Аргументы:
+        es_object: объект подключения
+        queries: итератор кортежей (параметры запроса, запрос) из batch_queries
+        from_date: начальный год
+        until_date: конечный год
+        batch_size: число запросов в одном _msearch
+
+    Возвращаемые значения:
+        item: кортеж (параметры запроса, запрос с исключением)
+
+    """
+    for batch in chunked(queries, batch_size):
+        body = []
+        for params, _ in batch:
+            body.append({"index": INDEX_NAME})
+            body.append({
+                "size": 0,
+                "query": {
+                    "bool": {
+                        "must": [{"match": {"text": params['word']}}],
+                        "filter": [
+                            {"range": {"year_publication": {"gte": from_date,
+                                                            "lte": until_date}}},
+                            {"exists": {"field": "chunk"}}
+                        ]
+                    }
+                },
+                "aggs": {"books": {"terms": {"field": "book_id",
+                                             "size": BATCH_EXCLUDE_SIZE}}}
+            })
+        res = es_object.msearch(body=body)
+        for (params, query), response in zip(batch, res['responses']):
+            if 'error' in response:
+                # Повтор отдельным запросом: при ошибке поиск прерывается, а не дает
+                # неверный ответ
+                exclude = books_with_word(es_object, from_date, until_date, params['word'])
+            else:
+                books = response['aggregations']['books']
+                exclude = [bucket['key'] for bucket in books['buckets']]
+                if books.get('sum_other_doc_count'):
+                    exclude = books_with_word(es_object, from_date, until_date,
+                                              params['word'])
+            yield params, date_query(from_date, until_date, params['word'], exclude)
+
+
+def msearch_results(es_object, queries, batch_size=100, size=10):
+    """Выполнение запросов пачками через _msearch
+
+    Аргументы:
+        es_object: объект подключения
+        queries: итератор кортежей (параметры запроса, запрос)
+        batch_size: число запросов в одном _msearch
+        size: число книг в результате каждого запроса
+
+    Возвращаемые значения:
+        result: словарь с параметрами запроса, числом книг (total) и списком книг
+
+    """
+    for batch in chunked(queries, batch_size):
+        body = []
+        for _, query in batch:
+            body.append({"index": INDEX_NAME})
+            body.append({
+                "size": size,
+                "query": query,
+                "_source": ["title", "author", "year_publication"],
+                "collapse": {"field": "book_id"},
+                "aggs": {
+                    "books": {
+                        "cardinality": {"field": "book_id", "precision_threshold": 40000}
+                    }
+                }
+            })
+        res = es_object.msearch(body=body)
+        for (params, _), response in zip(batch, res['responses']):
+            result = dict(params)
+            if 'error' in response:
+                result['error'] = str(response['error'])
+            else:
+                result['total'] = response['aggregations']['books']['value']
+                result['books'] = [
+                    {
+                        'title': record['_source']['title'],
+                        'author': record['_source']['author'],
+                        'year': record['_source']['year_publication']
+                    } for record in response['hits']['hits']
+                ]
+            yield result
+
+
+def write_results(results, out, output_format='jsonl'):
+    """Запись результатов пакетного поиска в формате JSON Lines или CSV
+
+    В CSV список книг записывается одной ячейкой через ' | '.
+
+    Аргументы:
+        results: итератор результатов msearch_results
+        out: файловый объект для записи
+        output_format: 'jsonl' или 'csv'
+
+    Возвращаемые значения:
+        count: число записанных результатов
+
+    """
+    import csv
+    count = 0
+    if output_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(['author', 'word', 'total', 'books', 'error'])
+        for result in results:
+            books = ' | '.join(f"{book['title']}, {book['author']}, {book['year']}"
+                               for book in result.get('books', []))
+            writer.writerow([result.get('author', ''), result['word'],
+                             result.get('total', ''), books, result.get('error', '')])
+            count += 1
+    else:
+        for result in results:
+            out.write(json.dumps(result, ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+
+def batch_search(es_object, file, query_type='count-books-with-words', from_date=None,
+                 until_date=None, output=None, output_format='jsonl', batch_size=100, size=10):
+    """Пакетный поиск по списку слов или пар (автор, слово) через _msearch
+
+    Аргументы:
+        es_object: объект подключения
+        file: файл со словами ('-' - stdin)
+        query_type: 'count-books-with-words', 'search-books' или 'search-dates'
+        from_date: начальный год (для search-dates)
+        until_date: конечный год (для search-dates)
+        output: файл результатов (None - stdout)
+        output_format: 'jsonl' или 'csv'
+        batch_size: число запросов в одном _msearch
+        size: число книг в результате каждого запроса
+
+    Возвращаемые значения:
+
+    """
+    read_file = sys.stdin if file == '-' else open(file, 'r', encoding='utf-8')
+    out = sys.stdout if output is None else open(output, 'w', encoding='utf-8', newline='')
+    start = time.perf_counter()
+    try:
+        queries = batch_queries(read_file, query_type, from_date, until_date)
+        if query_type == 'search-dates':
+            queries = split_book_exclusions(es_object, queries, from_date, until_date,
+                                            batch_size)
+        count = write_results(msearch_results(es_object, queries, batch_size, size),
+                              out, output_format)
+    finally:
+        if read_file is not sys.stdin:
+            read_file.close()
+        if out is not sys.stdout:
+            out.close()
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"Запросов: {count}, {round(count / elapsed, 2)} запросов/с", file=sys.stderr)
+
+
+YEAR_SCRIPT = {"source": "doc['year_publication'].value.getYear()"}
+
+
+def one_per_book():
+    """Условие, оставляющее по одному документу на книгу
+
+    Книга без разбиения хранится одним документом без поля chunk, у
+    разбитой книги берется часть с номером 0.
+
+    Возвращаемые значения:
+        clause: условие для контекста filter
+
+    """
+    return {
+        "bool": {
+            "should": [
+                {"bool": {"must_not": {"exists": {"field": "chunk"}}}},
+                {"term": {"chunk": 0}}
+            ]
+        }
+    }
+
+
+def year_stats_body(author=None, group_by=None):
+    """Тело запроса статистики годов издания (без передачи документов)
+
+    Аргументы:
+        author: автор (None - все книги)
+        group_by: группировка 'author', 'decade' или None
+
+    Возвращаемые значения:
+        body: тело запроса
+
+    """
+    query = {"bool": {"filter": [one_per_book()]}}
+    if author:
+        query['bool']['filter'].append({"match": {"author": f"{author}"}})
+    aggs = {
+        "years": {"stats": {"script": YEAR_SCRIPT}},
+        "percentiles": {
+            "percentiles": {"script": YEAR_SCRIPT, "percents": [25, 50, 75]}
+        }
+    }
+    if group_by == 'author':
+        aggs = {"groups": {"terms": {"field": "author.keyword", "size": 10000}, "aggs": aggs}}
+    elif group_by == 'decade':
+        aggs = {"groups": {"histogram": {"script": YEAR_SCRIPT, "interval": 10,
+                                         "min_doc_count": 1}, "aggs": aggs}}
+    return {"size": 0, "query": query, "aggs": aggs}
+
+
+def calc_date(es_object, author):
+    """Вывод среднего арифметического для года издания заданного автора
+
+    Аргументы:
+        es_object: объект подключения
+        author: автор
+
+    Возвращаемые значения:
+
+    """
+    res = searcher(es_object, year_stats_body(author))
+    if res['aggregations']['years']['count'] == 0:
+        print("Not found for this author")
+        sys.exit(0)
+    print(round(res['aggregations']['years']['avg']))
+
+
+def stats(es_object, author=None, group_by=None):
+    """Вывод статистики годов издания: число книг, минимум, максимум, среднее и квартили
+
+    Аргументы:
+        es_object: объект подключения
+        author: автор (None - все книги)
+        group_by: группировка 'author', 'decade' или None
+
+    Возвращаемые значения:
+
+    """
+    from prettytable import PrettyTable
+    res = searcher(es_object, year_stats_body(author, group_by))
+    if group_by:
+        groups = [(bucket['key'], bucket) for bucket in res['aggregations']['groups']['buckets']]
+    else:
+        groups = [('Все книги', res['aggregations'])]
+    if not groups or groups[0][1]['years']['count'] == 0:
+        print("Not found")
+        sys.exit(0)
+
+    head = ['Группа', 'Книг', 'Мин.', 'Макс.', 'Среднее', 'Q1', 'Медиана', 'Q3']
+    table = PrettyTable(head)
+    for key, group in groups:
+        if group_by == 'decade':
+            key = f"{int(key)}-е"
+        years = group['years']
+        quartiles = group['percentiles']['values']
+        table.add_row([key, years['count'], round(years['min']), round(years['max']),
+                       round(years['avg'], 1), round(quartiles['25.0']),
+                       round(quartiles['50.0']), round(quartiles['75.0'])])
+    print(table)
+
+
+def search_by_year(es_object, year):
+    """Поиск книг по году
+
+    Аргументы:
+        es_object: объект подключения
+        year: год публикации
+
+    Возвращаемые значения:
+        ids: идентификаторы всех документов заданного года
+
+    """
+    from elasticsearch6.helpers import scan
+    body = {
+        "query": {
+            "bool": {
+                "filter": [
+                    {
+                        "term": {"year_publication": year}
+                    }
+                ]
+            }
+        }
+    }
+    with metrics.phase('scan'):
+        ids = [record['_id'] for record in scan(es_object, query=body, index=INDEX_NAME,
+                                                _source=False)]
+    if not ids:
+        print("Not found for this year")
+        sys.exit(0)
+    return ids
+
+
+async def gather_limited(calls, concurrency=4, ordered=False):
+    """Асинхронное выполнение синхронных вызовов с ограничением числа одновременных
+
+    Клиент elasticsearch6 синхронный, поэтому вызовы выполняются в пуле из
+    concurrency потоков, а asyncio ограничивает их число и собирает ответы.
+
+    Аргументы:
+        calls: список функций без аргументов
+        concurrency: максимальное число одновременных вызовов
+        ordered: возвращать результаты в порядке вызовов, а не по готовности
+
+    Возвращаемые значения:
+        result: результат очередного вызова
+
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    with ThreadPoolExecutor(max(concurrency, 1)) as executor:
+        async def limited(call):
+            async with semaphore:
+                return await loop.run_in_executor(executor, call)
+
+        tasks = [asyncio.ensure_future(limited(call)) for call in calls]
+        for task in (tasks if ordered else asyncio.as_completed(tasks)):
+            yield await task
+
+
+def mtermvectors_call(es_object, ids):
+    """Запрос векторов терминов пачки документов (только частоты)
+
+    Аргументы:
+        es_object: объект подключения
+        ids: идентификаторы документов
+
+    Возвращаемые значения:
+        call: функция без аргументов, выполняющая запрос
+
+    """
+    return lambda: es_object.mtermvectors(index=INDEX_NAME, doc_type="document", body={
+        "ids": ids,
+        "parameters": {
+            "fields": ["text"],
+            "positions": False,
+            "offsets": False,
+            "payloads": False,
+            "field_statistics": False,
+            "term_statistics": False
+        }
+    })
+
+
+async def term_frequencies_async(es_object, ids, batch_size=100, concurrency=4,
+                                 by_document=False):
+    """Суммарные частоты слов в заданных документах (асинхронно)
+
+    Аргументы:
+        es_object: объект подключения
+        ids: идентификаторы документов
+        batch_size: число документов в одном запросе
+        concurrency: число одновременных запросов
+        by_document: вернуть частоты по каждому документу
+
+    Возвращаемые значения:
+        terms: Counter слово -> число упоминаний (с by_document - словарь
+               идентификатор документа -> Counter)
+
+    """
+    terms, documents = Counter(), {}
+    calls = [mtermvectors_call(es_object, ids[start:start + batch_size])
+             for start in range(0, len(ids), batch_size)]
+    async for res in gather_limited(calls, concurrency):
+        for doc in res['docs']:
+            vector = doc.get('term_vectors', {}).get('text', {}).get('terms', {})
+            counter = documents.setdefault(doc['_id'], Counter()) if by_document else terms
+            for term, info in vector.items():
+                counter[term] += info['term_freq']
+    return documents if by_document else terms
+
+
+def term_frequencies(es_object, ids, batch_size=100, concurrency=4, by_document=False):
+    """Суммарные частоты слов в заданных документах
+
+    Векторы терминов запрашиваются через mtermvectors пачками по batch_size
+    документов, без позиций, смещений и статистики; одновременно выполняется
+    до concurrency запросов.
+
+    Аргументы:
+        es_object: объект подключения
+        ids: идентификаторы документов
+        batch_size: число документов в одном запросе
+        concurrency: число одновременных запросов
+        by_document: вернуть частоты по каждому документу
+
+    Возвращаемые значения:
+        terms: Counter слово -> число упоминаний (с by_document - словарь
+               идентификатор документа -> Counter)
+
+    """
+    import asyncio
+    with metrics.phase('termvectors'):
+        return asyncio.run(term_frequencies_async(es_object, ids, batch_size, concurrency,
+                                                  by_document))
+
+
+def update_word_stats(es_object, ids_by_year, chunk_size=1000, sign=1):
+    """Добавление частот слов новых документов в сводку по годам
+
+    С sign=-1 частоты вычитаются (векторы терминов документов должны еще
+    быть в индексе).
+
+    Аргументы:
+        es_object: объект подключения
+        ids_by_year: словарь год -> идентификаторы документов
+        chunk_size: число обновлений в одном bulk-запросе
+        sign: 1 - добавить частоты, -1 - вычесть
+
+    Возвращаемые значения:
+
+    """
+    for year, ids in ids_by_year.items():
+        if ids:
+            apply_word_stats(es_object, {year: term_frequencies(es_object, ids)}, chunk_size,
+                             sign)
 
-    sorted_tuples = sorted(terms.items(), key=lambda item: item[1], reverse=True)
-    sorted_dict = dict(sorted_tuples)
 
-    print(f"Топ-10 самых популярных слов в книгах {year} года:\n")
+def apply_word_stats(es_object, terms_by_year, chunk_size=1000, sign=1):
+    """Запись частот слов в сводку по годам
+
+    Аргументы:
+        es_object: объект подключения
+        terms_by_year: словарь год -> Counter слово -> число упоминаний
+        chunk_size: число обновлений в одном bulk-запросе
+        sign: 1 - добавить частоты, -1 - вычесть
+
+    Возвращаемые значения:
+
+    """
+    from elasticsearch6.helpers import streaming_bulk
+    create_stats_index(es_object)
+    for year, terms in terms_by_year.items():
+        actions = ({
+            '_op_type': 'update',
+            '_index': STATS_INDEX,
+            '_type': 'document',
+            '_id': f"{year}:{term}",
+            '_retry_on_conflict': 3,
+            'script': {
+                'source': 'ctx._source.count += params.count',
+                'params': {'count': sign * count}
+            },
+            'upsert': {'year': str(year), 'term': term, 'count': sign * count}
+        } for term, count in terms.items())
+        with metrics.phase('word-stats'):
+            for success, item in streaming_bulk(es_object, actions, chunk_size=chunk_size,
+                                                raise_on_error=False):
+                if not success:
+                    info = list(item.values())[0]
+                    print(f"Ошибка обновления сводки ({info.get('status')}): "
+                          f"{info.get('error')}")
+
+
+def rebuild_stats(es_object):
+    """Пересчет сводки частот слов по годам по всему индексу
+
+    Аргументы:
+        es_object: объект подключения
+
+    Возвращаемые значения:
+
+    """
+    from elasticsearch6.helpers import scan
+    es_object.indices.delete(index=STATS_INDEX, ignore=404)
+    ids_by_year = {}
+    for record in scan(es_object, index=INDEX_NAME, _source=['year_publication']):
+        year = record['_source']['year_publication']
+        ids_by_year.setdefault(year, []).append(record['_id'])
+    update_word_stats(es_object, ids_by_year)
+    invalidate_cache()
+    print(f"Сводка пересчитана: {len(ids_by_year)} лет, "
+          f"{sum(map(len, ids_by_year.values()))} документов")
+
+
+def stored_top_words(es_object, year, top=10):
+    """Самые популярные слова года из сводки частот
+
+    Аргументы:
+        es_object: объект подключения
+        year: год публикации
+        top: число слов
+
+    Возвращаемые значения:
+        words: список пар (слово, число упоминаний); пустой, если года нет в сводке
+
+    """
+    if not es_object.indices.exists(STATS_INDEX):
+        return []
+    res = searcher(es_object, index=STATS_INDEX, search={
+        "size": top,
+        "query": {
+            "bool": {
+                "filter": {"term": {"year": str(year)}}
+            }
+        },
+        "sort": [{"count": "desc"}],
+        "_source": ["term", "count"]
+    })
+    return [(record['_source']['term'], record['_source']['count'])
+            for record in res['hits']['hits']]
+
+
+def top_words(es_object, year, top=10, concurrency=4):
+    """Вывод самых популярных слов с количеством их упоминаний во всех книгах одного года
+
+    Слова берутся из сводки частот по годам. Если года в сводке нет,
+    частоты считаются по векторам терминов документов.
+
+    Аргументы:
+        es_object: объект подключения
+        year: год публикации
+        top: число слов
+        concurrency: число одновременных запросов векторов терминов
+
+    Возвращаемые значения:
+
+    """
+    from prettytable import PrettyTable
+    with metrics.phase('stored-top-words'):
+        words = stored_top_words(es_object, year, top)
+    if not words:
+        terms = term_frequencies(es_object, search_by_year(es_object, year),
+                                 concurrency=concurrency)
+        words = heapq.nlargest(top, terms.items(), key=lambda item: item[1])
+
+    print(f"Топ-{top} самых популярных слов в книгах {year} года:\n")
     head = ['Слово', 'Количество упоминаний']
     table = PrettyTable(head)
-    for slovo in list(sorted_dict.keys())[0:10]:
-        body = [slovo, sorted_dict[slovo]]
-        table.add_row(body)
+    for slovo, count in words:
+        table.add_row([slovo, count])
     print(table)
 
 
-def main():
-    """Передача аргументов командной строки исполняемым функциям"""
-    args = arg_parse()
-    elastic = connect_elasticsearch('localhost', 9200)
+class ThreadStdout:
+    """Поток вывода, который пишет в буфер текущего потока, если он задан"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        buffer = getattr(self.local, 'buffer', None)
+        return (self.stream if buffer is None else buffer).write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def run_line(line, elastic):
+    """Выполнение одной команды пакета
+
+    Ошибки команды выводятся и не прерывают обработку остальных.
+
+    Аргументы:
+        line: команда в формате командной строки
+        elastic: объект подключения
+
+    Возвращаемые значения:
+
+    """
+    from elasticsearch6.exceptions import TransportError
+    try:
+        args = arg_parse(shlex.split(line))
+        with metrics.phase(args.command):
+            run_command(args, elastic)
+    except SystemExit:
+        pass
+    except (TransportError, OSError, KeyError, ValueError) as ex:
+        print(f"Ошибка: {ex}")
+
+
+def captured_line(line, elastic):
+    """Выполнение команды пакета с сохранением ее вывода
+
+    Аргументы:
+        line: команда в формате командной строки
+        elastic: объект подключения
+
+    Возвращаемые значения:
+        output: текст, выведенный командой
+
+    """
+    buffer = io.StringIO()
+    sys.stdout.local.buffer = buffer
+    try:
+        run_line(line, elastic)
+    finally:
+        sys.stdout.local.buffer = None
+    return buffer.getvalue()
+
+
+async def run_batch_async(elastic, lines, concurrency):
+    """Одновременное выполнение команд пакета, вывод в порядке команд
+
+    Аргументы:
+        elastic: объект подключения
+        lines: список команд
+        concurrency: число одновременно выполняемых команд
+
+    Возвращаемые значения:
+
+    """
+    stdout = sys.stdout
+    sys.stdout = ThreadStdout(stdout)
+    try:
+        calls = [lambda line=line: captured_line(line, elastic) for line in lines]
+        async for output in gather_limited(calls, concurrency, ordered=True):
+            stdout.write(output)
+            stdout.flush()
+    finally:
+        sys.stdout = stdout
+
+
+def batch_lines(lines):
+    """Отбор команд из строк пакета: без пустых строк и комментариев, до exit/quit
+
+    Аргументы:
+        lines: итератор строк
+
+    Возвращаемые значения:
+        line: очередная команда
+
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line in ('exit', 'quit'):
+            return
+        yield line
+
+
+def run_batch(elastic, lines, concurrency=1):
+    """Выполнение команд по одной на строку с общим подключением
+
+    При concurrency > 1 команды выполняются одновременно, а их вывод
+    печатается целиком в порядке команд. Параметры подключения в строках
+    команд игнорируются.
+
+    Аргументы:
+        elastic: объект подключения
+        lines: итератор строк с командами в формате командной строки
+        concurrency: число одновременно выполняемых команд
+
+    Возвращаемые значения:
+
+    """
+    import asyncio
+    if concurrency > 1:
+        asyncio.run(run_batch_async(elastic, list(batch_lines(lines)), concurrency))
+        return
+    for line in batch_lines(lines):
+        run_line(line, elastic)
+        sys.stdout.flush()
+
+
+def shell_lines():
+    """Чтение команд из интерактивного ввода
+
+    Возвращаемые значения:
+        line: очередная введенная строка
+
+    """
+    while True:
+        try:
+            yield input('lr2> ')
+        except EOFError:
+            return
+
+
+def run_command(args, elastic):
+    """Передача разобранных аргументов исполняемым функциям
+
+    Аргументы:
+        args: разобранные аргументы
+        elastic: объект подключения
+
+    Возвращаемые значения:
+
+    """
     if args.command == 'create':
-        create_index(elastic)
+        analysis = load_analysis(args.analysis) if args.analysis else None
+        if not create_index(elastic, args.shards, args.replicas, analysis,
+                            args.mapping or 'default'):
+            restore_index_settings(elastic)
         sys.exit(0)
+    elif args.command == 'reindex':
+        analysis = load_analysis(args.analysis) if args.analysis else None
+        reindex(elastic, args.second_command, args.slices, args.shards, args.replicas, analysis,
+                args.keep_old, args.workers, args.split_kb, args.mapping,
+                chunk_size=args.chunk_size, chunk_bytes=args.chunk_bytes,
+                max_retries=args.max_retries, initial_backoff=args.initial_backoff,
+                threads=args.threads)
+    elif args.command == 'restore-settings':
+        if restore_index_settings(elastic) is False:
+            print("Настройки индекса не менялись")
+    elif args.command == 'batch':
+        if args.second_command in (None, '-'):
+            run_batch(elastic, sys.stdin, args.concurrency or 1)
+        else:
+            with open(args.second_command, 'r', encoding='utf-8') as read_file:
+                run_batch(elastic, read_file, args.concurrency or 1)
+    elif args.command == 'shell':
+        run_batch(elastic, shell_lines())
     elif args.command == 'add-book':
         if args.second_command and args.name and args.author and args.year:
-            add_book(args.second_command, elastic, args.name, args.author, args.year)
+            restore_index_settings(elastic)
+            add_book(args.second_command, elastic, args.name, args.author, args.year,
+                     args.split_kb)
         else:
             print("Error args")
             sys.exit(1)
     elif args.command == 'add-books':
         if args.second_command:
-            add_books(args.second_command, elastic)
+            add_books(args.second_command, elastic, args.chunk_size, args.chunk_bytes,
+                      args.max_retries, args.initial_backoff, args.threads, args.workers,
+                      args.split_kb, args.bulk_profile, args.force_merge)
+        else:
+            print("Error args")
+            sys.exit(1)
+    elif args.command == 'sync':
+        if args.second_command:
+            sync(args.second_command, elastic, args.manifest, args.watch, args.interval,
+                 workers=args.workers, split_kb=args.split_kb, chunk_size=args.chunk_size,
+                 chunk_bytes=args.chunk_bytes, max_retries=args.max_retries,
+                 initial_backoff=args.initial_backoff, threads=args.threads)
+        else:
+            print("Error args")
+            sys.exit(1)
+    elif args.command == 'export':
+        if args.second_command:
+            export_index(elastic, args.second_command, args.slices, args.scroll_size,
+                         args.compression, args.part_mb)
+        else:
+            print("Error args")
+            sys.exit(1)
+    elif args.command == 'import':
+        if args.second_command:
+            import_dump(args.second_command, elastic, args.bulk_profile,
+                        chunk_size=args.chunk_size, chunk_bytes=args.chunk_bytes,
+                        max_retries=args.max_retries, initial_backoff=args.initial_backoff,
+                        threads=args.threads)
         else:
             print("Error args")
             sys.exit(1)
@@ -504,9 +3568,22 @@ def main():
         else:
             print("Error args")
             sys.exit(1)
+    elif args.command == 'msearch':
+        if args.second_command and (args.query != 'search-dates'
+                                    or (args.from_date and args.until_date)):
+            batch_search(elastic, args.second_command, args.query, args.from_date,
+                         args.until_date, args.output, args.format, args.batch_size,
+                         args.size)
+        else:
+            print("Error args")
+            sys.exit(1)
+    elif args.command == 'stats':
+        stats(elastic, args.author, args.group_by)
+    elif args.command == 'rebuild-stats':
+        rebuild_stats(elastic)
     elif args.command == 'top-words':
         if args.year:
-            top_words(elastic, args.year)
+            top_words(elastic, args.year, args.top, args.concurrency or 4)
         else:
             print("Error args")
             sys.exit(1)
@@ -515,5 +3592,213 @@ def main():
         sys.exit(1)
 
 
+def word_stats(path, top=10):
+    """Вывод самых частых слов по книгам и по годам для файлов каталога
+
+    Подсчет выполняется локально (analysis.year_top_words), год берется из
+    имени файла 'название - автор - год'.
+
+    Аргументы:
+        path: каталог (путь или имя каталога в LR_2/input)
+        top: число слов
+
+    Возвращаемые значения:
+
+    """
+    from prettytable import PrettyTable
+    from analysis import fb2_text, year_top_words
+    directory = path if os.path.isdir(path) else f'LR_2/input/{path}'
+
+    def books():
+        for name_file in sorted(os.listdir(directory)):
+            book = parse_file_name(name_file)
+            if book is None:
+                continue
+            text, _, error = read_book(os.path.join(directory, name_file))
+            if error is not None:
+                print(f"Ошибка чтения {name_file}: {error}")
+                continue
+            if name_file.endswith('.fb2'):
+                text = fb2_text(text)
+            yield os.path.splitext(name_file)[0], book[2], text
+
+    start = time.perf_counter()
+    by_book, by_year = year_top_words(books(), top)
+    elapsed = time.perf_counter() - start
+
+    for title, words in list(by_book.items()) + list(by_year.items()):
+        print(f"\nТоп-{top} слов: {title}")
+        table = PrettyTable(['Слово', 'Количество упоминаний'])
+        for slovo, count in words:
+            table.add_row([slovo, count])
+        print(table)
+    print(f"\nКниг: {len(by_book)}, время: {round(elapsed, 2)} с")
+
+
+def local_books(path):
+    """Книги каталога для локального индекса
+
+    Аргументы:
+        path: путь к каталогу
+
+    Возвращаемые значения:
+        book: кортеж (название, автор, год, текст)
+
+    """
+    for name_file in sorted(os.listdir(f'LR_2/input/{path}')):
+        book = parse_file_name(name_file)
+        if book is None:
+            continue
+        text, _, error = read_book(f"LR_2/input/{path}/{name_file}")
+        if error is not None:
+            print(f"Ошибка чтения {name_file}: {error}")
+            continue
+        yield (*book, text)
+
+
+def print_local_books(books, not_found):
+    """Вывод книг, найденных в локальном индексе, в формате команд поиска
+
+    Аргументы:
+        books: список словарей title, author, year
+        not_found: сообщение, если ничего не найдено
+
+    Возвращаемые значения:
+
+    """
+    if not books:
+        print(not_found)
+        sys.exit(0)
+    print(f"Found: {len(books)}")
+    for book in books:
+        print(f"{book['title']}, {book['author']}, {book['year']}")
+
+
+def run_local_command(args):
+    """Выполнение команд поиска по локальному индексу
+
+    Аргументы:
+        args: разобранные аргументы
+
+    Возвращаемые значения:
+
+    """
+    import local_index
+    from prettytable import PrettyTable
+    if args.command == 'build-local':
+        if not args.second_command:
+            print("Error args")
+            sys.exit(1)
+        count = local_index.build_index(local_books(args.second_command), args.local_index)
+        print(f"Локальный индекс '{args.local_index}' построен: {count} книг")
+        return
+
+    index = local_index.LocalIndex(args.local_index)
+    try:
+        if args.command == 'count-books-with-words' and args.second_command:
+            print_local_books(index.books(index.docs_with_words(args.second_command)),
+                              "Not found for this word")
+        elif args.command == 'search-books' and args.second_command and args.author:
+            docs = index.docs_with_words(args.second_command) & index.docs_by_author(args.author)
+            print_local_books(index.books(docs), "Not found for this word and author")
+        elif (args.command == 'search-dates' and args.from_date and args.until_date
+              and args.second_command):
+            docs = (index.docs_by_years(args.from_date, args.until_date)
+                    - index.docs_with_words(args.second_command))
+            print_local_books(index.books(docs), "Not found for this word and date range")
+        elif args.command == 'calc-date' and args.author:
+            books = index.books(index.docs_by_author(args.author))
+            if not books:
+                print("Not found for this author")
+                sys.exit(0)
+            print(round(sum(int(book['year']) for book in books) / len(books)))
+        elif args.command == 'top-words' and args.year:
+            print(f"Топ-{args.top} самых популярных слов в книгах {args.year} года:\n")
+            table = PrettyTable(['Слово', 'Количество упоминаний'])
+            for slovo, count in index.top_words(args.year, args.top):
+                table.add_row([slovo, count])
+            print(table)
+        else:
+            print("Error args")
+            sys.exit(1)
+    finally:
+        index.close()
+
+
+def report_metrics(args):
+    """Вывод и запись метрик выполнения команды
+
+    Аргументы:
+        args: разобранные аргументы
+
+    Возвращаемые значения:
+
+    """
+    if not metrics.METRICS['enabled']:
+        return
+    result = metrics.snapshot(args.command, peak_memory())
+    if args.metrics:
+        metrics.print_metrics(result)
+    if args.metrics_json:
+        metrics.write_json(result, args.metrics_json)
+    if args.metrics_prom:
+        metrics.write_prometheus(result, args.metrics_prom)
+
+
+def dispatch(args):
+    """Выполнение команды локально или в Elasticsearch
+
+    Аргументы:
+        args: разобранные аргументы
+
+    Возвращаемые значения:
+
+    """
+    if args.command == 'word-stats':
+        if args.second_command:
+            word_stats(args.second_command, args.top)
+        else:
+            print("Error args")
+            sys.exit(1)
+        return
+    if args.backend == 'local' or args.command == 'build-local':
+        run_local_command(args)
+        return
+    elastic = connect_elasticsearch(args.host, args.port, args.maxsize, args.timeout,
+                                    args.compress, args.sniff, not args.no_ping,
+                                    metrics.METRICS['enabled'])
+    configure_cache(args.cache, args.cache_ttl, args.cache_dir or None)
+    try:
+        run_command(args, elastic)
+    finally:
+        if args.cache:
+            print_cache_stats()
+
+
+def main():
+    """Передача аргументов командной строки исполняемым функциям
+
+    С --profile команда выполняется под cProfile, статистика сохраняется в
+    файл (просмотр: python -m pstats FILE).
+    """
+    args = arg_parse()
+    if args.metrics or args.metrics_json or args.metrics_prom:
+        metrics.enable()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with metrics.phase(args.command):
+            dispatch(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"Профиль сохранен в {args.profile}", file=sys.stderr)
+        report_metrics(args)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,299 @@
+"""
+Метрики выполнения команд: время фаз, запросы к Elasticsearch и took
+
+Фаза - участок кода в phase(name): для нее считаются число вызовов, время
+по часам и процессорное время потока. Фазы могут быть вложенными, время
+вложенной фазы входит и во внешнюю. Запросы учитываются подключением
+MetricsConnection: число, байты запроса и ответа, время и took из ответа
+Elasticsearch по каждому типу запроса (_search, _bulk, ...).
+
+prettytable и elasticsearch6 импортируются только при выводе метрик и
+создании подключения, чтобы не замедлять запуск команд без метрик.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+import contextlib
+
+
+TOOK_RE = re.compile(r'"took"\s*:\s*(\d+)')
+METRICS = {
+    'enabled': False,
+    'phases': {},
+    'requests': {},
+    'lock': threading.Lock(),
+    'start': time.perf_counter(),
+    'cpu_start': time.process_time()
+}
+
+
+def enable():
+    """Включение сбора метрик и сброс накопленных значений"""
+    with METRICS['lock']:
+        METRICS.update(enabled=True, phases={}, requests={}, start=time.perf_counter(),
+                       cpu_start=time.process_time())
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Учет времени участка кода
+
+    Аргументы:
+        name: имя фазы
+
+    Возвращаемые значения:
+
+    """
+    if not METRICS['enabled']:
+        yield
+        return
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+        with METRICS['lock']:
+            record = METRICS['phases'].setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+            record['calls'] += 1
+            record['wall'] += wall
+            record['cpu'] += cpu
+
+
+def endpoint(url):
+    """Тип запроса по пути: последний сегмент API ('_search', '_bulk', ...)
+
+    Аргументы:
+        url: путь запроса
+
+    Возвращаемые значения:
+        name: тип запроса ('doc' - запрос к документу, 'index' - к индексу, 'root' - к '/')
+
+    """
+    parts = [part for part in url.split('?')[0].split('/') if part]
+    if parts[-2:] == ['_search', 'scroll']:
+        return '_search/scroll'
+    api = [part for part in parts if part.startswith('_')]
+    if api:
+        return api[-1]
+    if len(parts) > 1:
+        return 'doc'
+    return 'index' if parts else 'root'
+
+
+def record_request(name, sent, received, wall, took=None, error=False):
+    """Учет одного запроса к Elasticsearch
+
+    Аргументы:
+        name: тип запроса
+        sent: байт в теле запроса
+        received: байт в теле ответа
+        wall: время запроса, с
+        took: время выполнения на сервере из ответа, мс (None - нет в ответе)
+        error: запрос завершился ошибкой
+
+    Возвращаемые значения:
+
+    """
+    with METRICS['lock']:
+        record = METRICS['requests'].setdefault(name, {
+            'count': 0, 'errors': 0, 'sent': 0, 'received': 0, 'wall': 0.0,
+            'took': 0, 'took_max': 0
+        })
+        record['count'] += 1
+        record['errors'] += int(error)
+        record['sent'] += sent
+        record['received'] += received
+        record['wall'] += wall
+        if took is not None:
+            record['took'] += took
+            record['took_max'] = max(record['took_max'], took)
+
+
+def connection_class():
+    """Класс подключения, который учитывает каждый запрос в METRICS
+
+    Возвращаемые значения:
+        MetricsConnection: подкласс Urllib3HttpConnection
+
+    """
+    if 'connection' in METRICS:
+        return METRICS['connection']
+    from elasticsearch6 import Urllib3HttpConnection
+
+    class MetricsConnection(Urllib3HttpConnection):
+        """Подключение, которое учитывает каждый запрос в METRICS"""
+
+        def perform_request(self, method, url, params=None, body=None, timeout=None,
+                            ignore=(), headers=None):
+            start = time.perf_counter()
+            sent = len(body) if body else 0
+            try:
+                status, response_headers, raw_data = super().perform_request(
+                    method, url, params, body, timeout=timeout, ignore=ignore,
+                    headers=headers)
+            except Exception:
+                record_request(endpoint(url), sent, 0, time.perf_counter() - start,
+                               error=True)
+                raise
+            took = TOOK_RE.search(raw_data[:128]) if raw_data else None
+            received = response_headers.get('content-length') if response_headers else None
+            record_request(endpoint(url), sent,
+                           int(received) if received else len(raw_data or ''),
+                           time.perf_counter() - start, int(took.group(1)) if took else None,
+                           status >= 400)
+            return status, response_headers, raw_data
+
+    METRICS['connection'] = MetricsConnection
+    return MetricsConnection
+
+
+def snapshot(command=None, peak_rss_mb=None):
+    """Накопленные метрики в виде словаря для JSON
+
+    Аргументы:
+        command: выполненная команда
+        peak_rss_mb: пиковый RSS, МБ
+
+    Возвращаемые значения:
+        metrics: словарь метрик
+
+    """
+    with METRICS['lock']:
+        return {
+            'command': command,
+            'wall_seconds': round(time.perf_counter() - METRICS['start'], 6),
+            'cpu_seconds': round(time.process_time() - METRICS['cpu_start'], 6),
+            'peak_rss_mb': peak_rss_mb,
+            'phases': {name: {'calls': record['calls'],
+                              'wall_seconds': round(record['wall'], 6),
+                              'cpu_seconds': round(record['cpu'], 6)}
+                       for name, record in METRICS['phases'].items()},
+            'requests': {name: {'count': record['count'],
+                                'errors': record['errors'],
+                                'bytes_sent': record['sent'],
+                                'bytes_received': record['received'],
+                                'wall_seconds': round(record['wall'], 6),
+                                'took_ms': record['took'],
+                                'took_max_ms': record['took_max']}
+                         for name, record in METRICS['requests'].items()}
+        }
+
+
+def print_metrics(metrics, out=sys.stderr):
+    """Вывод метрик таблицами
+
+    Аргументы:
+        metrics: словарь snapshot
+        out: поток вывода
+
+    Возвращаемые значения:
+
+    """
+    from prettytable import PrettyTable
+    print(f"\nМетрики '{metrics['command']}': время {metrics['wall_seconds']:.3f} с, "
+          f"CPU {metrics['cpu_seconds']:.3f} с, пик памяти {metrics['peak_rss_mb']} МБ",
+          file=out)
+    table = PrettyTable(['Фаза', 'Вызовов', 'Время, с', 'CPU, с'])
+    table.align['Фаза'] = 'l'
+    for name, record in sorted(metrics['phases'].items(),
+                               key=lambda item: -item[1]['wall_seconds']):
+        table.add_row([name, record['calls'], round(record['wall_seconds'], 3),
+                       round(record['cpu_seconds'], 3)])
+    print(table, file=out)
+
+    if metrics['requests']:
+        table = PrettyTable(['Запрос', 'Число', 'Ошибок', 'Отправлено, КБ', 'Получено, КБ',
+                             'Время, с', 'took, с', 'took max, мс'])
+        table.align['Запрос'] = 'l'
+        for name, record in sorted(metrics['requests'].items(),
+                                   key=lambda item: -item[1]['wall_seconds']):
+            table.add_row([name, record['count'], record['errors'],
+                           round(record['bytes_sent'] / 1024, 1),
+                           round(record['bytes_received'] / 1024, 1),
+                           round(record['wall_seconds'], 3),
+                           round(record['took_ms'] / 1000, 3), record['took_max_ms']])
+        print(table, file=out)
+
+
+def write_json(metrics, file):
+    """Запись метрик в JSON
+
+    Аргументы:
+        metrics: словарь snapshot
+        file: путь к файлу ('-' - stdout)
+
+    Возвращаемые значения:
+
+    """
+    if file == '-':
+        json.dump(metrics, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+        return
+    with open(file, 'w', encoding='utf-8') as write_file:
+        json.dump(metrics, write_file, ensure_ascii=False, indent=2)
+
+
+def prometheus_label(value):
+    """Экранирование значения метки Prometheus"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_prometheus(metrics, file):
+    """Запись метрик в формате textfile collector (node_exporter)
+
+    Файл записывается атомарно, значения относятся к последнему запуску.
+
+    Аргументы:
+        metrics: словарь snapshot
+        file: путь к файлу .prom
+
+    Возвращаемые значения:
+
+    """
+    command = prometheus_label(metrics['command'])
+    series = {
+        'lr2_run_seconds': ('Время выполнения команды', [({}, metrics['wall_seconds'])]),
+        'lr2_run_cpu_seconds': ('Процессорное время команды',
+                                [({}, metrics['cpu_seconds'])]),
+        'lr2_phase_calls': ('Число вызовов фазы', []),
+        'lr2_phase_seconds': ('Время фазы', []),
+        'lr2_phase_cpu_seconds': ('Процессорное время фазы', []),
+        'lr2_requests': ('Число запросов к Elasticsearch', []),
+        'lr2_request_errors': ('Число запросов с ошибкой', []),
+        'lr2_request_sent_bytes': ('Байт отправлено в запросах', []),
+        'lr2_request_received_bytes': ('Байт получено в ответах', []),
+        'lr2_request_seconds': ('Время запросов', []),
+        'lr2_request_took_seconds': ('Время выполнения на сервере (took)', [])
+    }
+    if metrics['peak_rss_mb'] is not None:
+        series['lr2_peak_rss_bytes'] = ('Пиковый RSS процесса',
+                                        [({}, int(metrics['peak_rss_mb'] * 1024 * 1024))])
+    for name, record in metrics['phases'].items():
+        labels = {'phase': name}
+        series['lr2_phase_calls'][1].append((labels, record['calls']))
+        series['lr2_phase_seconds'][1].append((labels, record['wall_seconds']))
+        series['lr2_phase_cpu_seconds'][1].append((labels, record['cpu_seconds']))
+    for name, record in metrics['requests'].items():
+        labels = {'endpoint': name}
+        series['lr2_requests'][1].append((labels, record['count']))
+        series['lr2_request_errors'][1].append((labels, record['errors']))
+        series['lr2_request_sent_bytes'][1].append((labels, record['bytes_sent']))
+        series['lr2_request_received_bytes'][1].append((labels, record['bytes_received']))
+        series['lr2_request_seconds'][1].append((labels, record['wall_seconds']))
+        series['lr2_request_took_seconds'][1].append((labels, record['took_ms'] / 1000))
+
+    lines = []
+    for name, (help_text, samples) in series.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            labels = dict(labels, command=command)
+            text = ','.join(f'{key}="{prometheus_label(val)}"' for key, val in labels.items())
+            lines.append(f"{name}{{{text}}} {value}")
+    with open(f"{file}.tmp", 'w', encoding='utf-8') as write_file:
+        write_file.write('\n'.join(lines) + '\n')
+    os.replace(f"{file}.tmp", file)
@@ -0,0 +1,6 @@
+"""Тесты запускаются из каталога LR_2 или из корня репозитория"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,34 @@
+"""Подсчет частот на массивах NumPy совпадает с подсчетом словарем"""
+
+import os
+from collections import Counter
+
+import pytest
+
+import analysis
+
+BOOKS = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))), 'LR_3', 'input', 'books')
+
+
+def vector_counts(text, vocabulary):
+    ids, counts = analysis.count_terms(text, vocabulary)
+    return {vocabulary.term(term_id): int(count)
+            for term_id, count in zip(ids.tolist(), counts.tolist())}
+
+
+def test_count_terms_sample():
+    text = ('Князь, князь и КНЯЗЬ! Ёлка ёлка, 1812 год; X_y z2 — и снова Ёлка. '
+            'ΟΔΟΣ 𝔄𝔟𝔠 İstanbul')
+    assert vector_counts(text, analysis.Vocabulary()) == Counter(analysis.analyze(text))
+
+
+@pytest.mark.skipif(not os.path.isdir(BOOKS), reason='нет книг LR_3/input/books')
+def test_count_terms_matches_analyze_on_books():
+    vocabulary = analysis.Vocabulary()
+    for name in sorted(os.listdir(BOOKS)):
+        with open(os.path.join(BOOKS, name), 'r', encoding='utf-8') as read_file:
+            text = read_file.read()
+        if name.endswith('.fb2'):
+            text = analysis.fb2_text(text)
+        assert vector_counts(text, vocabulary) == Counter(analysis.analyze(text)), name
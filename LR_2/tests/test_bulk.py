@@ -0,0 +1,97 @@
+"""Тела bulk-запросов: запись документов без json.dumps и повтор отклоненных строк"""
+
+import json
+
+import pytest
+
+import main
+
+
+TEXT = ('Мой дядя самых честных правил,\n"Когда не в шутку занемог",\t\\ 𝔄𝔟𝔠 ёЁ €\r\n'
+        'Он уважать себя заставил\x01 и лучше выдумать не мог.\n') * 40
+
+
+@pytest.fixture
+def book(tmp_path, monkeypatch):
+    # Маленький блок: многобайтовые символы и escape-последовательности
+    # попадают на границы блоков
+    monkeypatch.setattr(main, 'READ_BLOCK', 7)
+    path = tmp_path / 'book.txt'
+    path.write_bytes(TEXT.encode('utf-8'))
+    with main.mapped_file(str(path)) as mapped:
+        yield mapped
+
+
+@pytest.mark.parametrize('split_kb', [None, 1])
+def test_write_document_matches_json_dumps(book, split_kb):
+    documents = list(main.book_documents('id', 'Евгений "Онегин"', 'Пушкин', '1833', book,
+                                         split_kb))
+    assert (len(documents) > 1) == bool(split_kb)
+    texts = []
+    for _, meta, start, end in documents:
+        out = main.io.BytesIO()
+        main.write_document(out, meta, book, start, end)
+        text = book[start:end].decode('utf-8')
+        texts.append(text)
+        assert out.getvalue() == json.dumps(dict(meta, text=text),
+                                            ensure_ascii=False).encode('utf-8')
+    assert ''.join(texts) == TEXT
+
+
+def test_serialize_book_matches_json_dumps(tmp_path):
+    path = tmp_path / 'book.txt'
+    path.write_bytes(TEXT.encode('utf-8'))
+    documents, size, error = main.serialize_book(str(path), 'id', 'Онегин', 'Пушкин', '1833')
+    assert error is None and size == len(TEXT.encode('utf-8'))
+    assert documents == [('id', json.dumps({'title': 'Онегин', 'author': 'Пушкин',
+                                            'year_publication': '1833', 'book_id': 'id',
+                                            'text': TEXT}, ensure_ascii=False).encode('utf-8'))]
+
+
+class FakeBulk:
+    """Клиент, отклоняющий (429) документы из reject в первых attempts запросах"""
+
+    def __init__(self, reject, attempts=1):
+        self.reject = set(reject)
+        self.attempts = attempts
+        self.bodies = []
+
+    def bulk(self, body):
+        self.bodies.append(body)
+        lines = body.split(b'\n')
+        items = []
+        for action in lines[0:-1:2]:
+            doc_id = json.loads(action)['create']['_id']
+            rejected = doc_id in self.reject and len(self.bodies) <= self.attempts
+            items.append({'create': {'_id': doc_id, 'status': 429 if rejected else 201}})
+        return {'items': items}
+
+
+def actions(count):
+    for number in range(count):
+        data = json.dumps({'text': f'книга {number}'}, ensure_ascii=False).encode('utf-8')
+        yield {'_op_type': 'create', '_index': 'books', '_type': 'document',
+               '_id': f'id{number}', 'size': len(data),
+               'write': main.functools.partial(main.write_bytes, data=data)}
+
+
+def test_send_bulk_resends_only_rejected_lines():
+    (body, items), = main.bulk_chunks(actions(5), 100, 1 << 20)
+    client = FakeBulk(['id1', 'id3'])
+    results = main.send_bulk(client, body, items, max_retries=2, initial_backoff=0)
+
+    assert client.bodies[0] == body
+    lines = body.split(b'\n')
+    assert client.bodies[1] == b'\n'.join(lines[2:4] + lines[6:8]) + b'\n'
+    assert len(client.bodies) == 2
+    assert sorted(list(result.values())[0]['_id'] for success, result in results
+                  if success) == [f'id{number}' for number in range(5)]
+
+
+def test_send_bulk_reports_rejected_after_retries():
+    (body, items), = main.bulk_chunks(actions(3), 100, 1 << 20)
+    client = FakeBulk(['id2'], attempts=2)
+    results = main.send_bulk(client, body, items, max_retries=1, initial_backoff=0)
+    assert len(client.bodies) == 2
+    assert [(success, list(result.values())[0]['_id']) for success, result in results] == \
+        [(True, 'id0'), (True, 'id1'), (False, 'id2')]
@@ -0,0 +1,29 @@
+"""Бюджет времени импортов при запуске python -m main"""
+
+import os
+import sys
+import statistics
+import subprocess
+
+import benchmark
+
+
+def test_import_budget():
+    imports = statistics.median(benchmark.import_time(benchmark.STARTUP_PATHS['arg_parse'])[0]
+                                for _ in range(5))
+    assert imports <= benchmark.IMPORT_BUDGET_MS
+
+
+def test_client_budget():
+    imports = statistics.median(benchmark.import_time(benchmark.STARTUP_PATHS['connect'])[0]
+                                for _ in range(5))
+    assert imports <= benchmark.CLIENT_BUDGET_MS
+
+
+def test_profile_module_is_lazy():
+    # Команда без второго аргумента проходит main() и завершается с "Error args"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'main', 'build-local'],
+                            cwd=os.path.dirname(os.path.abspath(benchmark.__file__)),
+                            capture_output=True, text=True, check=False)
+    assert 'Error args' in result.stdout
+    assert 'cProfile' not in result.stderr
@@ -1,13 +1,16 @@
 import os
 import sys
+import time
+import hashlib
 import argparse
-from statistics import mean
-
-from prettytable import PrettyTable
-from elasticsearch6 import Elasticsearch
+import contextlib
+import xml.etree.ElementTree as ET
 
 
 INDEX_NAME = 'LR3'
+FB2_NS = '{http://www.gribuser.ru/xml/fictionbook/2.1}'
+FB2_PARAGRAPHS = {FB2_NS + tag for tag in ('p', 'v', 'subtitle', 'text-author')}
+FB2_AUTHOR_NAMES = {FB2_NS + tag for tag in ('first-name', 'middle-name', 'last-name')}
 
 
 def arg_parse():
@@ -26,10 +29,40 @@ def arg_parse():
     argument.add_argument("-n", "--name")
     argument.add_argument("-f", "--from_date")
     argument.add_argument("-u", "--until_date")
+    argument.add_argument("--chunk-size", type=int, default=50,
+                          help="число документов в одном bulk-запросе")
+    argument.add_argument("--max-retries", type=int, default=5,
+                          help="число повторов при отказе 429")
+    argument.add_argument("--split-sections", action='store_true',
+                          help="загружать каждый раздел <section> отдельным документом")
+    argument.add_argument("--slices", default='auto',
+                          help="число параллельных частей _reindex ('auto' - по числу шардов)")
+    argument.add_argument("--keep-old", action='store_true',
+                          help="не удалять старый индекс после reindex")
 
     return argument.parse_args()
 
 
+def load_elasticsearch():
+    """Импорт клиента elasticsearch6 перед первым подключением
+
+    Если numpy установлен, но еще не загружен, он скрывается на время
+    импорта: сериализатор elasticsearch6 иначе загружает его (около 50 мс).
+
+    Возвращаемые значения:
+        Elasticsearch: класс клиента
+
+    """
+    if 'elasticsearch6' not in sys.modules and 'numpy' not in sys.modules:
+        sys.modules['numpy'] = None
+        try:
+            import elasticsearch6
+        finally:
+            del sys.modules['numpy']
+    from elasticsearch6 import Elasticsearch
+    return Elasticsearch
+
+
 def connect_elasticsearch(host, port):
     """Подключение к Elasticsearch
 
@@ -41,7 +74,7 @@ def connect_elasticsearch(host, port):
         elastic: объект подключения
 
     """
-    elastic = Elasticsearch([{'host': host, 'port': port}])
+    elastic = load_elasticsearch()([{'host': host, 'port': port}])
     if elastic.ping():
         print('Connect')
     else:
@@ -49,18 +82,14 @@ def connect_elasticsearch(host, port):
     return elastic
 
 
-def create_index(es_object):
-    """Создание индекса
-
-    Аргументы:
-        es_object: объект подключения
+def index_body():
+    """Настройки и маппинг индекса книг
 
     Возвращаемые значения:
-        created: был ли создан новый индекс (True/False)
+        body: тело запроса создания индекса
 
     """
-    created = False
-    body_books = {
+    return {
         "settings": {
             "analysis": {
                 "filter": {
@@ -108,20 +137,379 @@ def create_index(es_object):
                         "type": "text",
                         "analyzer": "custom_analyzer",
                         "search_analyzer": "custom_analyzer"
+                    },
+                    "book_id": {
+                        "type": "keyword"
+                    },
+                    "chunk": {
+                        "type": "integer"
                     }
                 }
             }
         }
     }
 
+
+def index_version(name):
+    """Номер версии физического индекса вида '<INDEX_NAME>-v<номер>'
+
+    Аргументы:
+        name: имя индекса
+
+    Возвращаемые значения:
+        version: номер версии (0 для других имен)
+
+    """
+    suffix = name[len(f'{INDEX_NAME}-v'):]
+    if name.startswith(f'{INDEX_NAME}-v') and suffix.isdigit():
+        return int(suffix)
+    return 0
+
+
+def next_index(es_object):
+    """Имя физического индекса следующей версии
+
+    Аргументы:
+        es_object: объект подключения
+
+    Возвращаемые значения:
+        name: имя индекса '<INDEX_NAME>-v<номер>'
+
+    """
+    res = es_object.indices.get_alias(index=f'{INDEX_NAME}-v*', ignore=404)
+    version = max([index_version(name) for name in res] + [0]) + 1
+    return f'{INDEX_NAME}-v{version}'
+
+
+def alias_indices(es_object):
+    """Физические индексы, из которых сейчас читают запросы
+
+    Аргументы:
+        es_object: объект подключения
+
+    Возвращаемые значения:
+        indices: список имен (INDEX_NAME, если это индекс старого формата без псевдонима)
+
+    """
+    if es_object.indices.exists_alias(name=INDEX_NAME):
+        return sorted(es_object.indices.get_alias(name=INDEX_NAME))
+    if es_object.indices.exists(INDEX_NAME):
+        return [INDEX_NAME]
+    return []
+
+
+def create_index(es_object):
+    """Создание индекса
+
+    Книги хранятся в физическом индексе '<INDEX_NAME>-v<номер>', запросы
+    и загрузка идут через псевдоним INDEX_NAME.
+
+    Аргументы:
+        es_object: объект подключения
+
+    Возвращаемые значения:
+        created: был ли создан новый индекс (True/False)
+
+    """
+    created = False
+    body_books = index_body()
+    body_books["aliases"] = {INDEX_NAME: {}}
     try:
         if not es_object.indices.exists(INDEX_NAME):
-            es_object.indices.create(index=INDEX_NAME, ignore=400, body=body_books)
-            print(f"Индекс: '{INDEX_NAME}' успешно создан!")
+            name = next_index(es_object)
+            es_object.indices.create(index=name, ignore=400, body=body_books)
+            print(f"Индекс: '{name}' (псевдоним '{INDEX_NAME}') успешно создан!")
             created = True
         else:
             print(f"Индекс: '{INDEX_NAME}' уже существует!")
     except TypeError as ex:
         print(str(ex))
 
-    return created
\ No newline at end of file
+    return created
+
+
+def parse_fb2(file_path):
+    """Потоковый разбор файла FictionBook
+
+    Файл читается через iterparse, дерево целиком не строится: абзацы и
+    разделы очищаются сразу после обработки, а разбор останавливается после
+    основного <body>, так что примечания и вложения <binary> не читаются.
+
+    Аргументы:
+        file_path: путь к файлу .fb2
+
+    Возвращаемые значения:
+        book: словарь с полями title, author, year и sections (список текстов
+            разделов <section> основного <body>)
+
+    """
+    book = {'title': None, 'author': None, 'year': None, 'sections': []}
+    author_parts = []
+    paragraphs = []
+
+    for _, elem in ET.iterparse(file_path):
+        tag = elem.tag
+        if tag in FB2_PARAGRAPHS:
+            text = elem.text if len(elem) == 0 else ''.join(elem.itertext())
+            text = (text or '').strip()
+            if text:
+                paragraphs.append(text)
+            elem.clear()
+        elif tag == FB2_NS + 'section':
+            if paragraphs:
+                book['sections'].append('\n'.join(paragraphs))
+                paragraphs = []
+            elem.clear()
+        elif tag == FB2_NS + 'body':
+            break
+        elif tag in FB2_AUTHOR_NAMES and book['author'] is None:
+            if elem.text:
+                author_parts.append(elem.text.strip())
+        elif tag == FB2_NS + 'author' and book['author'] is None:
+            book['author'] = ' '.join(author_parts)
+        elif tag == FB2_NS + 'book-title' and book['title'] is None:
+            book['title'] = (elem.text or '').strip()
+        elif tag == FB2_NS + 'date' and book['year'] is None:
+            book['year'] = (elem.get('value') or elem.text or '').strip()[:4]
+
+    if paragraphs:
+        book['sections'].append('\n'.join(paragraphs))
+    return book
+
+
+def book_id(name, author, year):
+    """Детерминированный идентификатор книги
+
+    Аргументы:
+        name: название книги
+        author: автор
+        year: год публикации
+
+    Возвращаемые значения:
+        idi: идентификатор документа
+
+    """
+    key = '\x00'.join(str(part).strip().lower() for part in (name, author, year))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def book_actions(path, report, split_sections=False):
+    """Генератор bulk-действий для всех файлов .fb2 в каталоге
+
+    С split_sections каждый раздел книги загружается отдельным документом
+    с идентификатором '<id книги>-<номер>' и полями book_id и chunk.
+
+    Аргументы:
+        path: путь к каталогу
+        report: словарь со счетчиками загрузки
+        split_sections: разбивать книги по разделам
+
+    Возвращаемые значения:
+        action: действие для bulk API (по одному на книгу или раздел)
+
+    """
+    for name_file in sorted(os.listdir(f'LR_3/input/{path}')):
+        if not name_file.endswith('.fb2'):
+            continue
+        file_path = f'LR_3/input/{path}/{name_file}'
+        try:
+            book = parse_fb2(file_path)
+        except ET.ParseError as ex:
+            print(f"Ошибка разбора {name_file}: {ex}")
+            report['failed'] += 1
+            continue
+        report['bytes'] += os.path.getsize(file_path)
+        idi = book_id(book['title'], book['author'], book['year'])
+        if split_sections:
+            parts = enumerate(book['sections'])
+        else:
+            parts = [(None, '\n'.join(book['sections']))]
+        for number, text in parts:
+            source = {
+                'title': book['title'],
+                'author': book['author'],
+                'year_publication': book['year'],
+                'text': text,
+                'book_id': idi
+            }
+            if number is not None:
+                source['chunk'] = number
+            yield {
+                '_op_type': 'create',
+                '_index': INDEX_NAME,
+                '_type': 'document',
+                '_id': idi if number is None else f"{idi}-{number}",
+                '_source': source
+            }
+
+
+def add_books(path, es_object, chunk_size=50, max_retries=5, split_sections=False):
+    """Загрузка всех файлов .fb2 в каталоге через bulk API
+
+    Аргументы:
+        path: путь к каталогу
+        es_object: объект подключения
+        chunk_size: число документов в одном запросе
+        max_retries: число повторов при отказе 429
+        split_sections: разбивать книги по разделам
+
+    Возвращаемые значения:
+        report: словарь со счетчиками загрузки
+
+    """
+    from prettytable import PrettyTable
+    from elasticsearch6.helpers import streaming_bulk
+    report = {'indexed': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+    start = time.perf_counter()
+    for success, item in streaming_bulk(es_object, book_actions(path, report, split_sections),
+                                        chunk_size=chunk_size, max_retries=max_retries,
+                                        raise_on_error=False, raise_on_exception=False):
+        info = list(item.values())[0]
+        if success:
+            report['indexed'] += 1
+        elif info.get('status') == 409:
+            report['skipped'] += 1
+            print(f"Эта книга уже существует: {info.get('_id')}")
+        else:
+            report['failed'] += 1
+            print(f"Ошибка загрузки ({info.get('status')}): {info.get('error')}")
+    elapsed = max(time.perf_counter() - start, 1e-9)
+
+    print('Загрузка завершена!')
+    table = PrettyTable(['Загружено', 'Пропущено', 'Ошибок', 'Время, с', 'Док/с', 'МБ/с'])
+    table.add_row([
+        report['indexed'],
+        report['skipped'],
+        report['failed'],
+        round(elapsed, 2),
+        round(report['indexed'] / elapsed, 2),
+        round(report['bytes'] / 1024 / 1024 / elapsed, 2)
+    ])
+    print(table)
+    return report
+
+
+def wait_task(es_object, task_id, interval=2):
+    """Ожидание завершения фоновой задачи Elasticsearch с выводом прогресса
+
+    Аргументы:
+        es_object: объект подключения
+        task_id: идентификатор задачи
+        interval: период опроса, с
+
+    Возвращаемые значения:
+        response: результат задачи (None при ошибке)
+
+    """
+    while True:
+        res = es_object.tasks.get(task_id=task_id)
+        status = res['task']['status']
+        print(f"Перенесено документов: {status['created']} из {status['total']}")
+        if res.get('completed'):
+            if 'error' in res:
+                print(f"Ошибка задачи {task_id}: {res['error']}")
+                return None
+            return res['response']
+        time.sleep(interval)
+
+
+def reindex(es_object, slices='auto', keep_old=False):
+    """Перестроение индекса в новой версии с переключением псевдонима
+
+    Новый индекс создается с текущими настройками (index_body) и
+    заполняется параллельным _reindex, пока запросы читают старый индекс.
+    После проверки числа документов псевдоним переключается атомарно.
+
+    Аргументы:
+        es_object: объект подключения
+        slices: число частей _reindex ('auto' - по числу шардов)
+        keep_old: не удалять старый индекс после переключения
+
+    Возвращаемые значения:
+        target: имя нового индекса
+
+    """
+    old = alias_indices(es_object)
+    if not old:
+        print(f"Индекс '{INDEX_NAME}' не создан")
+        sys.exit(1)
+    replicas = next(iter(es_object.indices.get_settings(index=old[0])
+                         .values()))['settings']['index']['number_of_replicas']
+
+    target = next_index(es_object)
+    body = index_body()
+    body['settings'].update({'number_of_replicas': 0, 'refresh_interval': '-1'})
+    es_object.indices.create(index=target, body=body)
+    print(f"Создан индекс '{target}', источник: {', '.join(old)}")
+
+    start = time.perf_counter()
+    task = None
+    try:
+        task = es_object.reindex(body={
+            'source': {'index': INDEX_NAME, 'size': 1000},
+            'dest': {'index': target, 'op_type': 'create'}
+        }, slices=slices, wait_for_completion=False)['task']
+        response = wait_task(es_object, task)
+        failed = response is None or bool(response.get('failures'))
+
+        es_object.indices.put_settings(index=target, body={
+            'index.refresh_interval': None,
+            'index.number_of_replicas': replicas
+        })
+        es_object.indices.refresh(index=target)
+        expected = es_object.count(index=INDEX_NAME)['count']
+        count = es_object.count(index=target)['count']
+    except BaseException:
+        # Недозаполненный индекс без реплик и обновления не должен оставаться
+        print(f"Перестроение прервано, псевдоним не переключен, индекс '{target}' удален")
+        with contextlib.suppress(Exception):
+            if task is not None:
+                es_object.tasks.cancel(task_id=task)
+            es_object.indices.delete(index=target, ignore=404)
+        raise
+    if failed or count != expected:
+        print(f"Проверка не пройдена: в '{INDEX_NAME}' {expected} документов, "
+              f"в '{target}' {count}, ошибок: {'есть' if failed else 'нет'}. "
+              f"Псевдоним не переключен, индекс '{target}' удален")
+        es_object.indices.delete(index=target)
+        sys.exit(1)
+
+    actions = [{'add': {'index': target, 'alias': INDEX_NAME}}]
+    if old == [INDEX_NAME]:
+        actions.append({'remove_index': {'index': INDEX_NAME}})
+    else:
+        actions += [{'remove': {'index': name, 'alias': INDEX_NAME}} for name in old]
+    es_object.indices.update_aliases(body={'actions': actions})
+    print(f"Псевдоним '{INDEX_NAME}' переключен на '{target}': {count} документов "
+          f"за {round(time.perf_counter() - start, 2)} с")
+
+    old = [name for name in old if name != INDEX_NAME]
+    if old and not keep_old:
+        es_object.indices.delete(index=','.join(old))
+        print(f"Удален старый индекс: {', '.join(old)}")
+    return target
+
+
+def main():
+    """Передача аргументов командной строки исполняемым функциям"""
+    args = arg_parse()
+    elastic = connect_elasticsearch(args.host, args.port)
+    if args.command == 'create':
+        create_index(elastic)
+        sys.exit(0)
+    elif args.command == 'reindex':
+        reindex(elastic, args.slices, args.keep_old)
+    elif args.command == 'add-books':
+        if args.second_command:
+            add_books(args.second_command, elastic, args.chunk_size, args.max_retries,
+                      args.split_sections)
+        else:
+            print("Error args")
+            sys.exit(1)
+    else:
+        print("Unknown command")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()